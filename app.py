@@ -1,17 +1,45 @@
-﻿from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+﻿from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response, stream_with_context, send_from_directory, send_file, make_response, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from werkzeug.security import safe_join
 from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy import func, and_, or_, bindparam, select, update, case, event, inspect, cast, Float, Numeric
 from functools import wraps
+from collections import namedtuple, defaultdict, Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import os
+import re
+import math
 import sys
+import csv
+import unicodedata
+import io
+import gzip
+import json
+import zlib
+import hashlib
+import threading
+import zipfile
+import multiprocessing
+import mimetypes
+import bisect
+import itertools
+import click
 import webbrowser
 import logging
 import secrets
 import string
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import time
+import warnings
 import smtplib
 from email.mime.text import MIMEText
+from difflib import SequenceMatcher
+import numpy as np
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape as escape_xml
+from gerador_pdf import html_para_pdf
 
 # ==============================================================================
 # CONFIGURAÃ‡ÃƒO DE LOGGING PROFISSIONAL
@@ -110,7 +138,7 @@ class Loja(db.Model):
 class Maquina(db.Model):
     __tablename__ = 'maquinas'
     id = db.Column(db.Integer, primary_key=True)
-    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), index=True)
     fingerprint = db.Column(db.String(255), unique=True)
     ativa = db.Column(db.Boolean, default=True)
     criada_em = db.Column(db.DateTime, default=datetime.now)
@@ -131,6 +159,8 @@ class LogAcesso(db.Model):
     usuario = db.relationship('Usuario')
     loja = db.relationship('Loja')
 
+    __table_args__ = (db.Index('ix_logs_acesso_loja_data', 'loja_id', 'data'),)
+
 class HistoricoLicenca(db.Model):
     __tablename__ = 'historico_licencas'
     id = db.Column(db.Integer, primary_key=True)
@@ -152,11 +182,20 @@ class Categoria(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
 
+    __table_args__ = (
+        db.Index('ix_categorias_loja_nome', 'loja_id', 'nome', postgresql_include=['user_id']),
+    )
+
 class Unidade(db.Model):
     __tablename__ = 'unidades'
     id = db.Column(db.Integer, primary_key=True)
     sigla = db.Column(db.String(10), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+
+    __table_args__ = (
+        db.Index('ix_unidades_loja_sigla', 'loja_id', 'sigla', postgresql_include=['user_id']),
+    )
 
 class Insumo(db.Model):
     __tablename__ = 'insumos'
@@ -170,10 +209,17 @@ class Insumo(db.Model):
     fator_correcao = db.Column(db.Float, default=1.0)
     custo_unitario = db.Column(db.Float, default=0.0)
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+    versao = db.Column(db.Integer, nullable=False, default=1)
     
     categoria = db.relationship('Categoria', backref='insumos')
     unidade = db.relationship('Unidade', backref='insumos')
 
+    __mapper_args__ = {'version_id_col': versao}
+    __table_args__ = (
+        db.Index('ix_insumos_loja_nome', 'loja_id', 'nome',
+                 postgresql_include=['user_id', 'categoria_id', 'unidade_id', 'custo_unitario']),
+    )
+
 class Base(db.Model):
     __tablename__ = 'bases'
     id = db.Column(db.Integer, primary_key=True)
@@ -183,6 +229,12 @@ class Base(db.Model):
     data_atualizacao = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
     itens = db.relationship('BaseItem', backref='base', cascade='all, delete-orphan')
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+    versao = db.Column(db.Integer, nullable=False, default=1)
+
+    __mapper_args__ = {'version_id_col': versao}
+    __table_args__ = (
+        db.Index('ix_bases_loja_nome', 'loja_id', 'nome', postgresql_include=['user_id', 'rendimento_final']),
+    )
 
     @property
     def custo_total_producao(self):
@@ -205,12 +257,17 @@ class Base(db.Model):
 class BaseItem(db.Model):
     __tablename__ = 'base_itens'
     id = db.Column(db.Integer, primary_key=True)
-    base_id = db.Column(db.Integer, db.ForeignKey('bases.id'))
+    base_id = db.Column(db.Integer, db.ForeignKey('bases.id'), index=True)
     insumo_id = db.Column(db.Integer, db.ForeignKey('insumos.id'))
     quantidade = db.Column(db.Float, nullable=False)
     insumo = db.relationship('Insumo')
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
 
+    __table_args__ = (
+        # Índice reverso insumo -> bases (tela "onde é usado" e exclusões)
+        db.Index('ix_base_itens_insumo', 'insumo_id', 'base_id'),
+    )
+
 class Ficha(db.Model):
     __tablename__ = 'fichas'
     id = db.Column(db.Integer, primary_key=True)
@@ -221,17 +278,201 @@ class Ficha(db.Model):
     cmv_alvo = db.Column(db.Float, default=30.0)
     data_criacao = db.Column(db.DateTime, default=datetime.now)
     itens = db.relationship('FichaItem', backref='ficha', cascade='all, delete-orphan')
+    alertas_cmv = db.relationship('AlertaCmv', backref='ficha', cascade='all, delete-orphan')
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+    versao = db.Column(db.Integer, nullable=False, default=1)
+    codigo_pdv = db.Column(db.String(40))  # código do produto no sistema de vendas
+
+    __mapper_args__ = {'version_id_col': versao}
+    __table_args__ = (
+        db.Index('ix_fichas_loja_nome', 'loja_id', 'nome', postgresql_include=['user_id']),
+        db.Index('ix_fichas_loja_codigo_pdv', 'loja_id', 'codigo_pdv', unique=True),
+    )
 
 class FichaItem(db.Model):
     __tablename__ = 'ficha_itens'
     id = db.Column(db.Integer, primary_key=True)
-    ficha_id = db.Column(db.Integer, db.ForeignKey('fichas.id'))
+    ficha_id = db.Column(db.Integer, db.ForeignKey('fichas.id'), index=True)
     tipo_item = db.Column(db.String(10)) 
     referencia_id = db.Column(db.Integer, nullable=False)
     quantidade = db.Column(db.Float, nullable=False)
     loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
 
+    __table_args__ = (
+        # Índice reverso insumo/base -> fichas (tela "onde é usado" e exclusões)
+        db.Index('ix_ficha_itens_tipo_referencia', 'tipo_item', 'referencia_id', 'ficha_id'),
+    )
+
+class FornecedorProduto(db.Model):
+    """Código do produto no fornecedor (CNPJ + cProd da NF-e) -> insumo"""
+    __tablename__ = 'fornecedor_produtos'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    cnpj = db.Column(db.String(14), nullable=False)
+    codigo = db.Column(db.String(60), nullable=False)
+    descricao = db.Column(db.String(150))
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumos.id'), nullable=False)
+    # Quantidade do insumo em cada unidade comercial da nota (ex.: CX com 12 KG);
+    # vazio = mantém o tamanho de embalagem do insumo
+    tamanho_embalagem = db.Column(db.Float, nullable=True)
+    # 'MANUAL', 'NOME' ou 'SUGERIDO' (nome parecido ainda não confirmado: não casa nem aplica preço)
+    origem = db.Column(db.String(12), default='MANUAL')
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+    insumo = db.relationship('Insumo')
+
+    __table_args__ = (
+        db.Index('ix_fornecedor_produtos_codigo', 'loja_id', 'cnpj', 'codigo', unique=True),
+        db.Index('ix_fornecedor_produtos_insumo', 'insumo_id'),
+    )
+
+class NotaFiscal(db.Model):
+    __tablename__ = 'notas_fiscais'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    chave = db.Column(db.String(44), nullable=False)
+    numero = db.Column(db.String(20))
+    cnpj_emitente = db.Column(db.String(14))
+    emitente = db.Column(db.String(150))
+    data_emissao = db.Column(db.DateTime)
+    valor_total = db.Column(db.Float, default=0.0)
+    importada_em = db.Column(db.DateTime, default=datetime.now)
+    itens = db.relationship('NotaFiscalItem', backref='nota', cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('ix_notas_fiscais_loja_chave', 'loja_id', 'chave', unique=True),
+    )
+
+class NotaFiscalItem(db.Model):
+    __tablename__ = 'notas_fiscais_itens'
+    id = db.Column(db.Integer, primary_key=True)
+    nota_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais.id'), index=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'))
+    numero_item = db.Column(db.Integer)
+    codigo = db.Column(db.String(60))
+    descricao = db.Column(db.String(150))
+    unidade = db.Column(db.String(10))
+    quantidade = db.Column(db.Float, default=0.0)
+    valor_unitario = db.Column(db.Float, default=0.0)   # líquido de desconto
+    valor_total = db.Column(db.Float, default=0.0)
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumos.id'), index=True)
+    quantidade_insumo = db.Column(db.Float)              # quantidade na unidade do insumo
+
+class VendaDiaria(db.Model):
+    """Vendas do PDV somadas por ficha e dia (uma linha por loja/ficha/dia)"""
+    __tablename__ = 'vendas_diarias'
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), primary_key=True)
+    ficha_id = db.Column(db.Integer, db.ForeignKey('fichas.id'), primary_key=True)
+    dia = db.Column(db.Date, primary_key=True)
+    quantidade = db.Column(db.Float, nullable=False, default=0.0)
+    receita = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        db.Index('ix_vendas_diarias_loja_dia', 'loja_id', 'dia'),
+    )
+
+class VendaSemFicha(db.Model):
+    """Vendas de códigos do PDV ainda sem ficha; migram ao vincular o código"""
+    __tablename__ = 'vendas_sem_ficha'
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), primary_key=True)
+    codigo = db.Column(db.String(40), primary_key=True)
+    dia = db.Column(db.Date, primary_key=True)
+    descricao = db.Column(db.String(150))
+    quantidade = db.Column(db.Float, nullable=False, default=0.0)
+    receita = db.Column(db.Float, nullable=False, default=0.0)
+
+class ImportacaoVendas(db.Model):
+    __tablename__ = 'importacoes_vendas'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    hash_arquivo = db.Column(db.String(64), nullable=False)
+    nome_arquivo = db.Column(db.String(255))
+    linhas = db.Column(db.Integer, default=0)
+    quantidade_total = db.Column(db.Float, default=0.0)
+    receita_total = db.Column(db.Float, default=0.0)
+    data_inicio = db.Column(db.Date)
+    data_fim = db.Column(db.Date)
+    importada_em = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_importacoes_vendas_loja_hash', 'loja_id', 'hash_arquivo', unique=True),
+    )
+
+class MovimentoEstoque(db.Model):
+    """Razão de estoque (só inclusão): entradas positivas, saídas negativas, na unidade do insumo"""
+    __tablename__ = 'movimentos_estoque'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumos.id'), nullable=False)
+    data = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    tipo = db.Column(db.String(10), nullable=False)  # 'COMPRA', 'VENDA', 'PERDA', 'CONTAGEM'
+    quantidade = db.Column(db.Float, nullable=False)
+    saldo_contado = db.Column(db.Float)              # só em CONTAGEM: o que foi contado
+    nota_item_id = db.Column(db.Integer, db.ForeignKey('notas_fiscais_itens.id'), index=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('usuarios.id'))
+    observacao = db.Column(db.String(200))
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_movimentos_estoque_loja_insumo_data', 'loja_id', 'insumo_id', 'data'),
+        db.Index('ix_movimentos_estoque_loja_tipo_data', 'loja_id', 'tipo', 'data'),
+    )
+
+class SaldoEstoque(db.Model):
+    """Foto do saldo de um insumo: soma dos movimentos com data <= data_corte"""
+    __tablename__ = 'saldos_estoque'
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), primary_key=True)
+    insumo_id = db.Column(db.Integer, db.ForeignKey('insumos.id'), primary_key=True)
+    data_corte = db.Column(db.DateTime, primary_key=True)
+    saldo = db.Column(db.Float, nullable=False, default=0.0)
+
+class PrevisaoLote(db.Model):
+    """Previsão de demanda calculada para a loja, o modelo e a data-base (último dia com vendas)"""
+    __tablename__ = 'previsoes_lotes'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    modelo = db.Column(db.String(12), nullable=False)  # 'SAZONAL', 'SUAVIZACAO'
+    data_base = db.Column(db.Date, nullable=False)
+    assinatura = db.Column(db.String(40))              # vendas até a data-base quando foi calculada
+    incremental = db.Column(db.Boolean, default=False)
+    gerado_em = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.Index('ix_previsoes_lotes_loja_modelo_data', 'loja_id', 'modelo', 'data_base', unique=True),
+    )
+
+class PrevisaoFicha(db.Model):
+    """Previsão e estado do modelo de uma ficha (cache; sem chave estrangeira para a ficha)"""
+    __tablename__ = 'previsoes_fichas'
+    lote_id = db.Column(db.Integer, db.ForeignKey('previsoes_lotes.id'), primary_key=True)
+    ficha_id = db.Column(db.Integer, primary_key=True)
+    mape = db.Column(db.Float)
+    previsao = db.Column(db.Text)  # JSON: quantidades dos próximos dias
+    estado = db.Column(db.Text)    # JSON: estado do modelo na data-base
+
+class AlertaCmv(db.Model):
+    """Ficha que passou do CMV-alvo depois de uma mudança no custo dos insumos"""
+    __tablename__ = 'alertas_cmv'
+    id = db.Column(db.Integer, primary_key=True)
+    loja_id = db.Column(db.Integer, db.ForeignKey('lojas.id'), nullable=False)
+    ficha_id = db.Column(db.Integer, db.ForeignKey('fichas.id'), nullable=False, index=True)
+    cmv_anterior = db.Column(db.Float, nullable=False)
+    cmv_novo = db.Column(db.Float, nullable=False)
+    cmv_alvo = db.Column(db.Float, nullable=False)
+    criado_em = db.Column(db.DateTime, default=datetime.now)
+    visto_em = db.Column(db.DateTime)  # dispensado no painel
+
+    __table_args__ = (
+        db.Index('ix_alertas_cmv_loja_visto', 'loja_id', 'visto_em', 'criado_em'),
+    )
+
+class VersaoLoja(db.Model):
+    """Contador de alterações nos dados da loja (ETag das telas); loja 0 = alterações sem loja conhecida"""
+    __tablename__ = 'versoes_lojas'
+    loja_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    versao = db.Column(db.Integer, nullable=False, default=0)
+
 # ==============================================================================
 # FUNÃ‡Ã•ES AUXILIARES
 # ==============================================================================
@@ -284,6 +525,93 @@ def verificar_licenca_maquina(loja_id, fingerprint):
     
     return True, "LicenÃ§a vÃ¡lida"
 
+# ==============================================================================
+# NORMALIZAÇÃO DE NOMES E NÚMEROS
+# ==============================================================================
+def normalizar_nome(texto):
+    """Nome comparável: maiúsculo, sem acentos e com espaços simples"""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return ' '.join(texto.upper().split())
+
+def converter_decimal(valor):
+    """Converte números no formato brasileiro ('1.234,56', 'R$ 8,90') ou com ponto"""
+    texto = str(valor or '').replace('R$', '').replace(' ', '').strip()
+    if not texto:
+        return None
+    if ',' in texto:
+        texto = texto.replace('.', '').replace(',', '.')
+    try:
+        return float(texto)
+    except ValueError:
+        raise ValueError(f"número inválido: '{valor}'")
+
+def em_lotes(itens, tamanho=500):
+    """Divide uma sequência em listas de até `tamanho` (limite de parâmetros do IN)"""
+    itens = list(itens)
+    for inicio in range(0, len(itens), tamanho):
+        yield itens[inicio:inicio + tamanho]
+
+# ==============================================================================
+# ESCOPO POR LOJA (MULTI-TENANT)
+# ==============================================================================
+def eh_admin(usuario):
+    return usuario.role == 'admin' or usuario.username == 'bpereira'
+
+def filtros_loja(modelo, usuario, por_dono=None):
+    """Critérios que limitam `modelo` à loja do usuário.
+
+    Administradores enxergam a loja inteira; usuários comuns, só os próprios
+    registros. `por_dono` força (True) ou dispensa (False) o filtro de dono.
+    Os filtros casam com os índices (loja_id, nome) de cada tabela.
+    """
+    if por_dono is None:
+        por_dono = not eh_admin(usuario)
+    filtros = [modelo.loja_id == usuario.loja_id]
+    if por_dono and hasattr(modelo, 'user_id'):
+        filtros.append(modelo.user_id == usuario.id)
+    return filtros
+
+def escopo_loja(modelo, usuario, por_dono=None):
+    """Consulta de `modelo` já restrita à loja (e, se for o caso, ao dono)"""
+    return modelo.query.filter(*filtros_loja(modelo, usuario, por_dono))
+
+def acesso_loja(obj, usuario):
+    """Se o registro passa pelos critérios de filtros_loja (o mestre acessa qualquer loja).
+
+    Usado nas telas de um registro só, para que abrir, editar e excluir sigam
+    as mesmas regras das listagens.
+    """
+    if usuario.username == 'bpereira':
+        return True
+    if obj.loja_id != usuario.loja_id:
+        return False
+    return eh_admin(usuario) or not hasattr(obj, 'user_id') or obj.user_id == usuario.id
+
+# ==============================================================================
+# CONTROLE DE CONCORRÊNCIA OTIMISTA (FICHAS, BASES E INSUMOS)
+# ==============================================================================
+def versao_confere(obj):
+    """Compara a versão enviada pelo formulário com a versão atual do registro"""
+    enviada = request.form.get('versao', type=int)
+    return enviada is None or enviada == obj.versao
+
+def travar_versao(obj):
+    """Incrementa a versão e emite o UPDATE condicional antes de mexer nos itens.
+
+    O UPDATE só afeta a linha se a versão no banco ainda for a carregada; caso
+    contrário o SQLAlchemy levanta StaleDataError e nada é gravado.
+    """
+    obj.versao = obj.versao + 1
+    db.session.flush()
+
+def conflito_edicao(tipo, nome, url_voltar):
+    db.session.rollback()
+    return render_template('conflito_edicao.html',
+                           tipo=tipo,
+                           nome=nome,
+                           url_voltar=url_voltar), 409
+
 # ==============================================================================
 # SISTEMA DE ALERTAS POR EMAIL
 # ==============================================================================
@@ -615,14 +943,24 @@ class EngineCalculo:
                 'subtotal': subtotal
             })
 
-        custo_porcao = custo_total / ficha.porcoes if ficha.porcoes > 0 else 0
-        lucro_bruto = ficha.preco_venda - custo_porcao
-        margem = (lucro_bruto / ficha.preco_venda * 100) if ficha.preco_venda > 0 else 0
-        cmv_real = (custo_porcao / ficha.preco_venda * 100) if ficha.preco_venda > 0 else 0
-        p_sugerido = custo_porcao / (ficha.cmv_alvo / 100) if ficha.cmv_alvo > 0 else 0
+        metricas = EngineCalculo.indicadores(custo_total, ficha.porcoes, ficha.preco_venda, ficha.cmv_alvo)
+        metricas['itens'] = detalhes_itens
+        return metricas
+
+    @staticmethod
+    def indicadores(custo_total, porcoes, preco_venda, cmv_alvo):
+        """Indicadores de uma ficha a partir do custo total da receita"""
+        porcoes = porcoes or 0
+        preco_venda = preco_venda or 0
+        cmv_alvo = cmv_alvo or 0
+        
+        custo_porcao = custo_total / porcoes if porcoes > 0 else 0
+        lucro_bruto = preco_venda - custo_porcao
+        margem = (lucro_bruto / preco_venda * 100) if preco_venda > 0 else 0
+        cmv_real = (custo_porcao / preco_venda * 100) if preco_venda > 0 else 0
+        p_sugerido = custo_porcao / (cmv_alvo / 100) if cmv_alvo > 0 else 0
 
         return {
-            'itens': detalhes_itens,
             'custo_total': custo_total,
             'custo_porcao': custo_porcao,
             'lucro_bruto': lucro_bruto,
@@ -631,6 +969,528 @@ class EngineCalculo:
             'preco_sugerido': p_sugerido
         }
 
+    @staticmethod
+    def processar_fichas(ficha_ids, detalhar=False):
+        """Versão em lote do processar_ficha.
+
+        Usa um punhado de consultas para qualquer quantidade de fichas em vez
+        de uma consulta por item. Com `detalhar`, cada ficha traz também a
+        lista 'itens' no mesmo formato do processar_ficha.
+        """
+        fichas, itens = [], []
+        for lote in em_lotes(set(ficha_ids)):
+            fichas.extend(db.session.query(Ficha.id, Ficha.nome, Ficha.porcoes, Ficha.preco_venda, Ficha.cmv_alvo)
+                          .filter(Ficha.id.in_(lote)))
+            itens.extend(db.session.query(FichaItem.ficha_id, FichaItem.tipo_item,
+                                          FichaItem.referencia_id, FichaItem.quantidade)
+                         .filter(FichaItem.ficha_id.in_(lote)).order_by(FichaItem.id))
+        
+        insumo_ids = {ref for _, tipo, ref, _ in itens if tipo == 'insumo'}
+        base_ids = {ref for _, tipo, ref, _ in itens if tipo != 'insumo'}
+        custos_insumo, custos_base, nomes = {}, {}, {}
+        for lote in em_lotes(insumo_ids):
+            for id_, nome, custo, sigla in (db.session.query(Insumo.id, Insumo.nome, Insumo.custo_unitario, Unidade.sigla)
+                                            .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                                            .filter(Insumo.id.in_(lote))):
+                custos_insumo[id_] = custo
+                nomes[('insumo', id_)] = (nome, sigla or "un")
+        for lote in em_lotes(base_ids):
+            for b in listar_bases_resumo(Base.id.in_(lote)):
+                custos_base[b.id] = b.custo_por_kg_litro
+                nomes[('base', b.id)] = (f"[BASE] {b.nome}", "Base")
+        
+        custo_total, detalhes = {}, defaultdict(list)
+        for ficha_id, tipo, ref, qtd in itens:
+            custo_un = custos_insumo.get(ref) if tipo == 'insumo' else custos_base.get(ref)
+            subtotal = (qtd or 0) * (custo_un or 0)
+            custo_total[ficha_id] = custo_total.get(ficha_id, 0.0) + subtotal
+            if detalhar:
+                nome, unidade = nomes.get(('insumo' if tipo == 'insumo' else 'base', ref), ("Desconhecido", "-"))
+                detalhes[ficha_id].append({'nome': nome, 'qtd': qtd, 'un': unidade, 'custo_un': custo_un or 0,
+                                           'subtotal': subtotal})
+        
+        resultado = {}
+        for ficha_id, nome, porcoes, preco_venda, cmv_alvo in fichas:
+            metricas = EngineCalculo.indicadores(custo_total.get(ficha_id, 0.0), porcoes, preco_venda, cmv_alvo)
+            metricas.update({'id': ficha_id, 'nome': nome, 'preco_venda': preco_venda or 0, 'cmv_alvo': cmv_alvo or 0})
+            if detalhar:
+                metricas['itens'] = detalhes[ficha_id]
+            resultado[ficha_id] = metricas
+        return resultado
+
+# ==============================================================================
+# GRAFO DE RECEITAS (EXPLOSÃO EM MATRIZES)
+# ==============================================================================
+# As receitas da loja viram matrizes esparsas (só os itens que existem, em
+# vetores de linha, coluna e valor do NumPy): linhas são fichas (ou bases) e
+# colunas são insumos, com a quantidade por porção vendida (ou por KG/L de
+# base produzido). Uma ficha com base é explodida uma vez só na montagem
+# (ficha_base x base_insumo), então o consumo de qualquer período é um único
+# produto vetor x matriz. Os grafos ficam em cache por loja (os
+# GRAFOS_EM_CACHE usados mais recentemente) e são refeitos quando muda a
+# versão, a quantidade ou o maior id de fichas, bases ou insumos.
+GRAFOS_EM_CACHE = int(os.environ.get('GRAFOS_EM_CACHE', 16))
+
+class MatrizEsparsa:
+    """Matriz linhas x colunas guardada como trincas (linha, coluna, valor).
+
+    Trincas repetidas são somadas na montagem; elas ficam ordenadas por coluna
+    para que o produto some cada coluna com um único np.add.reduceat.
+    """
+    
+    def __init__(self, forma, linhas, colunas, valores):
+        self.forma = forma
+        linhas = np.asarray(linhas, dtype=np.intp)
+        colunas = np.asarray(colunas, dtype=np.intp)
+        valores = np.asarray(valores, dtype=np.float64)
+        chaves, posicao = np.unique(colunas * max(forma[0], 1) + linhas, return_inverse=True)
+        self.valores = np.bincount(posicao, weights=valores, minlength=len(chaves)) if len(chaves) else valores
+        self.linhas = chaves % max(forma[0], 1)
+        self.colunas = chaves // max(forma[0], 1)
+        self._colunas_usadas, self._inicios = np.unique(self.colunas, return_index=True)
+    
+    def multiplicar(self, x):
+        """x @ matriz, com x um vetor de linhas ou uma matriz (n x linhas)"""
+        resultado = np.zeros(np.shape(x)[:-1] + (self.forma[1],))
+        if len(self.valores):
+            parcelas = np.asarray(x, dtype=np.float64)[..., self.linhas] * self.valores
+            resultado[..., self._colunas_usadas] = np.add.reduceat(parcelas, self._inicios, axis=-1)
+        return resultado
+    
+    def compor(self, outra):
+        """Produto self x outra, também esparso (cada trinca de self se junta à linha correspondente de outra)"""
+        ordem = np.argsort(outra.linhas, kind='stable')
+        linhas_outra, colunas_outra, valores_outra = outra.linhas[ordem], outra.colunas[ordem], outra.valores[ordem]
+        por_linha = np.bincount(linhas_outra, minlength=outra.forma[0])
+        inicio_linha = np.cumsum(por_linha) - por_linha
+        repeticoes = por_linha[self.colunas]
+        deslocamento = np.arange(repeticoes.sum()) - np.repeat(np.cumsum(repeticoes) - repeticoes, repeticoes)
+        posicao = np.repeat(inicio_linha[self.colunas], repeticoes) + deslocamento
+        return MatrizEsparsa((self.forma[0], outra.forma[1]), np.repeat(self.linhas, repeticoes),
+                             colunas_outra[posicao], np.repeat(self.valores, repeticoes) * valores_outra[posicao])
+    
+    def somar(self, outra):
+        return MatrizEsparsa(self.forma, np.concatenate([self.linhas, outra.linhas]),
+                             np.concatenate([self.colunas, outra.colunas]),
+                             np.concatenate([self.valores, outra.valores]))
+
+class GrafoReceitas:
+    def __init__(self, loja_id):
+        self.loja_id = loja_id
+        fichas = (db.session.query(Ficha.id, Ficha.porcoes).filter(Ficha.loja_id == loja_id)
+                  .order_by(Ficha.id).all())
+        bases = (db.session.query(Base.id, Base.rendimento_final).filter(Base.loja_id == loja_id)
+                 .order_by(Base.id).all())
+        insumos = (db.session.query(Insumo.id, Insumo.fator_correcao).filter(Insumo.loja_id == loja_id)
+                   .order_by(Insumo.id).all())
+        
+        self.ficha_ids = np.array([f for f, _ in fichas], dtype=np.int64)
+        self.base_ids = np.array([b for b, _ in bases], dtype=np.int64)
+        self.insumo_ids = np.array([i for i, _ in insumos], dtype=np.int64)
+        self.indice_ficha = {f: n for n, f in enumerate(self.ficha_ids.tolist())}
+        self.indice_base = {b: n for n, b in enumerate(self.base_ids.tolist())}
+        self.indice_insumo = {i: n for n, i in enumerate(self.insumo_ids.tolist())}
+        # Quantidade bruta (de compra) = quantidade líquida da receita x fator de correção
+        self.fator_correcao = np.array([fc or 1.0 for _, fc in insumos], dtype=np.float64)
+        self.rendimento = np.array([r or 0.0 for _, r in bases], dtype=np.float64)
+        
+        porcoes = {f: p for f, p in fichas}
+        rendimento = {b: r for b, r in bases}
+        
+        linhas, colunas, valores = [], [], []
+        for base_id, insumo_id, qtd in (db.session.query(BaseItem.base_id, BaseItem.insumo_id, BaseItem.quantidade)
+                                        .join(Base, BaseItem.base_id == Base.id)
+                                        .filter(Base.loja_id == loja_id)):
+            if insumo_id in self.indice_insumo and rendimento.get(base_id) and rendimento[base_id] > 0:
+                linhas.append(self.indice_base[base_id])
+                colunas.append(self.indice_insumo[insumo_id])
+                valores.append((qtd or 0) / rendimento[base_id])
+        self.base_insumo = MatrizEsparsa((len(bases), len(insumos)), linhas, colunas, valores)
+        
+        itens = {'insumo': ([], [], []), 'base': ([], [], [])}
+        for ficha_id, tipo, ref, qtd in (db.session.query(FichaItem.ficha_id, FichaItem.tipo_item,
+                                                          FichaItem.referencia_id, FichaItem.quantidade)
+                                         .join(Ficha, FichaItem.ficha_id == Ficha.id)
+                                         .filter(Ficha.loja_id == loja_id)):
+            indice = self.indice_insumo if tipo == 'insumo' else self.indice_base
+            if ref not in indice or not porcoes.get(ficha_id) or porcoes[ficha_id] <= 0:
+                continue
+            linhas, colunas, valores = itens['insumo' if tipo == 'insumo' else 'base']
+            linhas.append(self.indice_ficha[ficha_id])
+            colunas.append(indice[ref])
+            valores.append((qtd or 0) / porcoes[ficha_id])
+        direto = MatrizEsparsa((len(fichas), len(insumos)), *itens['insumo'])
+        self.ficha_base = MatrizEsparsa((len(fichas), len(bases)), *itens['base'])
+        
+        # Insumos por porção de cada ficha, já com as bases explodidas
+        self.ficha_insumo = direto.somar(self.ficha_base.compor(self.base_insumo))
+    
+    def vetor_fichas(self, quantidades):
+        """Vetor alinhado às linhas da matriz a partir de {ficha_id: quantidade}"""
+        vetor = np.zeros(len(self.ficha_ids))
+        for ficha_id, quantidade in quantidades.items():
+            posicao = self.indice_ficha.get(ficha_id)
+            if posicao is not None:
+                vetor[posicao] += quantidade or 0
+        return vetor
+    
+    def consumo(self, quantidades):
+        """Consumo líquido de cada insumo (na ordem de insumo_ids) para as quantidades vendidas"""
+        return self.ficha_insumo.multiplicar(self.vetor_fichas(quantidades))
+
+_GRAFOS_RECEITAS = OrderedDict()
+_TRAVA_GRAFOS = threading.Lock()
+
+def assinatura_receitas(loja_id):
+    partes = []
+    for modelo in (Ficha, Base, Insumo):
+        partes.extend(db.session.query(func.count(modelo.id), func.coalesce(func.sum(modelo.versao), 0),
+                                       func.coalesce(func.max(modelo.id), 0))
+                      .filter(modelo.loja_id == loja_id).one())
+    return tuple(partes)
+
+def grafo_receitas(loja_id):
+    """GrafoReceitas da loja, remontado só quando as receitas mudam"""
+    assinatura = assinatura_receitas(loja_id)
+    with _TRAVA_GRAFOS:
+        guardado = _GRAFOS_RECEITAS.get(loja_id)
+        if guardado and guardado[0] == assinatura:
+            _GRAFOS_RECEITAS.move_to_end(loja_id)
+            return guardado[1]
+    grafo = GrafoReceitas(loja_id)
+    with _TRAVA_GRAFOS:
+        _GRAFOS_RECEITAS[loja_id] = (assinatura, grafo)
+        _GRAFOS_RECEITAS.move_to_end(loja_id)
+        while len(_GRAFOS_RECEITAS) > GRAFOS_EM_CACHE:
+            _GRAFOS_RECEITAS.popitem(last=False)
+    return grafo
+
+# ==============================================================================
+# CONSULTAS DE LEITURA PARA LISTAGENS
+# ==============================================================================
+# As telas de listagem só exibem algumas colunas. Em vez de carregar entidades
+# completas (e disparar lazy-loads por linha no template), buscamos apenas o que
+# é mostrado, com JOINs e agregados, em tuplas compactas.
+InsumoLinha = namedtuple('InsumoLinha', 'id nome categoria unidade custo_unitario')
+BaseLinha = namedtuple('BaseLinha', 'id nome rendimento custo_total custo_por_kg_litro')
+
+def consulta_insumos_resumo(*filtros):
+    """Colunas da tela de insumos com categoria e unidade resolvidas por JOIN"""
+    return (db.session.query(Insumo.id, Insumo.nome, Categoria.nome, Unidade.sigla, Insumo.custo_unitario)
+            .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+            .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+            .filter(*filtros)
+            .order_by(Insumo.nome))
+
+def consulta_bases_resumo(*filtros):
+    """Colunas da tela de bases; o custo vem de uma subconsulta por base_id"""
+    custo_total = (db.session.query(func.coalesce(func.sum(
+                        func.coalesce(BaseItem.quantidade, 0) * func.coalesce(Insumo.custo_unitario, 0)
+                    ), 0))
+                   .join(Insumo, BaseItem.insumo_id == Insumo.id)
+                   .filter(BaseItem.base_id == Base.id)
+                   .correlate(Base)
+                   .scalar_subquery())
+    return (db.session.query(Base.id, Base.nome, Base.rendimento_final, custo_total)
+            .filter(*filtros)
+            .order_by(Base.nome))
+
+def listar_insumos_resumo(*filtros):
+    return [InsumoLinha(*linha) for linha in consulta_insumos_resumo(*filtros)]
+
+def listar_bases_resumo(*filtros):
+    linhas = []
+    for id_, nome, rendimento, custo in consulta_bases_resumo(*filtros):
+        custo = float(custo or 0)
+        custo_kg = custo / rendimento if rendimento and rendimento > 0 else 0.0
+        linhas.append(BaseLinha(id_, nome, rendimento, custo, custo_kg))
+    return linhas
+
+# ==============================================================================
+# RECÁLCULO DE CUSTOS EM LOTE
+# ==============================================================================
+def fichas_afetadas(insumo_ids):
+    """Bases e fichas que usam os insumos, direto ou através de uma base"""
+    base_ids, ficha_ids = set(), set()
+    for lote in em_lotes(insumo_ids):
+        base_ids.update(b for (b,) in db.session.query(BaseItem.base_id)
+                        .filter(BaseItem.insumo_id.in_(lote)).distinct())
+        ficha_ids.update(f for (f,) in db.session.query(FichaItem.ficha_id)
+                         .filter(FichaItem.tipo_item == 'insumo', FichaItem.referencia_id.in_(lote)).distinct())
+    for lote in em_lotes(base_ids):
+        ficha_ids.update(f for (f,) in db.session.query(FichaItem.ficha_id)
+                         .filter(FichaItem.tipo_item == 'base', FichaItem.referencia_id.in_(lote)).distinct())
+    return base_ids, ficha_ids
+
+# ==============================================================================
+# ALERTAS DE CMV APÓS MUDANÇAS DE CUSTO
+# ==============================================================================
+# Toda gravação de custo de insumo guarda antes o CMV das fichas que usam os
+# insumos alterados, direto ou por bases (fichas_afetadas): as edições pelo
+# ORM são vistas no before_flush, e as gravações em lote (importação, NF-e,
+# reajuste) chamam guardar_cmv_anterior antes do UPDATE. No commit só essas
+# fichas são recalculadas, e as que passaram do CMV-alvo viram alertas na
+# mesma transação da mudança de preço. O trabalho cresce com a quantidade de
+# fichas afetadas, não com o tamanho do cardápio.
+LIMITE_ALERTAS_PAINEL = 20
+
+def guardar_cmv_anterior(ficha_ids):
+    """Guarda o CMV das fichas antes de uma mudança de custo; devolve {ficha_id: métricas}"""
+    guardadas = db.session.info.setdefault('cmv_anterior', {})
+    faltam = set(ficha_ids) - guardadas.keys()
+    if faltam:
+        guardadas.update(EngineCalculo.processar_fichas(faltam))
+    return {f: guardadas[f] for f in ficha_ids if f in guardadas}
+
+@event.listens_for(db.session, 'before_flush')
+def _custos_alterados_orm(sessao, contexto, instancias):
+    ids = [obj.id for obj in sessao.dirty
+           if isinstance(obj, Insumo) and obj.id and inspect(obj).attrs.custo_unitario.history.has_changes()]
+    if ids:
+        with sessao.no_autoflush:
+            guardar_cmv_anterior(fichas_afetadas(ids)[1])
+
+@event.listens_for(db.session, 'before_commit')
+def _registrar_alertas_cmv(sessao):
+    sessao.flush()  # grava as edições pendentes (e guarda o CMV anterior delas)
+    anteriores = sessao.info.pop('cmv_anterior', None)
+    if not anteriores:
+        return
+    atuais = EngineCalculo.processar_fichas(anteriores)
+    lojas = {}
+    for lote in em_lotes(atuais):
+        lojas.update(db.session.query(Ficha.id, Ficha.loja_id).filter(Ficha.id.in_(lote)))
+    alertas = [{'loja_id': lojas[f], 'ficha_id': f, 'cmv_anterior': anteriores[f]['cmv_real'],
+                'cmv_novo': m['cmv_real'], 'cmv_alvo': m['cmv_alvo'], 'criado_em': datetime.now()}
+               for f, m in atuais.items()
+               if m['cmv_alvo'] and lojas.get(f) and anteriores[f]['cmv_real'] <= m['cmv_alvo'] < m['cmv_real']]
+    if alertas:
+        sessao.execute(AlertaCmv.__table__.insert(), alertas)
+        logger.info(f"Alertas de CMV: {len(alertas)} de {len(atuais)} ficha(s) recalculada(s)")
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_cmv_anterior(sessao):
+    sessao.info.pop('cmv_anterior', None)
+
+def alertas_cmv_pendentes(usuario, limite=LIMITE_ALERTAS_PAINEL):
+    """Alertas ainda não dispensados das fichas visíveis ao usuário, do mais recente ao mais antigo"""
+    consulta = (db.session.query(AlertaCmv, Ficha.nome)
+                .join(Ficha, AlertaCmv.ficha_id == Ficha.id)
+                .filter(AlertaCmv.loja_id == usuario.loja_id, AlertaCmv.visto_em.is_(None),
+                        *filtros_loja(Ficha, usuario)))
+    return consulta.order_by(AlertaCmv.criado_em.desc()).limit(limite).all(), consulta.count()
+
+@app.route('/alertas-cmv/dispensar', methods=['POST'])
+@login_required
+def dispensar_alertas_cmv():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    ids = request.form.getlist('alerta', type=int)
+    visiveis = select(Ficha.id).where(*filtros_loja(Ficha, usuario))
+    filtros = [AlertaCmv.loja_id == usuario.loja_id, AlertaCmv.visto_em.is_(None), AlertaCmv.ficha_id.in_(visiveis)]
+    if ids:
+        filtros.append(AlertaCmv.id.in_(ids))
+    db.session.execute(update(AlertaCmv).where(*filtros).values(visto_em=datetime.now())
+                       .execution_options(synchronize_session=False))
+    db.session.commit()
+    return redirect(url_for('index'))
+
+# ==============================================================================
+# VERSÃO DOS DADOS DA LOJA (ETAG E GET CONDICIONAL)
+# ==============================================================================
+# Cada loja tem um contador em versoes_lojas, somado no commit de qualquer
+# transação que gravou dados dela: objetos do ORM pelo loja_id (before_flush)
+# e comandos em lote pela loja do usuário da requisição (do_orm_execute).
+# Gravações sem loja conhecida (linha antiga sem loja_id, linha de comando,
+# super admin em lote) somam a versão 0, que entra na ETag de todas as lojas.
+# Logs de acesso, máquinas e caches de previsão ficam de fora: são gravados
+# a cada requisição ou não aparecem nas telas com ETag.
+# As telas marcadas com @condicional_por_loja respondem 304 com uma consulta
+# só (as duas versões), antes de qualquer custeio ou renderização.
+TABELAS_FORA_DA_VERSAO = {'versoes_lojas', 'logs_acesso', 'maquinas', 'previsoes_lotes', 'previsoes_fichas'}
+LOJA_GLOBAL = 0
+
+def _marcar_loja_alterada(sessao, loja_id):
+    sessao.info.setdefault('lojas_alteradas', set()).add(loja_id or LOJA_GLOBAL)
+
+@event.listens_for(db.session, 'before_flush')
+def _lojas_alteradas_orm(sessao, contexto, instancias):
+    for obj in itertools.chain(sessao.new, sessao.dirty, sessao.deleted):
+        if obj.__table__.name in TABELAS_FORA_DA_VERSAO or (obj in sessao.dirty and not sessao.is_modified(obj)):
+            continue
+        _marcar_loja_alterada(sessao, obj.id if isinstance(obj, Loja) else getattr(obj, 'loja_id', None))
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _lojas_alteradas_lote(estado):
+    if not (estado.is_insert or estado.is_update or estado.is_delete):
+        return
+    tabela = getattr(estado.statement, 'table', None)
+    if tabela is None or tabela.name in TABELAS_FORA_DA_VERSAO:
+        return
+    loja_id = None
+    if has_request_context() and session.get('usuario_nome') != 'bpereira':
+        loja_id = session.get('loja_id')
+    _marcar_loja_alterada(estado.session, loja_id)
+
+@event.listens_for(db.session, 'before_commit')
+def _somar_versoes_lojas(sessao):
+    sessao.flush()
+    lojas = sessao.info.pop('lojas_alteradas', None)
+    if lojas:
+        upsert_somando(VersaoLoja.__table__, [{'loja_id': l, 'versao': 1} for l in sorted(lojas)],
+                       ['loja_id'], ['versao'])
+
+@event.listens_for(db.session, 'after_rollback')
+def _descartar_lojas_alteradas(sessao):
+    sessao.info.pop('lojas_alteradas', None)
+
+def etag_dados(loja_id):
+    """ETag da tela para o usuário: versões da loja e global, identidade, dia e URL"""
+    versoes = (db.session.query(VersaoLoja.loja_id, VersaoLoja.versao)
+               .filter(or_(VersaoLoja.loja_id == LOJA_GLOBAL, VersaoLoja.loja_id == loja_id))
+               .order_by(VersaoLoja.loja_id).all())
+    chave = '|'.join(map(str, (versoes, session.get('usuario_id'), session.get('role'), session.get('loja_id'),
+                               date.today(), request.full_path)))
+    return hashlib.sha1(chave.encode()).hexdigest()
+
+def condicional_por_loja(loja=None):
+    """GET com ETag pela versão dos dados; `loja(**kwargs)` dá a loja da tela (padrão: a do usuário).
+
+    Pode devolver um id ou uma subconsulta escalar, que vai junto na mesma consulta.
+    """
+    def decorador(f):
+        @wraps(f)
+        def envolvida(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return f(*args, **kwargs)
+            etag = etag_dados(loja(**kwargs) if loja else session.get('loja_id'))
+            if request.if_none_match.contains_weak(etag):
+                resposta = app.response_class(status=304)
+            else:
+                resposta = make_response(f(*args, **kwargs))
+                if resposta.status_code != 200:
+                    return resposta
+            resposta.set_etag(etag)
+            return resposta
+        return envolvida
+    return decorador
+
+@app.after_request
+def cache_privado(resposta):
+    """Páginas de usuário logado nunca vão para caches compartilhados e são revalidadas"""
+    if request.endpoint != 'static' and 'usuario_id' in session:
+        resposta.cache_control.private = True
+        if resposta.cache_control.max_age is None:
+            resposta.cache_control.no_cache = True
+    return resposta
+
+# ==============================================================================
+# COMPRESSÃO DAS RESPOSTAS (GZIP, BROTLI E ZSTD)
+# ==============================================================================
+# As páginas são tabelas grandes e repetitivas: comprimidas, caem a uma
+# fração do tamanho, o que pesa em conexões móveis ruins. O codec sai do
+# Accept-Encoding (zstd e brotli só se os pacotes estiverem instalados;
+# gzip sempre). Respostas comuns acima de COMPRESSAO_MINIMA são comprimidas
+# inteiras; respostas em streaming (CSV) são comprimidas pedaço a pedaço, sem
+# juntar tudo na memória. A ETag vira fraca (W/): o conteúdo é o mesmo em
+# qualquer codificação. Os arquivos de static/ são comprimidos no build por
+# comprimir_estaticos.py e servidos já prontos, com Content-Encoding e Vary.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSAO_MINIMA = int(os.getenv('COMPRESSAO_MINIMA', 1024))
+NIVEL_GZIP = 6
+TIPOS_COMPRIMIVEIS = {'text/html', 'text/csv', 'text/plain', 'text/css', 'text/javascript',
+                      'application/javascript', 'application/json', 'image/svg+xml', 'application/xml'}
+# Codificação -> extensão dos arquivos pré-comprimidos de static/ (ordem = preferência)
+EXTENSOES_CODIFICACAO = {'zstd': '.zst', 'br': '.br', 'gzip': '.gz'}
+
+def codificacoes_disponiveis():
+    return [c for c in EXTENSOES_CODIFICACAO
+            if c == 'gzip' or (c == 'br' and brotli) or (c == 'zstd' and zstandard)]
+
+def compressor(codificacao):
+    """(comprimir(bytes), finalizar()) de um compressor incremental"""
+    if codificacao == 'br':
+        c = brotli.Compressor(quality=5)
+        return c.process, c.finish
+    if codificacao == 'zstd':
+        c = zstandard.ZstdCompressor(level=3).compressobj()
+        return c.compress, c.flush
+    c = zlib.compressobj(NIVEL_GZIP, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    return c.compress, c.flush
+
+def comprimir_fluxo(partes, codificacao):
+    comprimir, finalizar = compressor(codificacao)
+    try:
+        for parte in partes:
+            saida = comprimir(parte.encode() if isinstance(parte, str) else parte)
+            if saida:
+                yield saida
+        yield finalizar()
+    finally:
+        if hasattr(partes, 'close'):
+            partes.close()
+
+def etag_fraca(resposta):
+    etag, fraca = resposta.get_etag()
+    if etag and not fraca:
+        resposta.set_etag(etag, weak=True)
+
+@app.after_request
+def comprimir_resposta(resposta):
+    if request.endpoint == 'static' or 'Content-Encoding' in resposta.headers:
+        return resposta
+    codificacao = request.accept_encodings.best_match(codificacoes_disponiveis())
+    if resposta.status_code == 304:
+        # A revalidação repete o Vary da resposta 200 que está no cache
+        resposta.vary.add('Accept-Encoding')
+        if codificacao:
+            etag_fraca(resposta)
+        return resposta
+    if resposta.mimetype not in TIPOS_COMPRIMIVEIS or resposta.direct_passthrough or resposta.status_code < 200:
+        return resposta
+    
+    resposta.vary.add('Accept-Encoding')
+    if not codificacao:
+        return resposta
+    if resposta.is_streamed:
+        resposta.response = comprimir_fluxo(resposta.response, codificacao)
+        resposta.headers.pop('Content-Length', None)
+    else:
+        dados = resposta.get_data()
+        if len(dados) < COMPRESSAO_MINIMA:
+            return resposta
+        comprimir, finalizar = compressor(codificacao)
+        resposta.set_data(comprimir(dados) + finalizar())
+    resposta.headers['Content-Encoding'] = codificacao
+    etag_fraca(resposta)
+    return resposta
+
+def estatico_pre_comprimido(filename):
+    """static/: entrega a versão pré-comprimida mais preferida que o navegador aceita"""
+    caminho = safe_join(app.static_folder, filename)
+    prontas = [c for c in codificacoes_disponiveis() if caminho and os.path.isfile(caminho + EXTENSOES_CODIFICACAO[c])
+               and os.path.getmtime(caminho + EXTENSOES_CODIFICACAO[c]) >= os.path.getmtime(caminho)]
+    codificacao = request.accept_encodings.best_match(prontas) if prontas else None
+    if not codificacao:
+        resposta = app.send_static_file(filename)
+    else:
+        resposta = send_from_directory(app.static_folder, filename + EXTENSOES_CODIFICACAO[codificacao],
+                                       mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                       max_age=app.get_send_file_max_age(filename))
+        resposta.headers['Content-Encoding'] = codificacao
+    if prontas:
+        resposta.vary.add('Accept-Encoding')
+    return resposta
+
+app.view_functions['static'] = estatico_pre_comprimido
+
 # ==============================================================================
 # ROTAS PRINCIPAIS
 # ==============================================================================
@@ -783,51 +1643,29 @@ def validar_chave():
 
 @app.route('/')
 @login_required
+@condicional_por_loja()
 def index():
     try:
         usuario = db.session.get(Usuario, session['usuario_id'])
         
-        if usuario.username == 'bpereira':
-            fichas = Ficha.query.order_by(Ficha.nome).all()
-            total_fichas = Ficha.query.count()
-            total_insumos = Insumo.query.count()
-            total_bases = Base.query.count()
-            
-            fichas_com_cmv_alto = 0
-            fichas_lucrativas = 0
-            custo_total_sistema = 0
-            
-            for ficha in Ficha.query.all():
-                metricas = EngineCalculo.processar_ficha(ficha.id)
-                if metricas:
-                    custo_total_sistema += metricas['custo_total']
-                    if metricas['cmv_real'] > ficha.cmv_alvo:
-                        fichas_com_cmv_alto += 1
-                    if metricas['lucro_bruto'] > 0:
-                        fichas_lucrativas += 1
-            
-        else:
-            fichas = Ficha.query.filter_by(user_id=usuario.id).order_by(Ficha.nome).all()
-            total_fichas = Ficha.query.filter_by(user_id=usuario.id).count()
-            total_insumos = Insumo.query.filter_by(user_id=usuario.id).count()
-            total_bases = Base.query.filter_by(user_id=usuario.id).count()
-            
-            fichas_com_cmv_alto = 0
-            fichas_lucrativas = 0
-            custo_total_sistema = 0
-            
-            for ficha in fichas:
-                metricas = EngineCalculo.processar_ficha(ficha.id)
-                if metricas:
-                    custo_total_sistema += metricas['custo_total']
-                    if metricas['cmv_real'] > ficha.cmv_alvo:
-                        fichas_com_cmv_alto += 1
-                    if metricas['lucro_bruto'] > 0:
-                        fichas_lucrativas += 1
+        fichas = escopo_loja(Ficha, usuario).order_by(Ficha.nome).all()
+        total_fichas = len(fichas)
+        total_insumos = escopo_loja(Insumo, usuario).count()
+        total_bases = escopo_loja(Base, usuario).count()
+        
+        fichas_com_cmv_alto = 0
+        fichas_lucrativas = 0
+        custo_total_sistema = 0
         
         lista_final = []
         for f in fichas:
             res = EngineCalculo.processar_ficha(f.id)
+            if res:
+                custo_total_sistema += res['custo_total']
+                if res['cmv_real'] > f.cmv_alvo:
+                    fichas_com_cmv_alto += 1
+                if res['lucro_bruto'] > 0:
+                    fichas_lucrativas += 1
             lista_final.append({'ficha': f, 'metricas': res})
         
         info_licenca = {}
@@ -852,10 +1690,14 @@ def index():
             'percentual_lucrativas': (fichas_lucrativas / total_fichas * 100) if total_fichas > 0 else 0
         }
         
+        alertas_cmv, total_alertas_cmv = alertas_cmv_pendentes(usuario)
+        
         return render_template('index.html', 
                              dados=lista_final, 
                              info_licenca=info_licenca,
-                             stats=stats)
+                             stats=stats,
+                             alertas_cmv=alertas_cmv,
+                             total_alertas_cmv=total_alertas_cmv)
     except Exception as e:
         logger.error(f"Erro no Index: {e}")
         return f"Erro CrÃ­tico: {e}", 500
@@ -1204,7 +2046,7 @@ def config_basico():
         
         if tipo_acao == 'add_cat':
             nome = request.form.get('nome_cat', '').upper().strip()
-            if nome and not Categoria.query.filter_by(nome=nome, user_id=usuario_id).first():
+            if nome and not escopo_loja(Categoria, usuario).filter_by(nome=nome).first():
                 nova_cat = Categoria(
                     nome=nome, 
                     user_id=usuario_id,
@@ -1216,16 +2058,16 @@ def config_basico():
                 
         elif tipo_acao == 'add_uni':
             sigla = request.form.get('sigla_uni', '').upper().strip()
-            if sigla and not Unidade.query.filter_by(sigla=sigla, user_id=usuario_id).first():
-                nova_uni = Unidade(sigla=sigla, user_id=usuario_id)
+            if sigla and not escopo_loja(Unidade, usuario).filter_by(sigla=sigla).first():
+                nova_uni = Unidade(sigla=sigla, user_id=usuario_id, loja_id=usuario.loja_id)
                 db.session.add(nova_uni)
                 db.session.commit()
                 flash("Unidade criada com sucesso!", "success")
         
         return redirect(url_for('config_basico'))
     
-    categorias = Categoria.query.filter_by(user_id=usuario_id).order_by(Categoria.nome).all()
-    unidades = Unidade.query.filter_by(user_id=usuario_id).order_by(Unidade.sigla).all()
+    categorias = escopo_loja(Categoria, usuario).order_by(Categoria.nome).all()
+    unidades = escopo_loja(Unidade, usuario).order_by(Unidade.sigla).all()
     
     return render_template('config_basico.html', 
                          categorias=categorias, 
@@ -1297,37 +2139,144 @@ def admin_logs_completo():
 @login_required
 @admin_required
 def exportar_maquinas():
-    import csv
-    import io
-    
     usuario = db.session.get(Usuario, session['usuario_id'])
     
-    if usuario.username == 'bpereira':
-        maquinas = Maquina.query.all()
-    else:
-        maquinas = Maquina.query.filter_by(loja_id=usuario.loja_id).all()
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
+    consulta = (db.session.query(Maquina.id, Loja.nome, Maquina.fingerprint, Maquina.ativa,
+                                 Maquina.criada_em, Maquina.expira_em)
+                .outerjoin(Loja, Maquina.loja_id == Loja.id)
+                .order_by(Maquina.id))
+    if usuario.username != 'bpereira':
+        consulta = consulta.filter(Maquina.loja_id == usuario.loja_id)
     
-    writer.writerow(['ID', 'Loja', 'Fingerprint', 'Status', 'Criada em', 'Expira em'])
+    linhas = (
+        [
+            id_,
+            loja_nome or '',
+            fingerprint,
+            'ATIVA' if ativa else 'INATIVA',
+            data_br(criada_em, '%d/%m/%Y %H:%M:%S'),
+            data_br(expira_em)
+        ]
+        for id_, loja_nome, fingerprint, ativa, criada_em, expira_em in consulta.yield_per(LOTE_EXPORTACAO)
+    )
     
-    for m in maquinas:
-        writer.writerow([
-            m.id,
-            m.loja.nome if m.loja else '',
-            m.fingerprint,
-            'ATIVA' if m.ativa else 'INATIVA',
-            m.criada_em.strftime('%d/%m/%Y %H:%M:%S'),
-            m.expira_em.strftime('%d/%m/%Y') if m.expira_em else ''
-        ])
+    return resposta_csv('maquinas.csv',
+                        ['ID', 'Loja', 'Fingerprint', 'Status', 'Criada em', 'Expira em'],
+                        linhas)
+
+# ==============================================================================
+# RELATÓRIO CONSOLIDADO DAS LOJAS (SUPER ADMIN)
+# ==============================================================================
+# Cada loja é resumida numa thread do pool, com o seu próprio contexto de
+# aplicação (e portanto a sua própria sessão do banco), e os resumos são
+# juntados no fim. O resultado fica numa foto em memória que o painel exibe
+# até o super admin pedir a atualização, então abrir a tela não refaz o
+# cálculo de todas as lojas.
+THREADS_RELATORIO = int(os.environ.get('RELATORIO_THREADS', 8))
+
+ResumoLoja = namedtuple('ResumoLoja', 'nome ativa licenca fichas insumos bases cmv_medio fichas_acima_meta '
+                                      'custo_total maquinas maquinas_ativas usuarios ultimo_acesso loja_id')
+CABECALHO_RESUMO_LOJAS = ['Loja', 'Ativa', 'Licença', 'Fichas', 'Insumos', 'Bases', 'CMV Médio %',
+                          'Fichas Acima da Meta', 'Custo Total', 'Máquinas', 'Máquinas Ativas', 'Usuários',
+                          'Último Acesso']
+CASAS_RESUMO_LOJAS = [None, None, None, 0, 0, 0, 2, 0, 2, 0, 0, 0, None]
+
+_pool_relatorio = None
+_trava_relatorio = threading.Lock()
+_foto_lojas = None
+
+def pool_relatorio():
+    """Pool de threads dos resumos por loja, criado sob demanda"""
+    global _pool_relatorio
+    with _trava_relatorio:
+        if _pool_relatorio is None:
+            _pool_relatorio = ThreadPoolExecutor(max_workers=max(THREADS_RELATORIO, 1),
+                                                 thread_name_prefix='relatorio')
+        return _pool_relatorio
+
+def resumir_loja(loja_id):
+    """Totais de uma loja; roda numa thread do pool, com contexto e sessão próprios"""
+    with app.app_context():
+        loja = db.session.get(Loja, loja_id)
+        contagens = {}
+        for modelo in (Ficha, Insumo, Base, Usuario):
+            contagens[modelo] = (db.session.query(func.count(modelo.id))
+                                 .filter(modelo.loja_id == loja_id).scalar())
+        
+        ficha_ids = [f for (f,) in db.session.query(Ficha.id).filter(Ficha.loja_id == loja_id)]
+        metricas = list(EngineCalculo.processar_fichas(ficha_ids).values())
+        cmvs = [m['cmv_real'] for m in metricas if m['preco_venda'] > 0]
+        acima_meta = sum(1 for m in metricas if m['cmv_alvo'] > 0 and m['cmv_real'] > m['cmv_alvo'])
+        
+        maquinas = db.session.query(Maquina.ativa).filter(Maquina.loja_id == loja_id).all()
+        ultimo_acesso = (db.session.query(func.max(LogAcesso.data))
+                         .filter(LogAcesso.loja_id == loja_id).scalar())
+        
+        return ResumoLoja(loja.nome, 'Sim' if loja.ativo else 'Não',
+                          'Ativa' if loja.licenca_ativa else 'Inativa',
+                          contagens[Ficha], contagens[Insumo], contagens[Base],
+                          sum(cmvs) / len(cmvs) if cmvs else 0.0, acima_meta,
+                          sum(m['custo_total'] for m in metricas),
+                          len(maquinas), sum(1 for (ativa,) in maquinas if ativa), contagens[Usuario],
+                          ultimo_acesso.strftime('%d/%m/%Y %H:%M') if ultimo_acesso else '', loja_id)
+
+def resumo_lojas(atualizar=False):
+    """Foto do resumo de todas as lojas; refeita só quando `atualizar` ou quando ainda não existe"""
+    global _foto_lojas
+    with _trava_relatorio:
+        foto = _foto_lojas
+    if foto and not atualizar:
+        return foto
     
-    output.seek(0)
+    inicio = time.perf_counter()
+    loja_ids = [l for (l,) in db.session.query(Loja.id)]
+    futuros = {pool_relatorio().submit(resumir_loja, loja_id): loja_id for loja_id in loja_ids}
+    lojas, falhas = [], []
+    for futuro in as_completed(futuros):
+        try:
+            lojas.append(futuro.result())
+        except Exception as e:
+            logger.error(f"Resumo da loja {futuros[futuro]}: {e}")
+            falhas.append(futuros[futuro])
+    lojas.sort(key=lambda r: r.nome.upper())
     
-    return output.getvalue(), 200, {
-        'Content-Type': 'text/csv',
-        'Content-Disposition': 'attachment; filename=maquinas.csv'
+    total_fichas = sum(r.fichas for r in lojas)
+    foto = {
+        'lojas': lojas,
+        'falhas': sorted(falhas),
+        'totais': {
+            'fichas': total_fichas,
+            'insumos': sum(r.insumos for r in lojas),
+            'bases': sum(r.bases for r in lojas),
+            'cmv_medio': sum(r.cmv_medio * r.fichas for r in lojas) / total_fichas if total_fichas else 0.0,
+            'fichas_acima_meta': sum(r.fichas_acima_meta for r in lojas),
+            'custo_total': sum(r.custo_total for r in lojas),
+            'maquinas': sum(r.maquinas for r in lojas),
+            'maquinas_ativas': sum(r.maquinas_ativas for r in lojas),
+            'usuarios': sum(r.usuarios for r in lojas),
+        },
+        'gerado_em': datetime.now(),
+        'segundos': time.perf_counter() - inicio,
     }
+    with _trava_relatorio:
+        _foto_lojas = foto
+    logger.info(f"Resumo consolidado: {len(lojas)} loja(s) em {foto['segundos']:.2f}s")
+    return foto
+
+@app.route('/admin/lojas/consolidado', methods=['GET', 'POST'])
+@login_required
+@super_admin_required
+def admin_consolidado():
+    if request.method == 'POST':
+        resumo_lojas(atualizar=True)
+        flash("Relatório consolidado atualizado.", "success")
+        return redirect(url_for('admin_consolidado'))
+    
+    foto = resumo_lojas()
+    if request.args.get('formato') == 'csv':
+        return resposta_csv('lojas_consolidado.csv', CABECALHO_RESUMO_LOJAS,
+                            formatar_br(foto['lojas'], CASAS_RESUMO_LOJAS))
+    return render_template('admin_consolidado.html', foto=foto)
 
 # ==============================================================================
 # ROTAS DE MÃQUINAS (ÃšNICAS - CORRIGIDAS)
@@ -1435,7 +2384,7 @@ def config():
         
         if tipo_acao == 'add_cat':
             nome = request.form.get('nome_cat', '').upper().strip()
-            if nome and not Categoria.query.filter_by(nome=nome, user_id=usuario_id).first():
+            if nome and not escopo_loja(Categoria, usuario).filter_by(nome=nome).first():
                 nova_cat = Categoria(
                     nome=nome, 
                     user_id=usuario_id,
@@ -1447,16 +2396,16 @@ def config():
                 
         elif tipo_acao == 'add_uni':
             sigla = request.form.get('sigla_uni', '').upper().strip()
-            if sigla and not Unidade.query.filter_by(sigla=sigla, user_id=usuario_id).first():
-                nova_uni = Unidade(sigla=sigla, user_id=usuario_id)
+            if sigla and not escopo_loja(Unidade, usuario).filter_by(sigla=sigla).first():
+                nova_uni = Unidade(sigla=sigla, user_id=usuario_id, loja_id=usuario.loja_id)
                 db.session.add(nova_uni)
                 db.session.commit()
                 flash("Unidade criada com sucesso!", "success")
         
         return redirect(url_for('config'))
     
-    categorias = Categoria.query.filter_by(user_id=usuario_id).order_by(Categoria.nome).all()
-    unidades = Unidade.query.filter_by(user_id=usuario_id).order_by(Unidade.sigla).all()
+    categorias = escopo_loja(Categoria, usuario).order_by(Categoria.nome).all()
+    unidades = escopo_loja(Unidade, usuario).order_by(Unidade.sigla).all()
     
     return render_template('config.html', 
                          categorias=categorias, 
@@ -1467,6 +2416,7 @@ def config():
 # ==============================================================================
 @app.route('/insumos', methods=['GET', 'POST'])
 @login_required
+@condicional_por_loja()
 def insumos():
     uid = session['usuario_id']
     usuario = db.session.get(Usuario, uid)
@@ -1487,7 +2437,7 @@ def insumos():
                 tamanho_embalagem=t_emb,
                 fator_correcao=fc,
                 custo_unitario=(p_emb / t_emb) * fc,
-                loja_id=session.get('loja_id')
+                loja_id=usuario.loja_id
             )
             db.session.add(novo_insumo)
             db.session.commit()
@@ -1496,13 +2446,10 @@ def insumos():
             db.session.rollback()
             flash(f"Erro ao cadastrar: {e}", "danger")
     
-    if usuario.username == 'bpereira' or usuario.role == 'admin':
-        insumos_lista = Insumo.query.filter_by(loja_id=usuario.loja_id).all()
-    else:
-        insumos_lista = Insumo.query.filter_by(user_id=uid).all()
+    insumos_lista = listar_insumos_resumo(*filtros_loja(Insumo, usuario))
     
-    cats = Categoria.query.filter_by(user_id=uid).all()
-    unis = Unidade.query.filter_by(user_id=uid).all()
+    cats = escopo_loja(Categoria, usuario).order_by(Categoria.nome).all()
+    unis = escopo_loja(Unidade, usuario).order_by(Unidade.sigla).all()
         
     return render_template('insumos.html', lista=insumos_lista, categorias=cats, unidades=unis)
 
@@ -1517,11 +2464,14 @@ def editar_insumo(id):
         flash("Insumo nÃ£o encontrado.", "danger")
         return redirect(url_for('insumos'))
     
-    if usuario.username != 'bpereira' and ins.user_id != uid:
+    if not acesso_loja(ins, usuario):
         flash("Acesso negado.", "danger")
         return redirect(url_for('insumos'))
 
     if request.method == 'POST':
+        nome_atual = ins.nome
+        if not versao_confere(ins):
+            return conflito_edicao('insumo', nome_atual, url_for('editar_insumo', id=id))
         try:
             ins.nome = request.form.get('nome').upper().strip()
             ins.preco_embalagem = float(request.form.get('preco').replace(',', '.'))
@@ -1533,43 +2483,2423 @@ def editar_insumo(id):
             db.session.commit()
             flash("Insumo atualizado!", "success")
             return redirect(url_for('insumos'))
+        except StaleDataError:
+            return conflito_edicao('insumo', nome_atual, url_for('editar_insumo', id=id))
         except Exception as e:
             db.session.rollback()
             flash(f"Erro na ediÃ§Ã£o: {e}", "danger")
     
     return render_template('insumos_form.html', i=ins, 
-                           categorias=Categoria.query.filter_by(user_id=uid).all(), 
-                           unidades=Unidade.query.filter_by(user_id=uid).all())
+                           categorias=escopo_loja(Categoria, usuario).order_by(Categoria.nome).all(), 
+                           unidades=escopo_loja(Unidade, usuario).order_by(Unidade.sigla).all())
 
 # ==============================================================================
-# ROTAS DE BASES
+# IMPORTAÇÃO DE INSUMOS EM LOTE (CSV DE FORNECEDORES)
 # ==============================================================================
-@app.route('/bases', methods=['GET', 'POST'])
-@login_required
-def bases():
-    if request.method == 'POST':
-        return nova_base()
+LOTE_IMPORTACAO = 500
+PASTA_RELATORIOS = os.path.join(base_path, 'relatorios')
+
+# Cabeçalhos aceitos na planilha (já normalizados) -> campo interno
+COLUNAS_IMPORTACAO = {
+    'NOME': 'nome', 'INSUMO': 'nome', 'PRODUTO': 'nome', 'DESCRICAO': 'nome',
+    'CATEGORIA': 'categoria',
+    'UNIDADE': 'unidade', 'UNID': 'unidade', 'UN': 'unidade',
+    'PRECO': 'preco', 'PRECO EMB.': 'preco', 'PRECO EMBALAGEM': 'preco', 'PRECO_EMBALAGEM': 'preco',
+    'TAMANHO': 'tamanho', 'QTD EMB.': 'tamanho', 'TAMANHO EMBALAGEM': 'tamanho', 'TAMANHO_EMBALAGEM': 'tamanho',
+    'FC': 'fc', 'FATOR CORRECAO': 'fc', 'FATOR_CORRECAO': 'fc',
+}
+
+def abrir_csv(fluxo):
+    """csv.reader em streaming sobre um arquivo binário.
+
+    A codificação (UTF-8 ou Windows-1252, comum em planilhas do Excel) e o
+    separador (';' ou ',') são detectados só pelo início do arquivo.
+    """
+    amostra = fluxo.read(64 * 1024)
+    fluxo.seek(0)
+    try:
+        amostra.decode('utf-8')
+        codificacao = 'utf-8-sig'
+    except UnicodeDecodeError as erro:
+        # Um caractere cortado no fim da amostra não descaracteriza o UTF-8
+        codificacao = 'utf-8-sig' if erro.start >= len(amostra) - 3 else 'cp1252'
     
-    uid = session['usuario_id']
-    usuario = db.session.get(Usuario, uid)
+    linhas = amostra.decode(codificacao, errors='ignore').splitlines()
+    primeira = linhas[0] if linhas else ''
+    separador = ';' if primeira.count(';') >= primeira.count(',') else ','
     
-    if usuario.username == 'bpereira' or usuario.role == 'admin':
-        lista = Base.query.filter_by(loja_id=usuario.loja_id).all()
-    else:
-        lista = Base.query.filter_by(user_id=uid).all()
+    texto = io.TextIOWrapper(fluxo, encoding=codificacao, newline='')
+    return csv.reader(texto, delimiter=separador)
+
+def _gravar_lote_insumos(atualizar, inserir):
+    tabela = Insumo.__table__
+    if atualizar:
+        guardar_cmv_anterior(fichas_afetadas(atualizar)[1])
+        db.session.execute(
+            tabela.update()
+            .where(tabela.c.id == bindparam('b_id'))
+            .values(preco_embalagem=bindparam('b_preco'),
+                    tamanho_embalagem=bindparam('b_tamanho'),
+                    fator_correcao=bindparam('b_fc'),
+                    custo_unitario=bindparam('b_custo'),
+                    categoria_id=bindparam('b_categoria'),
+                    unidade_id=bindparam('b_unidade'),
+                    versao=tabela.c.versao + 1),
+            list(atualizar.values())
+        )
+    if inserir:
+        db.session.execute(tabela.insert(), list(inserir.values()))
+
+def importar_insumos(leitor, usuario, relatorio):
+    """Cria ou atualiza insumos a partir das linhas de um CSV.
+
+    Os insumos são casados pelo nome normalizado e gravados em lotes
+    (executemany) dentro de uma única transação. Cada linha lida gera uma
+    linha em `relatorio`. Ao final, só as fichas que usam insumos com custo
+    alterado são recalculadas.
+    """
+    escritor = csv.writer(relatorio, delimiter=';')
+    escritor.writerow(['linha', 'nome', 'resultado', 'mensagem', 'custo_unitario'])
     
-    return render_template('bases.html', lista=lista)
+    cabecalho = next(leitor, None)
+    if not cabecalho:
+        raise ValueError("arquivo vazio")
+    campos = [COLUNAS_IMPORTACAO.get(normalizar_nome(coluna)) for coluna in cabecalho]
+    if 'nome' not in campos or 'preco' not in campos:
+        raise ValueError("o cabeçalho precisa ter ao menos as colunas 'nome' e 'preco'")
+    
+    existentes = {}
+    for id_, nome, preco, tamanho, fc, custo, cat_id, uni_id in (
+            db.session.query(Insumo.id, Insumo.nome, Insumo.preco_embalagem, Insumo.tamanho_embalagem,
+                             Insumo.fator_correcao, Insumo.custo_unitario, Insumo.categoria_id, Insumo.unidade_id)
+            .filter(*filtros_loja(Insumo, usuario))):
+        existentes[normalizar_nome(nome)] = {'b_id': id_, 'b_preco': preco, 'b_tamanho': tamanho, 'b_fc': fc,
+                                             'b_custo': custo, 'b_categoria': cat_id, 'b_unidade': uni_id}
+    categorias = {normalizar_nome(c.nome): c.id for c in escopo_loja(Categoria, usuario)}
+    unidades = {normalizar_nome(u.sigla): u.id for u in escopo_loja(Unidade, usuario)}
+    
+    def resolver(mapa, modelo, campo, texto):
+        chave = normalizar_nome(texto)
+        if chave not in mapa:
+            novo = modelo(**{campo: ' '.join(texto.upper().split())}, user_id=usuario.id, loja_id=usuario.loja_id)
+            db.session.add(novo)
+            db.session.flush()
+            mapa[chave] = novo.id
+        return mapa[chave]
+    
+    resumo = {'linhas': 0, 'criados': 0, 'atualizados': 0, 'inalterados': 0, 'erros': 0}
+    atualizar, inserir, alterados = {}, {}, set()
+    
+    def gravar():
+        _gravar_lote_insumos(atualizar, inserir)
+        # Insumos recém-criados passam a ser "existentes" para linhas repetidas adiante
+        for lote in em_lotes([r['nome'] for r in inserir.values()]):
+            for id_, nome in db.session.query(Insumo.id, Insumo.nome).filter(
+                    *filtros_loja(Insumo, usuario), Insumo.nome.in_(lote)):
+                registro = inserir.get(normalizar_nome(nome))
+                if registro:
+                    existentes[normalizar_nome(nome)] = {
+                        'b_id': id_, 'b_preco': registro['preco_embalagem'],
+                        'b_tamanho': registro['tamanho_embalagem'], 'b_fc': registro['fator_correcao'],
+                        'b_custo': registro['custo_unitario'], 'b_categoria': registro['categoria_id'],
+                        'b_unidade': registro['unidade_id']}
+        atualizar.clear()
+        inserir.clear()
+    
+    for numero, valores in enumerate(leitor, start=2):
+        if not any(v.strip() for v in valores):
+            continue
+        resumo['linhas'] += 1
+        dados = {campo: valor.strip() for campo, valor in zip(campos, valores) if campo}
+        nome = ' '.join(dados.get('nome', '').upper().split())
+        chave = normalizar_nome(nome)
+        atual = existentes.get(chave)
+        
+        try:
+            if not chave:
+                raise ValueError("nome vazio")
+            preco = converter_decimal(dados.get('preco'))
+            tamanho = converter_decimal(dados.get('tamanho'))
+            fc = converter_decimal(dados.get('fc'))
+            if preco is None or preco < 0:
+                raise ValueError("preço ausente ou negativo")
+            if tamanho is None:
+                tamanho = atual['b_tamanho'] if atual else 1.0
+            if fc is None:
+                fc = (atual['b_fc'] if atual else None) or 1.0
+            if not tamanho or tamanho <= 0:
+                raise ValueError("tamanho da embalagem deve ser maior que zero")
+            
+            cat_id = atual['b_categoria'] if atual else None
+            uni_id = atual['b_unidade'] if atual else None
+            if dados.get('categoria'):
+                cat_id = resolver(categorias, Categoria, 'nome', dados['categoria'])
+            if dados.get('unidade'):
+                uni_id = resolver(unidades, Unidade, 'sigla', dados['unidade'])
+        except ValueError as e:
+            resumo['erros'] += 1
+            escritor.writerow([numero, nome, 'ERRO', str(e), ''])
+            continue
+        
+        custo = (preco / tamanho) * fc
+        
+        if atual is None:
+            acao = 'ATUALIZADO' if chave in inserir else 'CRIADO'
+            inserir[chave] = {'nome': nome, 'user_id': usuario.id, 'loja_id': usuario.loja_id,
+                              'categoria_id': cat_id, 'unidade_id': uni_id, 'preco_embalagem': preco,
+                              'tamanho_embalagem': tamanho, 'fator_correcao': fc,
+                              'custo_unitario': custo, 'versao': 1}
+        else:
+            novo = {'b_id': atual['b_id'], 'b_preco': preco, 'b_tamanho': tamanho, 'b_fc': fc,
+                    'b_custo': custo, 'b_categoria': cat_id, 'b_unidade': uni_id}
+            if novo == atual:
+                acao = 'SEM ALTERACAO'
+            else:
+                acao = 'ATUALIZADO'
+                if abs((atual['b_custo'] or 0) - custo) > 1e-9:
+                    alterados.add(atual['b_id'])
+                atualizar[atual['b_id']] = novo
+                existentes[chave] = novo
+        
+        chave_resumo = {'CRIADO': 'criados', 'ATUALIZADO': 'atualizados', 'SEM ALTERACAO': 'inalterados'}[acao]
+        resumo[chave_resumo] += 1
+        escritor.writerow([numero, nome, acao, '', numero_br(custo, 4)])
+        
+        if len(atualizar) + len(inserir) >= LOTE_IMPORTACAO:
+            gravar()
+    
+    gravar()
+    db.session.commit()
+    
+    base_ids, ficha_ids = fichas_afetadas(alterados)
+    recalculadas = EngineCalculo.processar_fichas(ficha_ids)
+    resumo['bases_afetadas'] = len(base_ids)
+    resumo['fichas'] = sorted(recalculadas.values(), key=lambda m: m['nome'])
+    return resumo
 
-@app.route('/bases/nova', methods=['GET', 'POST'])
+@app.route('/insumos/importar', methods=['GET', 'POST'])
 @login_required
-def nova_base():
-    uid = session['usuario_id']
+def importar_insumos_csv():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    
     if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            flash("Selecione um arquivo CSV.", "warning")
+            return redirect(url_for('importar_insumos_csv'))
+        
+        os.makedirs(PASTA_RELATORIOS, exist_ok=True)
+        nome_relatorio = f"importacao_{usuario.id}_{datetime.now():%Y%m%d_%H%M%S}_{secrets.token_hex(4)}.csv"
+        inicio = time.time()
         try:
-            nome_base = request.form.get('nome')
-            if not nome_base:
-                flash("Nome da base Ã© obrigatÃ³rio!", "warning")
-                return redirect(url_for('bases'))
+            with open(os.path.join(PASTA_RELATORIOS, nome_relatorio), 'w', encoding='utf-8-sig', newline='') as relatorio:
+                resumo = importar_insumos(abrir_csv(arquivo.stream), usuario, relatorio)
+        except (ValueError, csv.Error) as e:
+            db.session.rollback()
+            flash(f"Arquivo inválido: {e}", "danger")
+            return redirect(url_for('importar_insumos_csv'))
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Erro na importação de insumos: {e}")
+            flash(f"Erro ao importar: {e}", "danger")
+            return redirect(url_for('importar_insumos_csv'))
+        
+        resumo['segundos'] = time.time() - inicio
+        logger.info(f"Importação de insumos ({usuario.username}): {resumo['linhas']} linhas em {resumo['segundos']:.2f}s")
+        return render_template('insumos_importar.html', resumo=resumo, relatorio=nome_relatorio)
+    
+    return render_template('insumos_importar.html', resumo=None)
+
+@app.route('/insumos/importar/relatorio/<nome>')
+@login_required
+def baixar_relatorio_importacao(nome):
+    if not nome.startswith(f"importacao_{session['usuario_id']}_"):
+        flash("Relatório não encontrado.", "danger")
+        return redirect(url_for('importar_insumos_csv'))
+    return send_from_directory(PASTA_RELATORIOS, nome, as_attachment=True, mimetype='text/csv')
+
+@app.cli.command('importar-insumos')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--usuario', 'username', required=True, help='Usuário dono dos insumos (define a loja).')
+@click.option('--relatorio', default=None, help='CSV de resultado (padrão: <arquivo>.resultado.csv).')
+def importar_insumos_cli(arquivo, username, relatorio):
+    """Importa a lista de preços de um fornecedor (CSV) para a loja do usuário"""
+    usuario = Usuario.query.filter_by(username=username).first()
+    if not usuario:
+        raise click.ClickException(f"Usuário '{username}' não encontrado")
+    
+    relatorio = relatorio or os.path.splitext(arquivo)[0] + '.resultado.csv'
+    inicio = time.time()
+    with open(arquivo, 'rb') as fluxo, open(relatorio, 'w', encoding='utf-8-sig', newline='') as saida:
+        try:
+            resumo = importar_insumos(abrir_csv(fluxo), usuario, saida)
+        except (ValueError, csv.Error) as e:
+            db.session.rollback()
+            raise click.ClickException(f"Arquivo inválido: {e}")
+    
+    click.echo(f"{resumo['linhas']} linhas em {time.time() - inicio:.2f}s: "
+               f"{resumo['criados']} criados, {resumo['atualizados']} atualizados, "
+               f"{resumo['inalterados']} sem alteração, {resumo['erros']} com erro")
+    click.echo(f"{resumo['bases_afetadas']} bases e {len(resumo['fichas'])} fichas recalculadas")
+    click.echo(f"Relatório: {relatorio}")
+
+# ==============================================================================
+# NOTAS FISCAIS DE COMPRA (NF-e)
+# ==============================================================================
+# O XML da NF-e é lido em streaming (iterparse). Cada item é casado com um
+# insumo pela tabela fornecedor_produtos (CNPJ + código do produto); sem
+# vínculo, só o nome normalizado idêntico vincula sozinho. Um nome semelhante
+# vira sugestão (origem 'SUGERIDO') na fila de vínculo e não mexe em preço até
+# ser confirmado. A quantidade da nota (uCom) é convertida para a unidade do
+# insumo quando as duas são medidas compatíveis; sem conversão, o item espera
+# o tamanho informado no vínculo. Os preços de cada nota são gravados num único
+# UPDATE em lote e, ao final, só as fichas que usam os insumos alterados são
+# recalculadas.
+PASTA_NFE_PROCESSADAS = 'processadas'
+PASTA_NFE_ERROS = 'erros'
+SEMELHANCA_MINIMA = 0.85
+# Insumo com todas as palavras na descrição da nota: só é sugerido se cobrir
+# boa parte dela ("LEITE" não casa com "DOCE DE LEITE 400G")
+SEMELHANCA_CONTIDO = 0.6
+COBERTURA_MINIMA = 0.6
+
+# Unidade comercial -> (grandeza, fator para a menor unidade da grandeza)
+UNIDADES_MEDIDA = {
+    'KG': ('MASSA', 1000.0), 'KILO': ('MASSA', 1000.0), 'G': ('MASSA', 1.0), 'GR': ('MASSA', 1.0),
+    'L': ('VOLUME', 1000.0), 'LT': ('VOLUME', 1000.0), 'LITRO': ('VOLUME', 1000.0), 'ML': ('VOLUME', 1.0),
+    'UN': ('UNIDADE', 1.0), 'UND': ('UNIDADE', 1.0), 'UNID': ('UNIDADE', 1.0), 'UNIDADE': ('UNIDADE', 1.0),
+}
+
+def quantidade_no_insumo(quantidade, unidade_nota, unidade_insumo, tamanho_vinculo=None):
+    """Quantidade da nota na unidade do insumo, ou None sem conversão conhecida.
+
+    O tamanho do vínculo (quantidade do insumo por unidade comercial, ex.: CX
+    com 12 UN) prevalece; sem ele, converte só entre medidas da mesma grandeza
+    (KG -> G, L -> ML, UN -> UN).
+    """
+    if tamanho_vinculo:
+        return (quantidade or 0) * tamanho_vinculo
+    origem = UNIDADES_MEDIDA.get(normalizar_nome(unidade_nota).rstrip('.'))
+    destino = UNIDADES_MEDIDA.get(normalizar_nome(unidade_insumo).rstrip('.'))
+    if not origem or not destino or origem[0] != destino[0]:
+        return None
+    return (quantidade or 0) * origem[1] / destino[1]
+
+class IndiceNomes:
+    """Busca de nomes parecidos: candidatos por palavra em comum (blocagem) e
+    nota pelo difflib só dentro desse grupo, sem comparar com todos os nomes."""
+    
+    def __init__(self, pares):
+        self.exatos, self.palavras, self.por_palavra = {}, {}, defaultdict(set)
+        self.nomes = {}
+        for id_, nome in pares:
+            chave = normalizar_nome(nome)
+            self.exatos.setdefault(chave, id_)
+            self.nomes[id_] = chave
+            self.palavras[id_] = set(p for p in chave.split() if len(p) >= 3)
+            for palavra in self.palavras[id_]:
+                self.por_palavra[palavra].add(id_)
+    
+    def candidatos(self, chave):
+        ids = set()
+        for palavra in set(chave.split()):
+            if len(palavra) >= 3:
+                ids.update(self.por_palavra.get(palavra, ()))
+        return ids
+    
+    def buscar(self, nome, minimo=SEMELHANCA_MINIMA):
+        """(id, origem) do nome mais parecido, ou (None, None)"""
+        chave = normalizar_nome(nome)
+        if chave in self.exatos:
+            return self.exatos[chave], 'NOME'
+        
+        palavras = set(chave.split())
+        # Palavras que descrevem o produto (sem pesos e medidas como "400G")
+        descritivas = {p for p in palavras if len(p) >= 3 and not any(c.isdigit() for c in p)}
+        melhor, melhor_nota = None, None
+        for id_ in self.candidatos(chave):
+            # Todas as palavras do insumo presentes na descrição ("QUEIJO MUSSARELA"
+            # em "QUEIJO MUSSARELA FATIADO KG"); entre eles vence o mais específico
+            contido = bool(self.palavras[id_]) and self.palavras[id_] <= palavras
+            semelhanca = SequenceMatcher(None, chave, self.nomes[id_]).ratio()
+            if contido:
+                cobertura = len(self.palavras[id_] & descritivas) / len(descritivas) if descritivas else 1.0
+                contido = cobertura >= COBERTURA_MINIMA and semelhanca >= SEMELHANCA_CONTIDO
+            if not contido and semelhanca < minimo:
+                continue
+            nota = (contido, len(self.palavras[id_]) if contido else 0, semelhanca)
+            if melhor_nota is None or nota > melhor_nota:
+                melhor, melhor_nota = id_, nota
+        return (melhor, 'SEMELHANTE') if melhor else (None, None)
+
+def _float_xml(texto):
+    try:
+        return float(texto) if texto else 0.0
+    except ValueError:
+        return 0.0
+
+def ler_nfe(fluxo):
+    """Cabeçalho e itens de uma NF-e (XML da nota ou nfeProc) lidos com iterparse"""
+    nota = {'chave': None, 'numero': None, 'cnpj': None, 'emitente': None,
+            'data_emissao': None, 'valor_total': 0.0, 'itens': []}
+    caminho = []
+    for evento, elem in ET.iterparse(fluxo, events=('start', 'end')):
+        tag = elem.tag.rsplit('}', 1)[-1]
+        if evento == 'start':
+            caminho.append(tag)
+            if tag == 'infNFe' and elem.get('Id'):
+                nota['chave'] = elem.get('Id')[-44:]
+            continue
+        
+        caminho.pop()
+        pai = caminho[-1] if caminho else None
+        texto = (elem.text or '').strip()
+        if tag == 'det':
+            prod = {filho.tag.rsplit('}', 1)[-1]: (filho.text or '').strip()
+                    for filho in elem.iter() if filho is not elem}
+            quantidade = _float_xml(prod.get('qCom'))
+            total = _float_xml(prod.get('vProd')) - _float_xml(prod.get('vDesc'))
+            nota['itens'].append({
+                'numero_item': int(elem.get('nItem') or len(nota['itens']) + 1),
+                'codigo': prod.get('cProd', '')[:60],
+                'descricao': prod.get('xProd', '')[:150],
+                'unidade': prod.get('uCom', '')[:10],
+                'quantidade': quantidade,
+                'valor_unitario': total / quantidade if quantidade else _float_xml(prod.get('vUnCom')),
+                'valor_total': total,
+            })
+            elem.clear()
+        elif pai == 'ide' and tag == 'nNF':
+            nota['numero'] = texto
+        elif pai == 'ide' and tag in ('dhEmi', 'dEmi') and texto:
+            nota['data_emissao'] = datetime.fromisoformat(texto).replace(tzinfo=None)
+        elif pai == 'emit' and tag in ('CNPJ', 'CPF'):
+            nota['cnpj'] = texto
+        elif pai == 'emit' and tag == 'xNome':
+            nota['emitente'] = texto[:150]
+        elif pai == 'ICMSTot' and tag == 'vNF':
+            nota['valor_total'] = _float_xml(texto)
+        elif tag == 'chNFe' and not nota['chave']:
+            nota['chave'] = texto
+    
+    if not nota['chave'] or not nota['cnpj']:
+        raise ValueError("XML sem chave de acesso ou emitente (não é uma NF-e)")
+    return nota
+
+def indice_insumos_loja(usuario):
+    # Mesmo escopo da edição: o preço da nota só casa com insumos que o usuário pode alterar
+    return IndiceNomes(db.session.query(Insumo.id, Insumo.nome).filter(*filtros_loja(Insumo, usuario)))
+
+def registrar_nfe(nota, usuario, indice):
+    """Grava uma NF-e lida por ler_nfe e atualiza os preços dos insumos casados.
+
+    Retorna o resumo da nota; a chave 'alterados' traz os ids dos insumos com
+    preço novo. Notas já importadas (mesma chave) não são gravadas de novo.
+    """
+    resumo = {'chave': nota['chave'], 'numero': nota['numero'], 'emitente': nota['emitente'],
+              'itens': len(nota['itens']), 'casados': 0, 'alterados': set(), 'status': 'IMPORTADA'}
+    if NotaFiscal.query.filter_by(loja_id=usuario.loja_id, chave=nota['chave']).first():
+        resumo['status'] = 'JÁ IMPORTADA'
+        return resumo
+    
+    cnpj = ''.join(c for c in nota['cnpj'] if c.isdigit())
+    codigos = {item['codigo'] for item in nota['itens']}
+    vinculos = {v.codigo: v for v in FornecedorProduto.query.filter(
+        FornecedorProduto.loja_id == usuario.loja_id, FornecedorProduto.cnpj == cnpj,
+        FornecedorProduto.codigo.in_(codigos))}
+    
+    for item in nota['itens']:
+        vinculo = vinculos.get(item['codigo'])
+        if vinculo is None:
+            insumo_id, origem = indice.buscar(item['descricao'])
+            if insumo_id:
+                # Só o nome idêntico vincula direto; o parecido fica sugerido na fila de vínculo
+                vinculo = FornecedorProduto(loja_id=usuario.loja_id, cnpj=cnpj, codigo=item['codigo'],
+                                            descricao=item['descricao'], insumo_id=insumo_id,
+                                            origem='NOME' if origem == 'NOME' else 'SUGERIDO')
+                db.session.add(vinculo)
+                vinculos[item['codigo']] = vinculo
+        item['vinculo'] = vinculo if vinculo and vinculo.origem != 'SUGERIDO' else None
+    
+    registro = NotaFiscal(loja_id=usuario.loja_id, user_id=usuario.id, chave=nota['chave'], numero=nota['numero'],
+                          cnpj_emitente=cnpj, emitente=nota['emitente'], data_emissao=nota['data_emissao'],
+                          valor_total=nota['valor_total'])
+    db.session.add(registro)
+    db.session.flush()
+    
+    insumo_ids = {item['vinculo'].insumo_id for item in nota['itens'] if item['vinculo']}
+    insumos = {}
+    for lote in em_lotes(insumo_ids):
+        for linha in (db.session.query(Insumo.id, Insumo.preco_embalagem, Insumo.tamanho_embalagem, Insumo.fator_correcao,
+                                       Insumo.custo_unitario, Insumo.categoria_id, Insumo.unidade_id, Unidade.sigla)
+                      .outerjoin(Unidade, Insumo.unidade_id == Unidade.id).filter(Insumo.id.in_(lote))):
+            insumos[linha.id] = linha
+    
+    # Preço médio da nota por insumo: valor líquido / quantidade na unidade do insumo.
+    # Item sem conversão de unidade fica casado, mas sem quantidade e sem preço.
+    valores, quantidades, tamanhos = defaultdict(float), defaultdict(float), {}
+    linhas = []
+    for item in nota['itens']:
+        vinculo = item.pop('vinculo')
+        insumo = insumos.get(vinculo.insumo_id) if vinculo else None
+        quantidade_insumo = None
+        if insumo:
+            resumo['casados'] += 1
+            quantidade_insumo = quantidade_no_insumo(item['quantidade'], item['unidade'], insumo.sigla,
+                                                     vinculo.tamanho_embalagem)
+            if quantidade_insumo:
+                valores[insumo.id] += item['valor_total']
+                quantidades[insumo.id] += quantidade_insumo
+            if vinculo.tamanho_embalagem:
+                tamanhos[insumo.id] = vinculo.tamanho_embalagem
+        linhas.append(dict(item, nota_id=registro.id, loja_id=usuario.loja_id,
+                           insumo_id=insumo.id if insumo else None, quantidade_insumo=quantidade_insumo))
+    db.session.execute(NotaFiscalItem.__table__.insert(), linhas)
+    
+    # Uma nota mais antiga importada depois não sobrescreve o preço de uma mais nova
+    mais_recentes = set()
+    if nota['data_emissao'] and quantidades:
+        for lote in em_lotes(list(quantidades)):
+            mais_recentes.update(insumo_id for (insumo_id,) in (
+                db.session.query(NotaFiscalItem.insumo_id).join(NotaFiscal, NotaFiscalItem.nota_id == NotaFiscal.id)
+                .filter(NotaFiscalItem.insumo_id.in_(lote), NotaFiscal.id != registro.id,
+                        NotaFiscal.loja_id == usuario.loja_id, NotaFiscal.data_emissao > nota['data_emissao'])
+                .distinct()))
+    
+    atualizar = {}
+    for insumo_id, quantidade in quantidades.items():
+        if insumo_id in mais_recentes or quantidade <= 0:
+            continue
+        insumo = insumos[insumo_id]
+        preco_unidade = valores[insumo_id] / quantidade
+        tamanho = tamanhos.get(insumo_id) or insumo.tamanho_embalagem or 1.0
+        novo = {'b_id': insumo_id, 'b_preco': preco_unidade * tamanho, 'b_tamanho': tamanho,
+                'b_fc': insumo.fator_correcao, 'b_custo': preco_unidade * (insumo.fator_correcao or 1.0),
+                'b_categoria': insumo.categoria_id, 'b_unidade': insumo.unidade_id}
+        if abs((insumo.custo_unitario or 0) - novo['b_custo']) > 1e-9 or abs((insumo.tamanho_embalagem or 0) - tamanho) > 1e-9:
+            atualizar[insumo_id] = novo
+    
+    _gravar_lote_insumos(atualizar, {})
+    db.session.commit()
+    resumo['alterados'] = set(atualizar)
+    return resumo
+
+def importar_notas(arquivos, usuario):
+    """Importa várias NF-e em ordem de emissão (o preço mais recente prevalece).
+
+    `arquivos` é uma lista de (nome, fluxo binário). Cada nota é gravada na sua
+    própria transação; um XML inválido não impede as demais.
+    """
+    lidas, resumos = [], []
+    for nome, fluxo in arquivos:
+        try:
+            lidas.append((nome, ler_nfe(fluxo)))
+        except (ET.ParseError, ValueError) as e:
+            resumos.append({'arquivo': nome, 'status': 'ERRO', 'mensagem': str(e), 'itens': 0, 'casados': 0,
+                            'alterados': set()})
+    lidas.sort(key=lambda par: par[1]['data_emissao'] or datetime.min)
+    
+    indice = indice_insumos_loja(usuario)
+    alterados = set()
+    for nome, nota in lidas:
+        try:
+            resumo = registrar_nfe(nota, usuario, indice)
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Erro ao importar NF-e {nome}: {e}")
+            resumo = {'chave': nota['chave'], 'status': 'ERRO', 'mensagem': str(e), 'itens': len(nota['itens']),
+                      'casados': 0, 'alterados': set()}
+        resumo['arquivo'] = nome
+        resumos.append(resumo)
+        alterados |= resumo['alterados']
+    
+    lancar_compras(usuario.loja_id)
+    db.session.commit()
+    
+    base_ids, ficha_ids = fichas_afetadas(alterados)
+    fichas = sorted(EngineCalculo.processar_fichas(ficha_ids).values(), key=lambda m: m['nome'])
+    return {'notas': resumos, 'insumos_alterados': len(alterados), 'bases_afetadas': len(base_ids), 'fichas': fichas}
+
+def itens_nfe_pendentes(usuario, limite=200):
+    """(item, nota, vínculo) dos itens sem insumo confirmado ou sem quantidade na unidade do insumo"""
+    return (db.session.query(NotaFiscalItem, NotaFiscal, FornecedorProduto)
+            .join(NotaFiscal, NotaFiscalItem.nota_id == NotaFiscal.id)
+            .outerjoin(FornecedorProduto, and_(FornecedorProduto.loja_id == NotaFiscal.loja_id,
+                                               FornecedorProduto.cnpj == NotaFiscal.cnpj_emitente,
+                                               FornecedorProduto.codigo == NotaFiscalItem.codigo))
+            .filter(NotaFiscalItem.loja_id == usuario.loja_id,
+                    or_(NotaFiscalItem.insumo_id.is_(None), NotaFiscalItem.quantidade_insumo.is_(None)))
+            .order_by(NotaFiscal.data_emissao.desc(), NotaFiscalItem.numero_item)
+            .limit(limite).all())
+
+def render_notas(usuario, resultado=None):
+    notas = (NotaFiscal.query.filter_by(loja_id=usuario.loja_id)
+             .order_by(NotaFiscal.data_emissao.desc()).limit(50).all())
+    vinculos = (FornecedorProduto.query.filter_by(loja_id=usuario.loja_id)
+                .order_by(FornecedorProduto.criado_em.desc()).limit(200).all())
+    insumos = listar_insumos_resumo(*filtros_loja(Insumo, usuario))
+    return render_template('notas.html', resultado=resultado, notas=notas, vinculos=vinculos,
+                           pendentes=itens_nfe_pendentes(usuario), insumos=insumos)
+
+@app.route('/notas', methods=['GET', 'POST'])
+@login_required
+def notas_fiscais():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    if request.method == 'POST':
+        arquivos = [(a.filename, a.stream) for a in request.files.getlist('arquivos') if a and a.filename]
+        if not arquivos:
+            flash("Selecione ao menos um XML de NF-e.", "warning")
+            return redirect(url_for('notas_fiscais'))
+        inicio = time.time()
+        resultado = importar_notas(arquivos, usuario)
+        resultado['segundos'] = time.time() - inicio
+        logger.info(f"NF-e ({usuario.username}): {len(arquivos)} arquivo(s) em {resultado['segundos']:.2f}s")
+        return render_notas(usuario, resultado)
+    return render_notas(usuario)
+
+@app.route('/notas/vincular', methods=['POST'])
+@login_required
+def vincular_produto_fornecedor():
+    """Vincula um código de fornecedor a um insumo e aplica o preço dos itens pendentes"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    cnpj = ''.join(c for c in request.form.get('cnpj', '') if c.isdigit())
+    codigo = request.form.get('codigo', '').strip()
+    insumo = escopo_loja(Insumo, usuario).filter(Insumo.id == request.form.get('insumo_id', type=int)).first()
+    try:
+        tamanho = converter_decimal(request.form.get('tamanho'))
+    except ValueError as e:
+        flash(f"Tamanho inválido: {e}", "danger")
+        return redirect(url_for('notas_fiscais'))
+    if not cnpj or not codigo or not insumo:
+        flash("Informe o produto do fornecedor e o insumo.", "warning")
+        return redirect(url_for('notas_fiscais'))
+    
+    vinculo = FornecedorProduto.query.filter_by(loja_id=usuario.loja_id, cnpj=cnpj, codigo=codigo).first()
+    if vinculo is None:
+        vinculo = FornecedorProduto(loja_id=usuario.loja_id, cnpj=cnpj, codigo=codigo)
+        db.session.add(vinculo)
+    vinculo.insumo_id = insumo.id
+    vinculo.tamanho_embalagem = tamanho if tamanho and tamanho > 0 else None
+    vinculo.descricao = request.form.get('descricao', vinculo.descricao or '')[:150]
+    vinculo.origem = 'MANUAL'
+    
+    # Itens pendentes desse produto passam a apontar para o insumo; o preço vem do
+    # mais recente que tiver quantidade na unidade do insumo
+    pendentes = (db.session.query(NotaFiscalItem, NotaFiscal.data_emissao)
+                 .join(NotaFiscal, NotaFiscalItem.nota_id == NotaFiscal.id)
+                 .filter(NotaFiscal.loja_id == usuario.loja_id, NotaFiscal.cnpj_emitente == cnpj,
+                         NotaFiscalItem.codigo == codigo,
+                         or_(NotaFiscalItem.insumo_id.is_(None), NotaFiscalItem.quantidade_insumo.is_(None)))
+                 .order_by(NotaFiscal.data_emissao).all())
+    sigla = insumo.unidade.sigla if insumo.unidade else None
+    for item, _ in pendentes:
+        item.insumo_id = insumo.id
+        item.quantidade_insumo = quantidade_no_insumo(item.quantidade, item.unidade, sigla, vinculo.tamanho_embalagem)
+    com_quantidade = [item for item, _ in pendentes if item.quantidade_insumo]
+    if com_quantidade:
+        ultimo = com_quantidade[-1]
+        tamanho_final = vinculo.tamanho_embalagem or insumo.tamanho_embalagem or 1.0
+        preco_unidade = ultimo.valor_total / ultimo.quantidade_insumo
+        insumo.tamanho_embalagem = tamanho_final
+        insumo.preco_embalagem = preco_unidade * tamanho_final
+        insumo.custo_unitario = preco_unidade * (insumo.fator_correcao or 1.0)
+    
+    try:
+        db.session.flush()
+        lancar_compras(usuario.loja_id)
+        db.session.commit()
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f"Erro ao vincular: {e}", "danger")
+        return redirect(url_for('notas_fiscais'))
+    
+    _, ficha_ids = fichas_afetadas([insumo.id])
+    flash(f"{codigo} vinculado a {insumo.nome}. {len(pendentes)} item(ns) de nota atualizado(s), "
+          f"{len(ficha_ids)} ficha(s) recalculada(s).", "success")
+    sem_quantidade = len(pendentes) - len(com_quantidade)
+    if sem_quantidade:
+        unidade_nota = pendentes[-1][0].unidade or 'unidade'
+        flash(f"{sem_quantidade} item(ns) em {unidade_nota} sem conversão para {sigla or 'a unidade do insumo'}: "
+              f"informe quanto do insumo vem em cada {unidade_nota} para aplicar o preço.", "warning")
+    return redirect(url_for('notas_fiscais'))
+
+@app.route('/notas/vinculos/excluir/<int:id>', methods=['POST'])
+@login_required
+def excluir_vinculo_fornecedor(id):
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    vinculo = FornecedorProduto.query.filter_by(id=id, loja_id=usuario.loja_id).first()
+    if vinculo:
+        db.session.delete(vinculo)
+        db.session.commit()
+        flash("Vínculo removido.", "info")
+    return redirect(url_for('notas_fiscais'))
+
+@app.cli.command('importar-nfe')
+@click.argument('caminho', type=click.Path(exists=True))
+@click.option('--usuario', 'username', required=True, help='Usuário que importa (define a loja).')
+@click.option('--vigiar', is_flag=True, help='Fica observando a pasta e importa os XMLs que chegarem.')
+@click.option('--intervalo', default=30, show_default=True, help='Segundos entre as verificações da pasta.')
+def importar_nfe_cli(caminho, username, vigiar, intervalo):
+    """Importa NF-e de um arquivo XML ou de uma pasta (um mês inteiro de uma vez)
+
+    Numa pasta, os XMLs lidos vão para processadas/ e os inválidos para erros/.
+    """
+    usuario = Usuario.query.filter_by(username=username).first()
+    if not usuario:
+        raise click.ClickException(f"Usuário '{username}' não encontrado")
+    
+    def processar(caminhos):
+        inicio = time.time()
+        fluxos = [(c, open(c, 'rb')) for c in caminhos]
+        try:
+            resultado = importar_notas([(os.path.basename(c), f) for c, f in fluxos], usuario)
+        finally:
+            for _, fluxo in fluxos:
+                fluxo.close()
+        
+        for caminho_xml, resumo in zip(sorted(caminhos, key=os.path.basename),
+                                       sorted(resultado['notas'], key=lambda r: r['arquivo'])):
+            click.echo(f"{resumo['arquivo']}: {resumo['status']} - {resumo.get('casados', 0)}/{resumo['itens']} itens casados"
+                       + (f" ({resumo['mensagem']})" if resumo.get('mensagem') else ''))
+            if os.path.isdir(caminho):
+                destino = os.path.join(caminho, PASTA_NFE_ERROS if resumo['status'] == 'ERRO' else PASTA_NFE_PROCESSADAS)
+                os.makedirs(destino, exist_ok=True)
+                os.replace(caminho_xml, os.path.join(destino, os.path.basename(caminho_xml)))
+        click.echo(f"{len(caminhos)} nota(s) em {time.time() - inicio:.2f}s: {resultado['insumos_alterados']} insumo(s) "
+                   f"com preço novo, {len(resultado['fichas'])} ficha(s) recalculada(s)")
+    
+    if os.path.isfile(caminho):
+        processar([caminho])
+        return
+    
+    while True:
+        caminhos = sorted(os.path.join(caminho, n) for n in os.listdir(caminho) if n.lower().endswith('.xml'))
+        if caminhos:
+            processar(caminhos)
+        if not vigiar:
+            break
+        time.sleep(intervalo)
+
+# ==============================================================================
+# VENDAS DO PDV
+# ==============================================================================
+# Os arquivos do PDV vêm por ticket (uma linha por item vendido). Só o total
+# por ficha e dia é guardado: as linhas são somadas em memória durante a
+# leitura e gravadas com upserts em lote que somam ao que já existe. Cada
+# arquivo é registrado pelo hash do conteúdo, então reenviá-lo não duplica vendas.
+LOTE_VENDAS = 5000
+
+COLUNAS_VENDAS = {
+    'DATA': 'data', 'DIA': 'data', 'DATE': 'data', 'DATA VENDA': 'data', 'DATA_VENDA': 'data', 'DATA HORA': 'data',
+    'CODIGO': 'codigo', 'COD': 'codigo', 'SKU': 'codigo', 'CODIGO PDV': 'codigo', 'CODIGO_PDV': 'codigo',
+    'CODIGO PRODUTO': 'codigo', 'CODIGO_PRODUTO': 'codigo',
+    'PRODUTO': 'descricao', 'DESCRICAO': 'descricao', 'ITEM': 'descricao',
+    'QUANTIDADE': 'quantidade', 'QTD': 'quantidade', 'QTDE': 'quantidade',
+    'VALOR': 'valor', 'TOTAL': 'valor', 'RECEITA': 'valor', 'VALOR TOTAL': 'valor', 'VALOR_TOTAL': 'valor',
+}
+
+def upsert_somando(tabela, registros, chaves, somar):
+    """INSERT em lote que, se a chave já existe, soma as colunas `somar`"""
+    dialeto = db.engine.dialect.name
+    if dialeto == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as insert_dialeto
+    elif dialeto == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as insert_dialeto
+    else:
+        raise RuntimeError(f"upsert não suportado para o banco '{dialeto}'")
+    
+    comando = insert_dialeto(tabela)
+    comando = comando.on_conflict_do_update(
+        index_elements=chaves,
+        set_={coluna: tabela.c[coluna] + comando.excluded[coluna] for coluna in somar})
+    for lote in em_lotes(registros, LOTE_VENDAS):
+        db.session.execute(comando, lote)
+
+# '1.234' e '12.345.678' em planilhas de PDV são milhar, não decimal
+_MILHAR_COM_PONTO = re.compile(r'[1-9]\d{0,2}(?:\.\d{3})+')
+
+def _numero_venda(valor, padrao):
+    """Número de uma célula de vendas; texto segue o formato brasileiro de converter_decimal"""
+    if valor is None or valor == '':
+        return padrao
+    if isinstance(valor, (int, float)):
+        return float(valor)
+    texto = str(valor).strip()
+    if _MILHAR_COM_PONTO.fullmatch(texto):
+        texto = texto.replace('.', '')
+    elif ',' not in texto:
+        try:
+            return float(texto)
+        except ValueError:
+            pass
+    numero = converter_decimal(texto)
+    return padrao if numero is None else numero
+
+def _dia_venda(texto, cache):
+    """Dia de 'AAAA-MM-DD[...]' ou 'DD/MM/AAAA[...]'; o cache evita reconverter o mesmo dia"""
+    chave = str(texto or '').strip()[:10]
+    dia = cache.get(chave)
+    if dia is None:
+        if len(chave) == 10 and chave[4] == '-':
+            dia = date(int(chave[:4]), int(chave[5:7]), int(chave[8:10]))
+        elif len(chave) == 10 and chave[2] == '/':
+            dia = date(int(chave[6:10]), int(chave[3:5]), int(chave[:2]))
+        else:
+            raise ValueError(f"data inválida: '{texto}'")
+        cache[chave] = dia
+    return dia
+
+def linhas_vendas(fluxo, nome_arquivo):
+    """(data, codigo, descricao, quantidade, valor) de um CSV ou NDJSON do PDV"""
+    if nome_arquivo.lower().endswith(('.ndjson', '.jsonl', '.json')):
+        for texto in io.TextIOWrapper(fluxo, encoding='utf-8-sig'):
+            if not texto.strip():
+                continue
+            r = json.loads(texto)
+            yield (r.get('data') or r.get('dia'), r.get('codigo'), r.get('descricao') or r.get('produto'),
+                   r.get('quantidade'), r.get('valor') if 'valor' in r else r.get('total'))
+        return
+    
+    leitor = abrir_csv(fluxo)
+    cabecalho = next(leitor, None)
+    if not cabecalho:
+        raise ValueError("arquivo vazio")
+    campos = [COLUNAS_VENDAS.get(normalizar_nome(coluna)) for coluna in cabecalho]
+    if 'data' not in campos or 'codigo' not in campos:
+        raise ValueError("o cabeçalho precisa ter ao menos as colunas 'data' e 'codigo'")
+    posicao = {campo: campos.index(campo) for campo in set(campos) if campo}
+    i_data, i_codigo = posicao['data'], posicao['codigo']
+    i_desc, i_qtd, i_valor = posicao.get('descricao'), posicao.get('quantidade'), posicao.get('valor')
+    for valores in leitor:
+        if len(valores) <= max(i_data, i_codigo):
+            continue
+        yield (valores[i_data], valores[i_codigo],
+               valores[i_desc] if i_desc is not None and i_desc < len(valores) else None,
+               valores[i_qtd] if i_qtd is not None and i_qtd < len(valores) else None,
+               valores[i_valor] if i_valor is not None and i_valor < len(valores) else None)
+
+def hash_arquivo(fluxo):
+    hasher = hashlib.sha256()
+    for bloco in iter(lambda: fluxo.read(1 << 20), b''):
+        hasher.update(bloco)
+    fluxo.seek(0)
+    return hasher.hexdigest()
+
+def codigos_pdv_loja(loja_id):
+    return {codigo.strip().upper(): ficha_id for ficha_id, codigo in
+            db.session.query(Ficha.id, Ficha.codigo_pdv).filter(Ficha.loja_id == loja_id, Ficha.codigo_pdv.isnot(None))}
+
+def importar_vendas(fluxo, nome_arquivo, usuario):
+    """Soma as vendas de um arquivo do PDV em vendas_diarias (uma transação)"""
+    resumo = {'arquivo': nome_arquivo, 'status': 'IMPORTADO', 'linhas': 0, 'erros': 0, 'amostra_erros': [],
+              'quantidade': 0.0, 'receita': 0.0, 'sem_ficha': 0}
+    assinatura = hash_arquivo(fluxo)
+    if ImportacaoVendas.query.filter_by(loja_id=usuario.loja_id, hash_arquivo=assinatura).first():
+        resumo['status'] = 'JÁ IMPORTADO'
+        return resumo
+    
+    codigos = codigos_pdv_loja(usuario.loja_id)
+    por_ficha = defaultdict(lambda: [0.0, 0.0])
+    sem_ficha = defaultdict(lambda: [0.0, 0.0, None])
+    dias, primeiro, ultimo = {}, None, None
+    
+    for numero, (data, codigo, descricao, quantidade, valor) in enumerate(linhas_vendas(fluxo, nome_arquivo), start=1):
+        resumo['linhas'] += 1
+        try:
+            dia = _dia_venda(data, dias)
+            quantidade = _numero_venda(quantidade, 1.0)
+            valor = _numero_venda(valor, 0.0)
+            codigo = str(codigo or '').strip().upper()
+            if not codigo:
+                raise ValueError("código vazio")
+        except (ValueError, TypeError) as e:
+            resumo['erros'] += 1
+            if len(resumo['amostra_erros']) < 10:
+                resumo['amostra_erros'].append(f"linha {numero}: {e}")
+            continue
+        
+        ficha_id = codigos.get(codigo)
+        if ficha_id:
+            total = por_ficha[(ficha_id, dia)]
+        else:
+            total = sem_ficha[(codigo[:40], dia)]
+            total[2] = total[2] or (str(descricao)[:150] if descricao else None)
+            resumo['sem_ficha'] += 1
+        total[0] += quantidade
+        total[1] += valor
+        resumo['quantidade'] += quantidade
+        resumo['receita'] += valor
+        primeiro = dia if primeiro is None or dia < primeiro else primeiro
+        ultimo = dia if ultimo is None or dia > ultimo else ultimo
+    
+    if resumo['linhas'] == resumo['erros']:
+        raise ValueError("nenhuma venda válida no arquivo" + (f" ({resumo['amostra_erros'][0]})" if resumo['amostra_erros'] else ''))
+    
+    upsert_somando(VendaDiaria.__table__,
+                   [{'loja_id': usuario.loja_id, 'ficha_id': ficha_id, 'dia': dia, 'quantidade': q, 'receita': v}
+                    for (ficha_id, dia), (q, v) in por_ficha.items()],
+                   ['loja_id', 'ficha_id', 'dia'], ['quantidade', 'receita'])
+    upsert_somando(VendaSemFicha.__table__,
+                   [{'loja_id': usuario.loja_id, 'codigo': codigo, 'dia': dia, 'descricao': d, 'quantidade': q, 'receita': v}
+                    for (codigo, dia), (q, v, d) in sem_ficha.items()],
+                   ['loja_id', 'codigo', 'dia'], ['quantidade', 'receita'])
+    db.session.add(ImportacaoVendas(loja_id=usuario.loja_id, user_id=usuario.id, hash_arquivo=assinatura,
+                                    nome_arquivo=nome_arquivo[:255], linhas=resumo['linhas'],
+                                    quantidade_total=resumo['quantidade'], receita_total=resumo['receita'],
+                                    data_inicio=primeiro, data_fim=ultimo))
+    baixar_consumo_vendas(usuario.loja_id, primeiro, ultimo, usuario.id)
+    db.session.commit()
+    resumo['dias'] = len({dia for _, dia in por_ficha} | {dia for _, dia in sem_ficha})
+    return resumo
+
+def codigo_pdv_formulario(usuario, ficha_id=None):
+    """Código do PDV enviado no formulário da ficha (None se vazio)"""
+    codigo = request.form.get('codigo_pdv', '').strip().upper()[:40] or None
+    if codigo:
+        outra = Ficha.query.filter(Ficha.loja_id == usuario.loja_id, Ficha.codigo_pdv == codigo,
+                                   Ficha.id != ficha_id).first()
+        if outra:
+            raise ValueError(f"o código do PDV {codigo} já pertence à ficha {outra.nome}")
+    return codigo
+
+def vincular_codigo_pdv(usuario, ficha, codigo):
+    """Define o código do PDV da ficha e move para ela as vendas pendentes desse código"""
+    ficha.codigo_pdv = codigo
+    pendentes = VendaSemFicha.query.filter_by(loja_id=usuario.loja_id, codigo=codigo).all()
+    upsert_somando(VendaDiaria.__table__,
+                   [{'loja_id': usuario.loja_id, 'ficha_id': ficha.id, 'dia': p.dia,
+                     'quantidade': p.quantidade, 'receita': p.receita} for p in pendentes],
+                   ['loja_id', 'ficha_id', 'dia'], ['quantidade', 'receita'])
+    VendaSemFicha.query.filter_by(loja_id=usuario.loja_id, codigo=codigo).delete()
+    if pendentes:
+        db.session.flush()
+        baixar_consumo_vendas(usuario.loja_id, min(p.dia for p in pendentes), max(p.dia for p in pendentes), usuario.id)
+    return len(pendentes)
+
+def codigo_vendas_arquivadas(ficha):
+    return ficha.codigo_pdv or f"FICHA {ficha.id}"
+
+def arquivar_vendas_ficha(ficha):
+    """Devolve as vendas de uma ficha que vai ser excluída para a fila de códigos sem ficha.
+
+    As vendas ficam no código do PDV da ficha (ou 'FICHA <id>', se não houver)
+    e voltam para uma ficha nova ao vincular esse código. Roda na mesma
+    transação da exclusão.
+    """
+    vendas = VendaDiaria.query.filter_by(ficha_id=ficha.id).all()
+    codigo = codigo_vendas_arquivadas(ficha)
+    upsert_somando(VendaSemFicha.__table__,
+                   [{'loja_id': v.loja_id, 'codigo': codigo, 'dia': v.dia, 'descricao': (ficha.nome or '')[:150],
+                     'quantidade': v.quantidade, 'receita': v.receita} for v in vendas],
+                   ['loja_id', 'codigo', 'dia'], ['quantidade', 'receita'])
+    VendaDiaria.query.filter_by(ficha_id=ficha.id).delete(synchronize_session=False)
+    return len(vendas)
+
+def resumo_vendas_periodo(usuario, inicio, fim):
+    """Vendas por ficha no período com o custo teórico pelas fichas atuais"""
+    vendas = (db.session.query(VendaDiaria.ficha_id, Ficha.nome, func.sum(VendaDiaria.quantidade),
+                               func.sum(VendaDiaria.receita))
+              .join(Ficha, VendaDiaria.ficha_id == Ficha.id)
+              .filter(VendaDiaria.loja_id == usuario.loja_id, VendaDiaria.dia >= inicio, VendaDiaria.dia <= fim)
+              .group_by(VendaDiaria.ficha_id, Ficha.nome)
+              .all())
+    metricas = EngineCalculo.processar_fichas([ficha_id for ficha_id, _, _, _ in vendas])
+    linhas = []
+    for ficha_id, nome, quantidade, receita in vendas:
+        custo = (quantidade or 0) * metricas.get(ficha_id, {}).get('custo_porcao', 0)
+        linhas.append({'ficha_id': ficha_id, 'nome': nome, 'quantidade': quantidade or 0, 'receita': receita or 0,
+                       'custo': custo, 'cmv': custo / receita * 100 if receita else 0})
+    linhas.sort(key=lambda l: l['receita'], reverse=True)
+    return linhas
+
+@app.route('/vendas', methods=['GET', 'POST'])
+@login_required
+def vendas():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    resultado = None
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            flash("Selecione o arquivo de vendas.", "warning")
+            return redirect(url_for('vendas'))
+        inicio = time.time()
+        try:
+            resultado = importar_vendas(arquivo.stream, arquivo.filename, usuario)
+        except (ValueError, csv.Error) as e:
+            db.session.rollback()
+            flash(f"Arquivo inválido: {e}", "danger")
+            return redirect(url_for('vendas'))
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Erro ao importar vendas: {e}")
+            flash(f"Erro ao importar vendas: {e}", "danger")
+            return redirect(url_for('vendas'))
+        resultado['segundos'] = time.time() - inicio
+        logger.info(f"Vendas ({usuario.username}): {resultado['linhas']} linhas em {resultado['segundos']:.2f}s")
+    
+    inicio, fim = periodo_filtro()
+    linhas = resumo_vendas_periodo(usuario, inicio.date(), fim.date())
+    pendentes = (db.session.query(VendaSemFicha.codigo, func.max(VendaSemFicha.descricao),
+                                  func.sum(VendaSemFicha.quantidade), func.sum(VendaSemFicha.receita))
+                 .filter(VendaSemFicha.loja_id == usuario.loja_id)
+                 .group_by(VendaSemFicha.codigo)
+                 .order_by(func.sum(VendaSemFicha.receita).desc())
+                 .limit(100).all())
+    importacoes = (ImportacaoVendas.query.filter_by(loja_id=usuario.loja_id)
+                   .order_by(ImportacaoVendas.importada_em.desc()).limit(10).all())
+    fichas = escopo_loja(Ficha, usuario, por_dono=False).order_by(Ficha.nome).all() if pendentes else []
+    return render_template('vendas.html', resultado=resultado, linhas=linhas, pendentes=pendentes,
+                           importacoes=importacoes, fichas=fichas, inicio=inicio, fim=fim,
+                           total_receita=sum(l['receita'] for l in linhas),
+                           total_custo=sum(l['custo'] for l in linhas))
+
+@app.route('/vendas/vincular', methods=['POST'])
+@login_required
+def vincular_venda_pdv():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    codigo = request.form.get('codigo', '').strip().upper()[:40]
+    ficha = escopo_loja(Ficha, usuario, por_dono=False).filter(Ficha.id == request.form.get('ficha_id', type=int)).first()
+    if not codigo or not ficha:
+        flash("Informe o código e a ficha.", "warning")
+        return redirect(url_for('vendas'))
+    
+    outra = Ficha.query.filter(Ficha.loja_id == usuario.loja_id, Ficha.codigo_pdv == codigo, Ficha.id != ficha.id).first()
+    if outra:
+        flash(f"O código {codigo} já pertence à ficha {outra.nome}.", "danger")
+        return redirect(url_for('vendas'))
+    try:
+        dias = vincular_codigo_pdv(usuario, ficha, codigo)
+        db.session.commit()
+    except StaleDataError:
+        return conflito_edicao('ficha', ficha.nome, url_for('vendas'))
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f"Erro ao vincular: {e}", "danger")
+        return redirect(url_for('vendas'))
+    flash(f"Código {codigo} vinculado a {ficha.nome}; {dias} dia(s) de vendas transferido(s).", "success")
+    return redirect(url_for('vendas'))
+
+@app.cli.command('importar-vendas')
+@click.argument('arquivos', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--usuario', 'username', required=True, help='Usuário que importa (define a loja).')
+def importar_vendas_cli(arquivos, username):
+    """Importa arquivos de vendas do PDV (CSV ou NDJSON)"""
+    usuario = Usuario.query.filter_by(username=username).first()
+    if not usuario:
+        raise click.ClickException(f"Usuário '{username}' não encontrado")
+    for caminho in arquivos:
+        inicio = time.time()
+        with open(caminho, 'rb') as fluxo:
+            try:
+                r = importar_vendas(fluxo, os.path.basename(caminho), usuario)
+            except (ValueError, csv.Error) as e:
+                db.session.rollback()
+                click.echo(f"{caminho}: ERRO - {e}")
+                continue
+        click.echo(f"{caminho}: {r['status']} - {r['linhas']} linhas, {r['erros']} com erro, "
+                   f"{r['sem_ficha']} sem ficha, R$ {r['receita']:.2f} em {time.time() - inicio:.2f}s")
+        for erro in r['amostra_erros']:
+            click.echo(f"  {erro}")
+
+# ==============================================================================
+# CONSUMO TEÓRICO DE INSUMOS
+# ==============================================================================
+# Quanto de cada insumo deveria ter saído do estoque para as vendas de um
+# período: as quantidades vendidas por ficha (do PDV, de uma planilha ou
+# digitadas na tela) multiplicadas pela matriz do grafo de receitas.
+COLUNAS_QUANTIDADES = {
+    'FICHA': 'ficha', 'PRODUTO': 'ficha', 'NOME': 'ficha', 'ITEM': 'ficha', 'DESCRICAO': 'ficha',
+    'CODIGO': 'codigo', 'COD': 'codigo', 'SKU': 'codigo', 'CODIGO PDV': 'codigo', 'CODIGO_PDV': 'codigo',
+    'QUANTIDADE': 'quantidade', 'QTD': 'quantidade', 'QTDE': 'quantidade', 'VENDIDOS': 'quantidade',
+}
+CABECALHO_CONSUMO = ['Categoria', 'Insumo', 'Unidade', 'Qtd Líquida', 'Fator Correção', 'Qtd Bruta (compra)',
+                     'Custo Unit.', 'Custo Teórico']
+CASAS_CONSUMO = [None, None, None, 3, 3, 3, 4, 2]
+
+def vendas_por_ficha(loja_id, inicio, fim):
+    return dict(db.session.query(VendaDiaria.ficha_id, func.sum(VendaDiaria.quantidade))
+                .filter(VendaDiaria.loja_id == loja_id, VendaDiaria.dia >= inicio, VendaDiaria.dia <= fim)
+                .group_by(VendaDiaria.ficha_id))
+
+def ler_quantidades_csv(fluxo, loja_id):
+    """{ficha_id: quantidade} de uma planilha com a ficha (nome ou código do PDV) e a quantidade"""
+    leitor = abrir_csv(fluxo)
+    cabecalho = next(leitor, None)
+    if not cabecalho:
+        raise ValueError("arquivo vazio")
+    campos = [COLUNAS_QUANTIDADES.get(normalizar_nome(coluna)) for coluna in cabecalho]
+    if 'quantidade' not in campos or ('ficha' not in campos and 'codigo' not in campos):
+        raise ValueError("o cabeçalho precisa ter a coluna 'quantidade' e 'ficha' ou 'codigo'")
+    i_qtd = campos.index('quantidade')
+    i_ficha = campos.index('codigo') if 'codigo' in campos else campos.index('ficha')
+    
+    codigos = codigos_pdv_loja(loja_id)
+    nomes = {normalizar_nome(nome): ficha_id for ficha_id, nome in
+             db.session.query(Ficha.id, Ficha.nome).filter(Ficha.loja_id == loja_id)}
+    quantidades, nao_encontradas = defaultdict(float), []
+    for numero, valores in enumerate(leitor, start=2):
+        if len(valores) <= max(i_qtd, i_ficha) or not valores[i_ficha].strip():
+            continue
+        referencia = valores[i_ficha].strip()
+        ficha_id = codigos.get(referencia.upper()) or nomes.get(normalizar_nome(referencia))
+        if not ficha_id:
+            nao_encontradas.append(referencia)
+            continue
+        try:
+            quantidades[ficha_id] += _numero_venda(valores[i_qtd], 0.0)
+        except ValueError as e:
+            raise ValueError(f"linha {numero}: {e}")
+    return quantidades, nao_encontradas
+
+def quantidades_formulario():
+    """{ficha_id: quantidade} dos campos qtd_<id> da tela"""
+    quantidades = {}
+    for campo, valor in request.form.items():
+        if campo.startswith('qtd_') and valor.strip():
+            quantidades[int(campo[4:])] = converter_decimal(valor)
+    return quantidades
+
+def calcular_consumo_teorico(loja_id, quantidades):
+    """Linhas do relatório (CABECALHO_CONSUMO), ordenadas por categoria e insumo"""
+    grafo = grafo_receitas(loja_id)
+    liquido = grafo.consumo(quantidades)
+    usados = np.flatnonzero(liquido)
+    insumo_ids = grafo.insumo_ids[usados].tolist()
+    
+    dados = {}
+    for lote in em_lotes(insumo_ids):
+        for insumo_id, nome, categoria, sigla, custo in (
+                db.session.query(Insumo.id, Insumo.nome, Categoria.nome, Unidade.sigla, Insumo.custo_unitario)
+                .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+                .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                .filter(Insumo.id.in_(lote))):
+            dados[insumo_id] = (nome, categoria, sigla, custo)
+    
+    linhas = []
+    for insumo_id, qtd, fc in zip(insumo_ids, liquido[usados].tolist(), grafo.fator_correcao[usados].tolist()):
+        nome, categoria, sigla, custo = dados[insumo_id]
+        linhas.append([categoria or 'Sem categoria', nome, sigla or 'un', qtd, fc, qtd * fc,
+                       custo or 0, qtd * (custo or 0)])
+    linhas.sort(key=lambda l: (l[0], l[1]))
+    return linhas
+
+@app.route('/consumo-teorico', methods=['GET', 'POST'])
+@login_required
+def consumo_teorico():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio, fim = periodo_filtro()
+    nao_encontradas = []
+    
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        try:
+            if arquivo and arquivo.filename:
+                quantidades, nao_encontradas = ler_quantidades_csv(arquivo.stream, usuario.loja_id)
+                origem = f"Planilha {arquivo.filename}"
+            else:
+                quantidades = quantidades_formulario()
+                origem = "Quantidades informadas na tela"
+        except (ValueError, csv.Error) as e:
+            flash(f"Quantidades inválidas: {e}", "danger")
+            return redirect(url_for('consumo_teorico'))
+    else:
+        quantidades = vendas_por_ficha(usuario.loja_id, inicio.date(), fim.date())
+        origem = f"Vendas do PDV de {inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')}"
+    
+    inicio_calculo = time.perf_counter()
+    linhas = calcular_consumo_teorico(usuario.loja_id, quantidades)
+    segundos = time.perf_counter() - inicio_calculo
+    
+    formato = request.values.get('formato')
+    if formato == 'csv':
+        return resposta_csv('consumo_teorico.csv', CABECALHO_CONSUMO, formatar_br(linhas, CASAS_CONSUMO))
+    if formato == 'xlsx':
+        return resposta_xlsx('consumo_teorico.xlsx', [('Consumo Teórico', CABECALHO_CONSUMO, CASAS_CONSUMO, linhas)])
+    
+    fichas = (db.session.query(Ficha.id, Ficha.nome, Ficha.codigo_pdv)
+              .filter(Ficha.loja_id == usuario.loja_id).order_by(Ficha.nome).all())
+    return render_template('consumo_teorico.html', linhas=linhas, fichas=fichas, quantidades=quantidades,
+                           origem=origem, nao_encontradas=nao_encontradas[:50], inicio=inicio, fim=fim,
+                           segundos=segundos, total_custo=sum(l[7] for l in linhas))
+
+# ==============================================================================
+# ESTOQUE: RAZÃO DE MOVIMENTOS E FOTOS DE SALDO
+# ==============================================================================
+# O estoque é um razão só de inclusão (movimentos_estoque), na unidade de
+# compra do insumo: compras das NF-e entram positivas; consumo teórico das
+# vendas, perdas e ajustes de contagem entram com sinal. Nenhum movimento é
+# alterado ou apagado; correções são novos lançamentos.
+#
+# Para não somar o razão inteiro a cada consulta, o fechamento periódico
+# (flask fechar-estoque) grava em saldos_estoque a foto do saldo de cada insumo
+# numa data de corte. O saldo em qualquer data é a última foto até ela mais os
+# movimentos posteriores, ambos buscados pelo índice (loja, insumo, data).
+# Um lançamento com data anterior a uma foto descarta essa foto.
+LOTE_MOVIMENTOS = 5000
+INICIO_RAZAO = datetime(1900, 1, 1)
+FIM_DO_DIA = datetime.max.time().replace(microsecond=0)
+
+EstoqueLinha = namedtuple('EstoqueLinha', 'id nome categoria unidade custo saldo valor')
+
+def lancar_movimentos(loja_id, registros):
+    """Inclui movimentos no razão em lotes e descarta as fotos de saldo que eles invalidam"""
+    if not registros:
+        return 0
+    linhas, primeira_data = [], {}
+    for registro in registros:
+        linha = {'loja_id': loja_id, 'saldo_contado': None, 'nota_item_id': None, 'user_id': None, 'observacao': None}
+        linha.update(registro)
+        linhas.append(linha)
+        insumo_id, data = linha['insumo_id'], linha['data']
+        if insumo_id not in primeira_data or data < primeira_data[insumo_id]:
+            primeira_data[insumo_id] = data
+    for lote in em_lotes(linhas, LOTE_MOVIMENTOS):
+        db.session.execute(MovimentoEstoque.__table__.insert(), lote)
+    
+    if db.session.query(SaldoEstoque.insumo_id).filter(
+            SaldoEstoque.loja_id == loja_id, SaldoEstoque.data_corte >= min(primeira_data.values())).first():
+        fotos = (SaldoEstoque.__table__.delete()
+                 .where(SaldoEstoque.loja_id == loja_id, SaldoEstoque.insumo_id == bindparam('b_insumo'),
+                        SaldoEstoque.data_corte >= bindparam('b_data')))
+        db.session.execute(fotos, [{'b_insumo': i, 'b_data': d} for i, d in primeira_data.items()])
+    return len(linhas)
+
+def lancar_compras(loja_id):
+    """Entrada no estoque dos itens de NF-e já casados com insumo e ainda não lançados"""
+    pendentes = (db.session.query(NotaFiscalItem.id, NotaFiscalItem.insumo_id, NotaFiscalItem.quantidade_insumo,
+                                  NotaFiscal.data_emissao, NotaFiscal.importada_em, NotaFiscal.numero, NotaFiscal.user_id)
+                 .join(NotaFiscal, NotaFiscalItem.nota_id == NotaFiscal.id)
+                 .outerjoin(MovimentoEstoque, MovimentoEstoque.nota_item_id == NotaFiscalItem.id)
+                 .filter(NotaFiscal.loja_id == loja_id, NotaFiscalItem.insumo_id.isnot(None),
+                         NotaFiscalItem.quantidade_insumo.isnot(None), MovimentoEstoque.id.is_(None))
+                 .all())
+    return lancar_movimentos(loja_id, [
+        {'insumo_id': insumo_id, 'data': emissao or importada, 'tipo': 'COMPRA', 'quantidade': quantidade,
+         'nota_item_id': item_id, 'user_id': user_id, 'observacao': f"NF-e {numero or ''}".strip()}
+        for item_id, insumo_id, quantidade, emissao, importada, numero, user_id in pendentes])
+
+def baixar_consumo_vendas(loja_id, inicio, fim, user_id=None):
+    """Lança a saída de insumos das vendas de cada dia do período.
+
+    O consumo teórico de cada dia (vendas x grafo de receitas x fator de
+    correção) é comparado com o que já foi lançado como VENDA naquele dia e só
+    a diferença entra no razão; reimportar vendas ou vincular um código depois
+    gera apenas o complemento. As receitas usadas são as atuais.
+    """
+    grafo = grafo_receitas(loja_id)
+    vendas = (db.session.query(VendaDiaria.dia, VendaDiaria.ficha_id, VendaDiaria.quantidade)
+              .filter(VendaDiaria.loja_id == loja_id, VendaDiaria.dia >= inicio, VendaDiaria.dia <= fim)
+              .all())
+    lancados = (db.session.query(MovimentoEstoque.data, MovimentoEstoque.insumo_id, MovimentoEstoque.quantidade)
+                .filter(MovimentoEstoque.loja_id == loja_id, MovimentoEstoque.tipo == 'VENDA',
+                        MovimentoEstoque.data >= datetime.combine(inicio, datetime.min.time()),
+                        MovimentoEstoque.data <= datetime.combine(fim, FIM_DO_DIA))
+                .all())
+    dias = sorted({dia for dia, _, _ in vendas} | {data.date() for data, _, _ in lancados})
+    if not dias:
+        return 0
+    
+    indice_dia = {dia: n for n, dia in enumerate(dias)}
+    vendidos = np.zeros((len(dias), len(grafo.ficha_ids)))
+    for dia, ficha_id, quantidade in vendas:
+        posicao = grafo.indice_ficha.get(ficha_id)
+        if posicao is not None:
+            vendidos[indice_dia[dia], posicao] += quantidade or 0
+    diferenca = -grafo.ficha_insumo.multiplicar(vendidos) * grafo.fator_correcao
+    for data, insumo_id, quantidade in lancados:
+        posicao = grafo.indice_insumo.get(insumo_id)
+        if posicao is not None:
+            diferenca[indice_dia[data.date()], posicao] -= quantidade
+    
+    dias_lancar, colunas = np.nonzero(np.abs(diferenca) > 1e-6)
+    return lancar_movimentos(loja_id, [
+        {'insumo_id': int(grafo.insumo_ids[coluna]), 'data': datetime.combine(dias[d], FIM_DO_DIA), 'tipo': 'VENDA',
+         'quantidade': float(diferenca[d, coluna]), 'user_id': user_id, 'observacao': 'Consumo teórico das vendas'}
+        for d, coluna in zip(dias_lancar.tolist(), colunas.tolist())])
+
+def consulta_saldos(loja_id, ate=None, *filtros):
+    """Saldo de cada insumo da loja em `ate` (agora, se None).
+
+    Última foto até a data (uma busca no índice da chave primária) mais a soma
+    dos movimentos posteriores a ela (um trecho do índice loja/insumo/data).
+    """
+    limite_foto = [SaldoEstoque.data_corte <= ate] if ate else []
+    limite_razao = [MovimentoEstoque.data <= ate] if ate else []
+    ultima_foto = (select(func.max(SaldoEstoque.data_corte))
+                   .where(SaldoEstoque.loja_id == Insumo.loja_id, SaldoEstoque.insumo_id == Insumo.id, *limite_foto)
+                   .correlate(Insumo)
+                   .scalar_subquery())
+    cauda = (select(func.coalesce(func.sum(MovimentoEstoque.quantidade), 0.0))
+             .where(MovimentoEstoque.loja_id == Insumo.loja_id, MovimentoEstoque.insumo_id == Insumo.id,
+                    MovimentoEstoque.data > func.coalesce(SaldoEstoque.data_corte, INICIO_RAZAO), *limite_razao)
+             .correlate(Insumo, SaldoEstoque)
+             .scalar_subquery())
+    return (db.session.query(Insumo.id, Insumo.nome, Categoria.nome, Unidade.sigla, Insumo.preco_embalagem,
+                             Insumo.tamanho_embalagem, func.coalesce(SaldoEstoque.saldo, 0.0) + cauda)
+            .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+            .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+            .outerjoin(SaldoEstoque, and_(SaldoEstoque.loja_id == Insumo.loja_id, SaldoEstoque.insumo_id == Insumo.id,
+                                          SaldoEstoque.data_corte == ultima_foto))
+            .filter(Insumo.loja_id == loja_id, *filtros)
+            .order_by(Categoria.nome, Insumo.nome))
+
+def listar_saldos(loja_id, ate=None, *filtros):
+    linhas = []
+    for insumo_id, nome, categoria, sigla, preco, tamanho, saldo in consulta_saldos(loja_id, ate, *filtros):
+        # Custo da unidade de compra (o saldo é bruto, antes do fator de correção)
+        custo = (preco or 0) / tamanho if tamanho else 0.0
+        saldo = float(saldo or 0)
+        linhas.append(EstoqueLinha(insumo_id, nome, categoria or 'Sem categoria', sigla or 'un', custo, saldo, saldo * custo))
+    return linhas
+
+def fechar_estoque(loja_id, data_corte):
+    """Grava a foto do saldo de todos os insumos da loja na data de corte"""
+    saldos = [{'loja_id': loja_id, 'insumo_id': insumo_id, 'data_corte': data_corte, 'saldo': float(saldo or 0)}
+              for insumo_id, _, _, _, _, _, saldo in consulta_saldos(loja_id, data_corte)]
+    SaldoEstoque.query.filter_by(loja_id=loja_id, data_corte=data_corte).delete()
+    for lote in em_lotes(saldos, LOTE_MOVIMENTOS):
+        db.session.execute(SaldoEstoque.__table__.insert(), lote)
+    return len(saldos)
+
+def ler_contagem_formulario():
+    """{insumo_id: quantidade contada} dos campos contado_<id> preenchidos"""
+    contados = {}
+    for campo, valor in request.form.items():
+        if campo.startswith('contado_') and valor.strip():
+            contados[int(campo[8:])] = converter_decimal(valor)
+    return contados
+
+@app.route('/estoque')
+@login_required
+def estoque():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    data = ler_data_filtro('data')
+    linhas = listar_saldos(usuario.loja_id, datetime.combine(data.date(), FIM_DO_DIA) if data else None)
+    ultimo_fechamento = (db.session.query(func.max(SaldoEstoque.data_corte))
+                         .filter(SaldoEstoque.loja_id == usuario.loja_id).scalar())
+    hoje = date.today()
+    return render_template('estoque.html', linhas=linhas, data=data, ultimo_fechamento=ultimo_fechamento,
+                           total_valor=sum(l.valor for l in linhas),
+                           vendas_inicio=hoje - timedelta(days=7), vendas_fim=hoje)
+
+@app.route('/estoque/contagem', methods=['POST'])
+@login_required
+def estoque_contagem():
+    """Compara a contagem física com o razão; com `confirmar`, lança os ajustes"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    try:
+        contados = ler_contagem_formulario()
+    except ValueError as e:
+        flash(f"Contagem inválida: {e}", "danger")
+        return redirect(url_for('estoque'))
+    if not contados:
+        flash("Informe a quantidade contada de ao menos um insumo.", "warning")
+        return redirect(url_for('estoque'))
+    
+    saldos = []
+    for lote in em_lotes(list(contados)):
+        saldos.extend(listar_saldos(usuario.loja_id, None, Insumo.id.in_(lote)))
+    comparacao = [(linha, contados[linha.id], contados[linha.id] - linha.saldo) for linha in saldos]
+    
+    if request.form.get('confirmar'):
+        agora = datetime.now()
+        lancados = lancar_movimentos(usuario.loja_id, [
+            {'insumo_id': linha.id, 'data': agora, 'tipo': 'CONTAGEM', 'quantidade': diferenca,
+             'saldo_contado': contado, 'user_id': usuario.id, 'observacao': 'Contagem física'}
+            for linha, contado, diferenca in comparacao])
+        db.session.commit()
+        flash(f"Contagem de {lancados} insumo(s) registrada; saldos ajustados ao contado.", "success")
+        return redirect(url_for('estoque'))
+    
+    return render_template('estoque_contagem.html', comparacao=comparacao,
+                           total_diferenca=sum(d * linha.custo for linha, _, d in comparacao))
+
+@app.route('/estoque/perda', methods=['POST'])
+@login_required
+def estoque_perda():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    insumo = escopo_loja(Insumo, usuario, por_dono=False).filter(
+        Insumo.id == request.form.get('insumo_id', type=int)).first()
+    try:
+        quantidade = converter_decimal(request.form.get('quantidade'))
+    except ValueError as e:
+        flash(f"Quantidade inválida: {e}", "danger")
+        return redirect(url_for('estoque'))
+    if not insumo or not quantidade or quantidade <= 0:
+        flash("Informe o insumo e a quantidade perdida.", "warning")
+        return redirect(url_for('estoque'))
+    
+    lancar_movimentos(usuario.loja_id, [{'insumo_id': insumo.id, 'data': datetime.now(), 'tipo': 'PERDA',
+                                         'quantidade': -quantidade, 'user_id': usuario.id,
+                                         'observacao': request.form.get('observacao', '').strip()[:200] or None}])
+    db.session.commit()
+    flash(f"Perda de {peso_filter(quantidade)} {insumo.unidade.sigla if insumo.unidade else 'un'} de {insumo.nome} registrada.", "success")
+    return redirect(url_for('estoque'))
+
+@app.route('/estoque/baixar-vendas', methods=['POST'])
+@login_required
+def estoque_baixar_vendas():
+    """Refaz a baixa das vendas do período pelas receitas atuais (só as diferenças)"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    try:
+        inicio = datetime.strptime(request.form.get('data_inicio', ''), '%Y-%m-%d').date()
+        fim = datetime.strptime(request.form.get('data_fim', ''), '%Y-%m-%d').date()
+    except ValueError:
+        flash("Informe o período das vendas.", "warning")
+        return redirect(url_for('estoque'))
+    lancados = baixar_consumo_vendas(usuario.loja_id, inicio, fim, usuario.id)
+    db.session.commit()
+    flash(f"Baixa das vendas de {inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')}: "
+          f"{lancados} movimento(s) lançado(s).", "success")
+    return redirect(url_for('estoque'))
+
+@app.route('/estoque/insumo/<int:id>')
+@login_required
+def estoque_insumo(id):
+    """Extrato do insumo: últimos movimentos com o saldo após cada um"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    insumo = escopo_loja(Insumo, usuario, por_dono=False).filter(Insumo.id == id).first_or_404()
+    linha = listar_saldos(usuario.loja_id, None, Insumo.id == id)[0]
+    movimentos = (MovimentoEstoque.query.filter_by(loja_id=usuario.loja_id, insumo_id=id)
+                  .order_by(MovimentoEstoque.data.desc(), MovimentoEstoque.id.desc()).limit(200).all())
+    extrato, saldo = [], linha.saldo
+    for movimento in movimentos:
+        extrato.append((movimento, saldo))
+        saldo -= movimento.quantidade
+    return render_template('estoque_insumo.html', insumo=insumo, linha=linha, extrato=extrato)
+
+@app.cli.command('fechar-estoque')
+@click.option('--data', 'data_corte', default=None, help='Dia do corte, AAAA-MM-DD (padrão: ontem).')
+@click.option('--loja', 'loja_id', type=int, default=None, help='Só esta loja (padrão: todas).')
+def fechar_estoque_cli(data_corte, loja_id):
+    """Lança as compras pendentes das notas e grava a foto dos saldos de estoque"""
+    try:
+        dia = datetime.strptime(data_corte, '%Y-%m-%d').date() if data_corte else date.today() - timedelta(days=1)
+    except ValueError:
+        raise click.ClickException(f"Data inválida: '{data_corte}'")
+    corte = datetime.combine(dia, FIM_DO_DIA)
+    lojas = [loja_id] if loja_id else [l for (l,) in db.session.query(Loja.id).order_by(Loja.id)]
+    for loja in lojas:
+        inicio = time.time()
+        compras = lancar_compras(loja)
+        fotos = fechar_estoque(loja, corte)
+        db.session.commit()
+        click.echo(f"Loja {loja}: {compras} compra(s) lançada(s), {fotos} saldo(s) em "
+                   f"{corte.strftime('%d/%m/%Y %H:%M')} ({time.time() - inicio:.2f}s)")
+
+# ==============================================================================
+# PLANO DE PRODUÇÃO E LISTA DE COMPRAS
+# ==============================================================================
+# As porções planejadas por ficha formam um vetor; contra o grafo de receitas
+# já carregado, um produto dá as bases a produzir e outro os insumos (com as
+# bases explodidas). Nenhuma consulta é feita por ficha.
+LinhaProducaoBase = namedtuple('LinhaProducaoBase', 'base quantidade rendimento lotes lotes_inteiros')
+LinhaCompra = namedtuple('LinhaCompra', 'categoria insumo unidade necessario estoque comprar embalagem embalagens custo')
+
+CABECALHO_PRODUCAO_BASES = ['Base', 'Quantidade (KG/L)', 'Rendimento por Lote', 'Lotes', 'Lotes (arredondado)']
+CASAS_PRODUCAO_BASES = [None, 3, 3, 2, 0]
+CABECALHO_COMPRAS = ['Categoria', 'Insumo', 'Unidade', 'Necessário', 'Em Estoque', 'A Comprar', 'Embalagem',
+                     'Embalagens', 'Custo da Compra']
+CASAS_COMPRAS = [None, None, None, 3, 3, 3, 3, 0, 2]
+
+def plano_producao(loja_id, porcoes, descontar_estoque=False):
+    """Bases a produzir e lista de compras (por categoria) para as porções planejadas"""
+    grafo = grafo_receitas(loja_id)
+    vetor = grafo.vetor_fichas(porcoes)
+    por_base = grafo.ficha_base.multiplicar(vetor)
+    # Quantidade de compra: a receita pede o peso limpo, o fator de correção leva ao bruto
+    bruto = grafo.ficha_insumo.multiplicar(vetor) * grafo.fator_correcao
+    
+    usadas = np.flatnonzero(por_base > 0)
+    nomes_base = {}
+    for lote in em_lotes(grafo.base_ids[usadas].tolist()):
+        nomes_base.update(db.session.query(Base.id, Base.nome).filter(Base.id.in_(lote)))
+    bases = []
+    for posicao in usadas.tolist():
+        quantidade, rendimento = float(por_base[posicao]), float(grafo.rendimento[posicao])
+        lotes = quantidade / rendimento if rendimento > 0 else 0.0
+        bases.append(LinhaProducaoBase(nomes_base[int(grafo.base_ids[posicao])], quantidade, rendimento,
+                                       lotes, math.ceil(lotes - 1e-9)))
+    bases.sort(key=lambda b: b.base)
+    
+    usados = np.flatnonzero(bruto > 0)
+    insumo_ids = grafo.insumo_ids[usados].tolist()
+    dados, saldos = {}, {}
+    for lote in em_lotes(insumo_ids):
+        for insumo_id, nome, categoria, sigla, preco, tamanho in (
+                db.session.query(Insumo.id, Insumo.nome, Categoria.nome, Unidade.sigla,
+                                 Insumo.preco_embalagem, Insumo.tamanho_embalagem)
+                .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+                .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                .filter(Insumo.id.in_(lote))):
+            dados[insumo_id] = (nome, categoria, sigla, preco or 0, tamanho or 0)
+        if descontar_estoque:
+            saldos.update((l.id, l.saldo) for l in listar_saldos(loja_id, None, Insumo.id.in_(lote)))
+    
+    compras = []
+    for insumo_id, necessario in zip(insumo_ids, bruto[usados].tolist()):
+        nome, categoria, sigla, preco, tamanho = dados[insumo_id]
+        estoque = max(saldos.get(insumo_id, 0.0), 0.0)
+        comprar = max(necessario - estoque, 0.0)
+        embalagens = math.ceil(comprar / tamanho - 1e-9) if tamanho > 0 else 0
+        compras.append(LinhaCompra(categoria or 'Sem categoria', nome, sigla or 'un', necessario, estoque,
+                                   comprar, tamanho, embalagens, embalagens * preco))
+    compras.sort(key=lambda c: (c.categoria, c.insumo))
+    return bases, compras
+
+@app.route('/producao', methods=['GET', 'POST'])
+@login_required
+def producao():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    porcoes, bases, compras = {}, [], []
+    descontar_estoque = bool(request.form.get('descontar_estoque'))
+    if request.method == 'GET' and request.args.get('previsao'):
+        porcoes = porcoes_previstas(usuario.loja_id, ler_modelo_previsao(), ler_dias_previsao())
+        if porcoes:
+            bases, compras = plano_producao(usuario.loja_id, porcoes)
+    if request.method == 'POST':
+        try:
+            porcoes = quantidades_formulario()
+        except ValueError as e:
+            flash(f"Porções inválidas: {e}", "danger")
+            return redirect(url_for('producao'))
+        bases, compras = plano_producao(usuario.loja_id, porcoes, descontar_estoque)
+        
+        formato = request.form.get('formato')
+        if formato == 'csv':
+            return resposta_csv('lista_compras.csv', CABECALHO_COMPRAS, formatar_br(compras, CASAS_COMPRAS))
+        if formato == 'xlsx':
+            return resposta_xlsx('plano_producao.xlsx', [
+                ('Compras', CABECALHO_COMPRAS, CASAS_COMPRAS, compras),
+                ('Bases', CABECALHO_PRODUCAO_BASES, CASAS_PRODUCAO_BASES, bases),
+            ])
+    
+    fichas = (db.session.query(Ficha.id, Ficha.nome, Ficha.codigo_pdv)
+              .filter(Ficha.loja_id == usuario.loja_id).order_by(Ficha.nome).all())
+    return render_template('producao.html', fichas=fichas, porcoes=porcoes, bases=bases, compras=compras,
+                           descontar_estoque=descontar_estoque, total_compra=sum(c.custo for c in compras),
+                           nomes_fichas={f.id: f.nome for f in fichas})
+
+# ==============================================================================
+# ENGENHARIA DE CARDÁPIO (POPULARIDADE x MARGEM DE CONTRIBUIÇÃO)
+# ==============================================================================
+# Matriz clássica de Kasavana e Smith. Um item é popular quando sua fatia nas
+# vendas é ao menos 70% da fatia média (0,7 / nº de itens vendidos) e tem
+# margem alta quando o lucro bruto por porção é ao menos a média ponderada
+# pelas quantidades. Os custos vêm de um único EngineCalculo.processar_fichas
+# e todo o resto é calculado em vetores do NumPy.
+CLASSES_CARDAPIO = {
+    'ESTRELA': 'Estrela',
+    'BURRO_DE_CARGA': 'Burro de Carga',
+    'QUEBRA_CABECA': 'Quebra-cabeça',
+    'CAO': 'Cão',
+}
+LIMITE_POPULARIDADE = 0.7
+
+def engenharia_cardapio(quantidades):
+    """Classificação dos itens vendidos; `quantidades` é {ficha_id: quantidade}"""
+    metricas = EngineCalculo.processar_fichas([f for f, q in quantidades.items() if q and q > 0])
+    ids = sorted(metricas)
+    resultado = {'itens': [], 'total_itens': len(ids), 'quantidade_total': 0.0, 'receita_total': 0.0,
+                 'lucro_total': 0.0, 'limite_popularidade': 0.0, 'margem_media': 0.0,
+                 'margem_percentual_media': 0.0, 'cmv_medio': 0.0}
+    if not ids:
+        return resultado
+    
+    quantidade = np.array([quantidades[f] for f in ids], dtype=np.float64)
+    preco = np.array([metricas[f]['preco_venda'] for f in ids], dtype=np.float64)
+    custo = np.array([metricas[f]['custo_porcao'] for f in ids], dtype=np.float64)
+    margem = np.array([metricas[f]['lucro_bruto'] for f in ids], dtype=np.float64)
+    
+    total = quantidade.sum()
+    mix = quantidade / total
+    receita, lucro = quantidade * preco, quantidade * margem
+    limite_popularidade = LIMITE_POPULARIDADE / len(ids)
+    margem_media = lucro.sum() / total
+    popular = mix >= limite_popularidade
+    rentavel = margem >= margem_media
+    classes = np.where(popular, np.where(rentavel, 'ESTRELA', 'BURRO_DE_CARGA'),
+                       np.where(rentavel, 'QUEBRA_CABECA', 'CAO'))
+    
+    for n, ficha_id in enumerate(ids):
+        resultado['itens'].append({
+            'id': ficha_id, 'nome': metricas[ficha_id]['nome'], 'quantidade': float(quantidade[n]),
+            'mix': float(mix[n] * 100), 'preco_venda': float(preco[n]), 'custo_porcao': float(custo[n]),
+            'lucro_bruto': float(margem[n]), 'margem_contribuicao': metricas[ficha_id]['margem_contribuicao'],
+            'receita': float(receita[n]), 'lucro_total': float(lucro[n]), 'classe': str(classes[n]),
+        })
+    resultado['itens'].sort(key=lambda i: i['lucro_total'], reverse=True)
+    resultado.update({
+        'quantidade_total': float(total), 'receita_total': float(receita.sum()), 'lucro_total': float(lucro.sum()),
+        'limite_popularidade': limite_popularidade * 100, 'margem_media': float(margem_media),
+        'margem_percentual_media': float(lucro.sum() / receita.sum() * 100) if receita.sum() > 0 else 0.0,
+        'cmv_medio': float((quantidade * custo).sum() / receita.sum() * 100) if receita.sum() > 0 else 0.0,
+        'classes': {classe: int((classes == classe).sum()) for classe in CLASSES_CARDAPIO},
+    })
+    return resultado
+
+@app.route('/engenharia-cardapio', methods=['GET', 'POST'])
+@login_required
+def engenharia_cardapio_tela():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio, fim = periodo_filtro()
+    nao_encontradas = []
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            flash("Selecione a planilha de quantidades vendidas.", "warning")
+            return redirect(url_for('engenharia_cardapio_tela'))
+        try:
+            quantidades, nao_encontradas = ler_quantidades_csv(arquivo.stream, usuario.loja_id)
+        except (ValueError, csv.Error) as e:
+            flash(f"Planilha inválida: {e}", "danger")
+            return redirect(url_for('engenharia_cardapio_tela'))
+        origem = f"Planilha {arquivo.filename}"
+    else:
+        quantidades = vendas_por_ficha(usuario.loja_id, inicio.date(), fim.date())
+        origem = f"Vendas do PDV de {inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')}"
+    
+    return render_template('engenharia_cardapio.html', analise=engenharia_cardapio(quantidades),
+                           classes=CLASSES_CARDAPIO, origem=origem, inicio=inicio, fim=fim,
+                           nao_encontradas=nao_encontradas[:50])
+
+@app.route('/engenharia-cardapio/dados')
+@login_required
+def engenharia_cardapio_dados():
+    """Pontos do gráfico de dispersão (mix % x lucro bruto) e as médias do período"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio, fim = periodo_filtro()
+    analise = engenharia_cardapio(vendas_por_ficha(usuario.loja_id, inicio.date(), fim.date()))
+    analise.update({'data_inicio': inicio.strftime('%Y-%m-%d'), 'data_fim': fim.strftime('%Y-%m-%d')})
+    return jsonify(analise)
+
+# ==============================================================================
+# PREVISÃO DE DEMANDA POR FICHA
+# ==============================================================================
+# As vendas diárias da loja formam uma matriz dias x fichas e cada modelo
+# avança um dia por vez sobre todas as fichas juntas (operações de vetor):
+#   SAZONAL    - ingênuo sazonal: o mesmo dia da semana anterior;
+#   SUAVIZACAO - suavização exponencial com nível e sazonalidade semanal
+#                aditiva (Holt-Winters sem tendência).
+# O estado de cada modelo na data-base fica guardado com a previsão. Quando
+# chegam vendas novas, o cálculo parte do lote anterior e percorre só os dias
+# novos, desde que o histórico até aquele lote não tenha mudado; um cálculo do
+# zero usa só as últimas SEMANAS_HISTORICO semanas, onde o peso do que vem antes
+# já é desprezível. O MAPE usa os erros da previsão de um dia à frente nos
+# últimos JANELA_MAPE dias.
+MODELOS_PREVISAO = {
+    'SUAVIZACAO': 'Suavização exponencial sazonal',
+    'SAZONAL': 'Sazonal ingênuo (mesmo dia da semana)',
+}
+HORIZONTE_PREVISAO = 28
+JANELA_MAPE = 28
+ALFA_NIVEL = 0.3
+GAMA_SAZONAL = 0.2
+SEMANAS_HISTORICO = 26
+PREVISOES_MANTIDAS = 30  # dias de lotes antigos guardados pelo job noturno
+
+def assinatura_vendas(loja_id, ate):
+    quantidade, soma = (db.session.query(func.count(VendaDiaria.ficha_id), func.coalesce(func.sum(VendaDiaria.quantidade), 0))
+                        .filter(VendaDiaria.loja_id == loja_id, VendaDiaria.dia <= ate).one())
+    return f"{quantidade}:{float(soma):.4f}"
+
+def _estado_previsao(fichas):
+    return {'nivel': np.zeros(fichas), 'sazonal': np.zeros((fichas, 7)), 'ultimos': np.zeros((fichas, 7)),
+            'erros': np.full((fichas, JANELA_MAPE), np.nan)}
+
+def _avancar_previsao(modelo, estado, vendido, dia_semana):
+    """Registra o erro da previsão do dia e atualiza o estado com o vendido (todas as fichas)"""
+    if modelo == 'SAZONAL':
+        previsto = estado['ultimos'][:, dia_semana].copy()
+        estado['ultimos'][:, dia_semana] = vendido
+    else:
+        previsto = estado['nivel'] + estado['sazonal'][:, dia_semana]
+        nivel = ALFA_NIVEL * (vendido - estado['sazonal'][:, dia_semana]) + (1 - ALFA_NIVEL) * estado['nivel']
+        estado['sazonal'][:, dia_semana] = (GAMA_SAZONAL * (vendido - nivel)
+                                            + (1 - GAMA_SAZONAL) * estado['sazonal'][:, dia_semana])
+        estado['nivel'] = nivel
+    erros = estado['erros']
+    erros[:, :-1] = erros[:, 1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        erros[:, -1] = np.where(vendido > 0, np.abs(vendido - np.maximum(previsto, 0)) / vendido, np.nan)
+
+def _prever(modelo, estado, data_base):
+    """Matriz fichas x HORIZONTE_PREVISAO com as quantidades previstas a partir do dia seguinte"""
+    dias_semana = [(data_base + timedelta(days=h)).weekday() for h in range(1, HORIZONTE_PREVISAO + 1)]
+    if modelo == 'SAZONAL':
+        previsto = estado['ultimos'][:, dias_semana]
+    else:
+        previsto = estado['nivel'][:, None] + estado['sazonal'][:, dias_semana]
+    return np.maximum(previsto, 0)
+
+def calcular_previsao(loja_id, modelo, data_base):
+    """Lote de previsão da loja na data-base, reaproveitado ou calculado (se possível, incrementalmente)"""
+    assinatura = assinatura_vendas(loja_id, data_base)
+    lote = PrevisaoLote.query.filter_by(loja_id=loja_id, modelo=modelo, data_base=data_base).first()
+    if lote and lote.assinatura == assinatura:
+        return lote
+    
+    ficha_ids, estado, desde, incremental = [], None, None, False
+    anterior = (PrevisaoLote.query.filter(PrevisaoLote.loja_id == loja_id, PrevisaoLote.modelo == modelo,
+                                          PrevisaoLote.data_base < data_base)
+                .order_by(PrevisaoLote.data_base.desc()).first())
+    if anterior and anterior.assinatura == assinatura_vendas(loja_id, anterior.data_base):
+        linhas = (db.session.query(PrevisaoFicha.ficha_id, PrevisaoFicha.estado)
+                  .filter(PrevisaoFicha.lote_id == anterior.id).order_by(PrevisaoFicha.ficha_id).all())
+        ficha_ids = [ficha_id for ficha_id, _ in linhas]
+        estado = _estado_previsao(len(linhas))
+        for n, (_, texto) in enumerate(linhas):
+            for chave, valor in json.loads(texto).items():
+                estado[chave][n] = valor
+        desde = anterior.data_base + timedelta(days=1)
+        incremental = True
+    
+    limite = desde or data_base - timedelta(weeks=SEMANAS_HISTORICO) + timedelta(days=1)
+    vendas = (db.session.query(VendaDiaria.dia, VendaDiaria.ficha_id, VendaDiaria.quantidade)
+              .filter(VendaDiaria.loja_id == loja_id, VendaDiaria.dia >= limite, VendaDiaria.dia <= data_base)
+              .all())
+    if desde is None:
+        desde = min((dia for dia, _, _ in vendas), default=data_base)
+    
+    indice = {ficha_id: n for n, ficha_id in enumerate(ficha_ids)}
+    for _, ficha_id, _ in vendas:
+        if ficha_id not in indice:
+            indice[ficha_id] = len(ficha_ids)
+            ficha_ids.append(ficha_id)
+    novas = len(ficha_ids) - (len(estado['nivel']) if estado else 0)
+    if estado is None:
+        estado = _estado_previsao(novas)
+    elif novas:
+        extra = _estado_previsao(novas)
+        estado = {chave: np.concatenate([estado[chave], extra[chave]]) for chave in estado}
+    
+    dias = (data_base - desde).days + 1
+    matriz = np.zeros((dias, len(ficha_ids)))
+    if vendas:
+        np.add.at(matriz, (np.array([(dia - desde).days for dia, _, _ in vendas]),
+                           np.array([indice[ficha_id] for _, ficha_id, _ in vendas])),
+                  np.array([quantidade or 0 for _, _, quantidade in vendas], dtype=np.float64))
+    
+    inicio = 0
+    if not incremental:
+        # Cálculo do zero: a primeira semana define o nível e a sazonalidade iniciais
+        if modelo == 'SUAVIZACAO' and dias >= 7:
+            estado['nivel'] = matriz[:7].mean(axis=0)
+            for t in range(7):
+                estado['sazonal'][:, (desde + timedelta(days=t)).weekday()] = matriz[t] - estado['nivel']
+            inicio = 7
+    for t in range(inicio, dias):
+        _avancar_previsao(modelo, estado, matriz[t], (desde + timedelta(days=t)).weekday())
+    
+    previsto = _prever(modelo, estado, data_base)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # fichas sem venda na janela: MAPE vazio
+        mape = np.nanmean(estado['erros'], axis=1) * 100
+    
+    # A tela, o plano de produção e o job noturno podem gravar o mesmo lote ao
+    # mesmo tempo: a gravação vai num savepoint e quem perder a corrida pelo
+    # índice único usa o lote gravado pelo outro
+    try:
+        with db.session.begin_nested():
+            if lote:
+                PrevisaoFicha.query.filter_by(lote_id=lote.id).delete(synchronize_session=False)
+                PrevisaoLote.query.filter_by(id=lote.id).delete(synchronize_session=False)
+                db.session.expunge(lote)
+            lote = PrevisaoLote(loja_id=loja_id, modelo=modelo, data_base=data_base, assinatura=assinatura,
+                                incremental=incremental)
+            db.session.add(lote)
+            db.session.flush()
+            registros = [{'lote_id': lote.id, 'ficha_id': ficha_id,
+                          'mape': None if np.isnan(mape[n]) else float(mape[n]),
+                          'previsao': json.dumps([round(v, 3) for v in previsto[n].tolist()]),
+                          'estado': json.dumps({chave: valor[n].tolist() for chave, valor in estado.items()})}
+                         for n, ficha_id in enumerate(ficha_ids)]
+            for lote_registros in em_lotes(registros, LOTE_MOVIMENTOS):
+                db.session.execute(PrevisaoFicha.__table__.insert(), lote_registros)
+    except IntegrityError:
+        logger.info(f"Previsão {modelo} da loja {loja_id} gravada por outro processo; usando o lote dele")
+        return PrevisaoLote.query.filter_by(loja_id=loja_id, modelo=modelo, data_base=data_base).one()
+    return lote
+
+def ultimo_dia_vendas(loja_id):
+    return db.session.query(func.max(VendaDiaria.dia)).filter(VendaDiaria.loja_id == loja_id).scalar()
+
+def previsoes_fichas(lote, dias):
+    """{ficha_id: (quantidades dos próximos `dias` dias, mape)}"""
+    return {ficha_id: (json.loads(previsao)[:dias], mape) for ficha_id, previsao, mape in
+            db.session.query(PrevisaoFicha.ficha_id, PrevisaoFicha.previsao, PrevisaoFicha.mape)
+            .filter(PrevisaoFicha.lote_id == lote.id)}
+
+def descartar_previsoes_antigas(loja_id, antes_de):
+    antigos = [i for (i,) in db.session.query(PrevisaoLote.id).filter(PrevisaoLote.loja_id == loja_id,
+                                                                      PrevisaoLote.data_base < antes_de)]
+    for lote in em_lotes(antigos):
+        PrevisaoFicha.query.filter(PrevisaoFicha.lote_id.in_(lote)).delete(synchronize_session=False)
+        PrevisaoLote.query.filter(PrevisaoLote.id.in_(lote)).delete(synchronize_session=False)
+    return len(antigos)
+
+def ler_modelo_previsao():
+    modelo = request.args.get('modelo', 'SUAVIZACAO')
+    return modelo if modelo in MODELOS_PREVISAO else 'SUAVIZACAO'
+
+def ler_dias_previsao(padrao=7):
+    return min(max(request.args.get('dias', padrao, type=int) or padrao, 1), HORIZONTE_PREVISAO)
+
+@app.route('/previsao')
+@login_required
+def previsao_demanda():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    modelo, dias = ler_modelo_previsao(), ler_dias_previsao()
+    data_base = ultimo_dia_vendas(usuario.loja_id)
+    linhas, datas, lote = [], [], None
+    if data_base:
+        inicio = time.perf_counter()
+        lotes = {m: calcular_previsao(usuario.loja_id, m, data_base) for m in MODELOS_PREVISAO}
+        db.session.commit()
+        lote = lotes[modelo]
+        segundos = time.perf_counter() - inicio
+        previsoes = {m: previsoes_fichas(l, dias) for m, l in lotes.items()}
+        nomes = dict(db.session.query(Ficha.id, Ficha.nome).filter(Ficha.loja_id == usuario.loja_id))
+        for ficha_id, (quantidades, mape) in previsoes[modelo].items():
+            if ficha_id in nomes:
+                linhas.append({'ficha_id': ficha_id, 'nome': nomes[ficha_id], 'quantidades': quantidades,
+                               'total': sum(quantidades), 'mape': mape,
+                               'mapes': {m: previsoes[m].get(ficha_id, (None, None))[1] for m in MODELOS_PREVISAO}})
+        linhas.sort(key=lambda l: l['total'], reverse=True)
+        datas = [data_base + timedelta(days=h) for h in range(1, dias + 1)]
+        logger.info(f"Previsão ({usuario.username}): {len(linhas)} fichas em {segundos:.3f}s")
+    return render_template('previsao.html', linhas=linhas, datas=datas, lote=lote, modelo=modelo, dias=dias,
+                           modelos=MODELOS_PREVISAO, data_base=data_base, horizonte=HORIZONTE_PREVISAO)
+
+def porcoes_previstas(loja_id, modelo, dias):
+    """Porções previstas por ficha para os próximos dias, arredondadas para cima"""
+    data_base = ultimo_dia_vendas(loja_id)
+    if not data_base:
+        return {}
+    lote = calcular_previsao(loja_id, modelo, data_base)
+    db.session.commit()
+    return {ficha_id: math.ceil(sum(quantidades) - 1e-9)
+            for ficha_id, (quantidades, _) in previsoes_fichas(lote, dias).items() if sum(quantidades) > 0}
+
+@app.cli.command('prever-demanda')
+@click.option('--loja', 'loja_id', type=int, default=None, help='Só esta loja (padrão: todas).')
+def prever_demanda_cli(loja_id):
+    """Job noturno: atualiza as previsões de demanda de todas as lojas"""
+    lojas = [loja_id] if loja_id else [l for (l,) in db.session.query(VendaDiaria.loja_id).distinct()]
+    inicio_total = time.time()
+    for loja in lojas:
+        data_base = ultimo_dia_vendas(loja)
+        if not data_base:
+            click.echo(f"Loja {loja}: sem vendas")
+            continue
+        inicio = time.time()
+        modos = []
+        for modelo in MODELOS_PREVISAO:
+            lote = calcular_previsao(loja, modelo, data_base)
+            modos.append(f"{modelo} {'incremental' if lote.incremental else 'completo'}")
+        descartados = descartar_previsoes_antigas(loja, data_base - timedelta(days=PREVISOES_MANTIDAS))
+        db.session.commit()
+        click.echo(f"Loja {loja}: previsão a partir de {data_base.strftime('%d/%m/%Y')} ({', '.join(modos)}; "
+                   f"{descartados} lote(s) antigo(s) descartado(s)) em {time.time() - inicio:.2f}s")
+    click.echo(f"Total: {time.time() - inicio_total:.2f}s")
+
+# ==============================================================================
+# CURVA ABC DOS INSUMOS (PARETO POR CUSTO)
+# ==============================================================================
+# O custo de cada insumo no cardápio sai do grafo de receitas já carregado: o
+# vetor de porções (uma de cada ficha, as vendas do período ou um plano) vezes
+# ficha_insumo dá o consumo líquido, que vezes o custo unitário dá o custo. Com
+# várias lojas, cada uma entra com o seu grafo e o ranking é único. A classe A
+# vai até 80% do custo acumulado, a B até 95% e o resto é C; o insumo que
+# cruza o limite fica na classe de cima.
+LIMITES_ABC = (('A', 0.80), ('B', 0.95), ('C', 1.0))
+PESOS_ABC = {
+    'cardapio': 'Uma porção de cada ficha',
+    'vendas': 'Porções vendidas no PDV',
+    'previsao': 'Porções previstas',
+}
+PONTOS_CURVA_ABC = 200
+
+LinhaABC = namedtuple('LinhaABC', 'posicao loja insumo categoria unidade quantidade custo_unitario custo '
+                                  'participacao acumulado classe insumo_id')
+CABECALHO_ABC = ['Posição', 'Loja', 'Insumo', 'Categoria', 'Unidade', 'Qtd Líquida', 'Custo Unit.', 'Custo',
+                 'Participação %', 'Acumulado %', 'Classe']
+CASAS_ABC = [0, None, None, None, None, 3, 4, 2, 2, 2, None]
+
+def curva_abc(porcoes_por_loja):
+    """Ranking dos insumos por custo; `porcoes_por_loja` é {loja_id: {ficha_id: porções}}.
+
+    Porções None numa loja valem uma porção de cada ficha.
+    """
+    lojas = dict(db.session.query(Loja.id, Loja.nome).filter(Loja.id.in_(list(porcoes_por_loja))))
+    partes = []
+    for loja_id, porcoes in porcoes_por_loja.items():
+        grafo = grafo_receitas(loja_id)
+        if not len(grafo.insumo_ids):
+            continue
+        vetor = np.ones(len(grafo.ficha_ids)) if porcoes is None else grafo.vetor_fichas(porcoes)
+        quantidade = grafo.ficha_insumo.multiplicar(vetor)
+        custos = dict(db.session.query(Insumo.id, Insumo.custo_unitario).filter(Insumo.loja_id == loja_id))
+        custo_unitario = np.array([custos.get(i) or 0.0 for i in grafo.insumo_ids.tolist()], dtype=np.float64)
+        partes.append((np.full(len(grafo.insumo_ids), loja_id), grafo.insumo_ids, quantidade, custo_unitario))
+    
+    resultado = {'linhas': [], 'curva': [], 'custo_total': 0.0,
+                 'resumo': {classe: {'itens': 0, 'custo': 0.0, 'itens_pct': 0.0, 'custo_pct': 0.0}
+                            for classe, _ in LIMITES_ABC}}
+    if not partes:
+        return resultado
+    loja_ids, insumo_ids, quantidade, custo_unitario = (np.concatenate(coluna) for coluna in zip(*partes))
+    custo = quantidade * custo_unitario
+    usados = np.flatnonzero(custo > 0)
+    usados = usados[np.argsort(-custo[usados], kind='stable')]
+    total = custo[usados].sum()
+    if not len(usados) or total <= 0:
+        return resultado
+    
+    participacao = custo[usados] / total
+    acumulado = np.cumsum(participacao)
+    anterior = acumulado - participacao
+    classes = np.full(len(usados), LIMITES_ABC[-1][0])
+    for classe, limite in reversed(LIMITES_ABC[:-1]):
+        classes[anterior < limite - 1e-12] = classe
+    
+    dados = {}
+    for lote in em_lotes(insumo_ids[usados].tolist()):
+        for insumo_id, nome, categoria, sigla in (
+                db.session.query(Insumo.id, Insumo.nome, Categoria.nome, Unidade.sigla)
+                .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+                .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                .filter(Insumo.id.in_(lote))):
+            dados[insumo_id] = (nome, categoria or 'Sem categoria', sigla or 'un')
+    
+    for posicao, (n, loja_id, insumo_id, classe) in enumerate(zip(
+            usados.tolist(), loja_ids[usados].tolist(), insumo_ids[usados].tolist(), classes.tolist()), start=1):
+        nome, categoria, sigla = dados[insumo_id]
+        resultado['linhas'].append(LinhaABC(
+            posicao, lojas.get(loja_id, ''), nome, categoria, sigla, float(quantidade[n]),
+            float(custo_unitario[n]), float(custo[n]), float(participacao[posicao - 1] * 100),
+            float(acumulado[posicao - 1] * 100), classe, insumo_id))
+    
+    for classe, _ in LIMITES_ABC:
+        da_classe = classes == classe
+        resultado['resumo'][classe] = {
+            'itens': int(da_classe.sum()), 'custo': float(custo[usados][da_classe].sum()),
+            'itens_pct': float(da_classe.mean() * 100), 'custo_pct': float(participacao[da_classe].sum() * 100),
+        }
+    # Curva de Pareto (% dos itens x % do custo) com no máximo PONTOS_CURVA_ABC pontos
+    pontos = np.unique(np.linspace(0, len(usados) - 1, min(len(usados), PONTOS_CURVA_ABC)).astype(np.intp))
+    resultado['curva'] = [[0.0, 0.0]] + [[float((p + 1) / len(usados) * 100), float(acumulado[p] * 100)]
+                                         for p in pontos.tolist()]
+    resultado['custo_total'] = float(total)
+    return resultado
+
+def ler_peso_abc():
+    peso = request.args.get('peso', 'cardapio')
+    return peso if peso in PESOS_ABC else 'cardapio'
+
+@app.route('/curva-abc', methods=['GET', 'POST'])
+@login_required
+def curva_abc_insumos():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio, fim = periodo_filtro()
+    peso = ler_peso_abc()
+    todas_lojas = request.values.get('lojas') == 'todas' and session.get('usuario_nome') == 'bpereira'
+    if todas_lojas:
+        loja_ids = [l for (l,) in db.session.query(Loja.id).order_by(Loja.id)]
+    else:
+        loja_ids = [usuario.loja_id]
+    nao_encontradas = []
+    
+    if request.method == 'POST':
+        arquivo = request.files.get('arquivo')
+        if not arquivo or not arquivo.filename:
+            flash("Selecione a planilha de porções planejadas.", "warning")
+            return redirect(url_for('curva_abc_insumos'))
+        try:
+            porcoes, nao_encontradas = ler_quantidades_csv(arquivo.stream, usuario.loja_id)
+        except (ValueError, csv.Error) as e:
+            flash(f"Planilha inválida: {e}", "danger")
+            return redirect(url_for('curva_abc_insumos'))
+        porcoes_por_loja, todas_lojas = {usuario.loja_id: porcoes}, False
+        origem = f"Porções planejadas na planilha {arquivo.filename}"
+    elif peso == 'vendas':
+        porcoes_por_loja = {l: vendas_por_ficha(l, inicio.date(), fim.date()) for l in loja_ids}
+        origem = f"Porções vendidas no PDV de {inicio.strftime('%d/%m/%Y')} a {fim.strftime('%d/%m/%Y')}"
+    elif peso == 'previsao':
+        dias = ler_dias_previsao()
+        porcoes_por_loja = {l: porcoes_previstas(l, ler_modelo_previsao(), dias) for l in loja_ids}
+        origem = f"Porções previstas para os próximos {dias} dias"
+    else:
+        porcoes_por_loja = dict.fromkeys(loja_ids)
+        origem = PESOS_ABC['cardapio']
+    
+    inicio_calculo = time.perf_counter()
+    analise = curva_abc(porcoes_por_loja)
+    segundos = time.perf_counter() - inicio_calculo
+    logger.info(f"Curva ABC ({usuario.username}): {len(porcoes_por_loja)} loja(s), "
+                f"{len(analise['linhas'])} insumos em {segundos:.3f}s")
+    
+    formato = request.values.get('formato')
+    if formato == 'csv':
+        return resposta_csv('curva_abc_insumos.csv', CABECALHO_ABC, formatar_br(analise['linhas'], CASAS_ABC))
+    if formato == 'xlsx':
+        return resposta_xlsx('curva_abc_insumos.xlsx', [('Curva ABC', CABECALHO_ABC, CASAS_ABC, analise['linhas'])])
+    
+    return render_template('curva_abc.html', analise=analise, origem=origem, peso=peso, pesos=PESOS_ABC,
+                           inicio=inicio, fim=fim, todas_lojas=todas_lojas, lojas=len(porcoes_por_loja),
+                           segundos=segundos, nao_encontradas=nao_encontradas[:50],
+                           limites={classe: limite * 100 for classe, limite in LIMITES_ABC})
+
+# ==============================================================================
+# REPRECIFICAÇÃO DO CARDÁPIO EM LOTE
+# ==============================================================================
+# O preço-alvo de cada ficha é o custo da porção dividido pelo CMV-alvo (o
+# mesmo preco_sugerido do EngineCalculo), calculado para todas de uma vez.
+# Com uma meta de CMV da loja, os preços-alvo sobem por igual até o CMV
+# ponderado pelas vendas do período chegar à meta. Depois vem o
+# arredondamento para cima até a terminação (ex.: ,90), e mudanças menores
+# que o passo mínimo são descartadas. As mudanças aceitas na prévia são
+# gravadas num único UPDATE com CASE por id, condicionado à versão lida na
+# prévia: fichas editadas nesse meio-tempo ficam de fora.
+LinhaPreco = namedtuple('LinhaPreco', 'ficha_id nome versao custo_porcao preco_atual cmv_atual cmv_alvo '
+                                      'preco_novo cmv_novo variacao peso alterar')
+TERMINACAO_PADRAO = 0.90
+PASSO_MINIMO_PADRAO = 0.50
+
+def arredondar_precos(precos, terminacao):
+    """Arredonda para cima até o próximo preço com os centavos de `terminacao` (None: centavos)"""
+    if terminacao is None:
+        return np.ceil(np.round(precos * 100, 6)) / 100
+    return np.ceil(precos - terminacao - 1e-9) + terminacao
+
+def simular_precos(usuario, terminacao=TERMINACAO_PADRAO, passo_minimo=PASSO_MINIMO_PADRAO,
+                   cmv_meta=None, pesos=None):
+    """Prévia da reprecificação das fichas visíveis ao usuário.
+
+    `pesos` é {ficha_id: porções vendidas} para o CMV ponderado; sem vendas,
+    todas as fichas pesam igual. Devolve (linhas, resumo).
+    """
+    versoes = dict(db.session.query(Ficha.id, Ficha.versao).filter(*filtros_loja(Ficha, usuario)))
+    metricas = EngineCalculo.processar_fichas(versoes)
+    ids = sorted(metricas, key=lambda f: metricas[f]['nome'].upper())
+    resumo = {'fichas': len(ids), 'alteradas': 0, 'cmv_atual': 0.0, 'cmv_novo': 0.0, 'fator_meta': 1.0,
+              'receita_atual': 0.0, 'receita_nova': 0.0, 'ponderado_por_vendas': bool(pesos)}
+    if not ids:
+        return [], resumo
+    
+    custo = np.array([metricas[f]['custo_porcao'] for f in ids], dtype=np.float64)
+    atual = np.array([metricas[f]['preco_venda'] for f in ids], dtype=np.float64)
+    alvo_cmv = np.array([metricas[f]['cmv_alvo'] for f in ids], dtype=np.float64)
+    peso = np.array([(pesos or {}).get(f, 0) or 0 for f in ids], dtype=np.float64) if pesos else np.ones(len(ids))
+    
+    # Sem custo ou sem CMV-alvo a ficha fica com o preço atual (mas entra na média)
+    calculavel = (custo > 0) & (alvo_cmv > 0)
+    alvo = np.where(calculavel, custo / np.where(alvo_cmv > 0, alvo_cmv, 1) * 100, atual)
+    if cmv_meta and peso.sum() > 0:
+        receita_alvo = (alvo * peso).sum()
+        cmv_ponderado = (custo * peso).sum() / receita_alvo * 100 if receita_alvo > 0 else 0.0
+        if cmv_ponderado > cmv_meta:
+            resumo['fator_meta'] = cmv_ponderado / cmv_meta
+            alvo = np.where(custo > 0, alvo * resumo['fator_meta'], alvo)
+    
+    novo = np.where(calculavel | (alvo != atual), arredondar_precos(alvo, terminacao), atual)
+    alterar = (np.abs(novo - atual) >= max(passo_minimo, 0.005)) & (novo > 0)
+    novo = np.where(alterar, novo, atual)
+    
+    def cmv(precos):
+        return np.where(precos > 0, custo / np.where(precos > 0, precos, 1) * 100, 0.0)
+    
+    cmv_atual, cmv_novo = cmv(atual), cmv(novo)
+    receita_atual, receita_nova = (atual * peso).sum(), (novo * peso).sum()
+    resumo.update({
+        'alteradas': int(alterar.sum()),
+        'cmv_atual': float((custo * peso).sum() / receita_atual * 100) if receita_atual > 0 else 0.0,
+        'cmv_novo': float((custo * peso).sum() / receita_nova * 100) if receita_nova > 0 else 0.0,
+        'receita_atual': float(receita_atual), 'receita_nova': float(receita_nova),
+    })
+    linhas = [LinhaPreco(f, metricas[f]['nome'], versoes[f], float(custo[n]), float(atual[n]),
+                         float(cmv_atual[n]), float(alvo_cmv[n]), float(novo[n]), float(cmv_novo[n]),
+                         float(novo[n] - atual[n]), float(peso[n]), bool(alterar[n]))
+              for n, f in enumerate(ids)]
+    return linhas, resumo
+
+def aplicar_precos(usuario, precos):
+    """Grava {ficha_id: (preço, versão lida)} em UPDATEs com CASE; devolve quantas fichas mudaram"""
+    alteradas = 0
+    for lote in em_lotes(precos):
+        resultado = db.session.execute(
+            update(Ficha)
+            .where(Ficha.id.in_(lote),
+                   Ficha.versao == case({f: precos[f][1] for f in lote}, value=Ficha.id),
+                   *filtros_loja(Ficha, usuario))
+            .values(preco_venda=case({f: precos[f][0] for f in lote}, value=Ficha.id),
+                    versao=Ficha.versao + 1)
+            .execution_options(synchronize_session=False))
+        alteradas += resultado.rowcount
+    return alteradas
+
+def ler_parametros_precos():
+    """Terminação, passo mínimo e meta de CMV do formulário; ValueError se inválidos"""
+    valores = request.values
+    terminacao = converter_decimal(valores.get('terminacao', numero_br(TERMINACAO_PADRAO)))
+    if terminacao is not None and not 0 <= terminacao < 1:
+        raise ValueError("a terminação deve estar entre 0,00 e 0,99")
+    passo_minimo = converter_decimal(valores.get('passo_minimo', numero_br(PASSO_MINIMO_PADRAO))) or 0.0
+    cmv_meta = converter_decimal(valores.get('cmv_meta'))
+    if cmv_meta is not None and not 0 < cmv_meta < 100:
+        raise ValueError("a meta de CMV deve estar entre 0 e 100%")
+    return terminacao, max(passo_minimo, 0.0), cmv_meta
+
+@app.route('/reprecificacao', methods=['GET', 'POST'])
+@login_required
+def reprecificacao():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    if request.method == 'POST':
+        try:
+            precos = {}
+            for ficha_id in request.form.getlist('aceitar', type=int):
+                preco = converter_decimal(request.form.get(f'preco_{ficha_id}'))
+                versao = request.form.get(f'versao_{ficha_id}', type=int)
+                if preco and preco > 0 and versao:
+                    precos[ficha_id] = (round(preco, 2), versao)
+        except ValueError as e:
+            flash(f"Preço inválido: {e}", "danger")
+            return redirect(url_for('reprecificacao'))
+        inicio = time.perf_counter()
+        alteradas = aplicar_precos(usuario, precos)
+        db.session.commit()
+        logger.info(f"Reprecificação ({usuario.username}): {alteradas}/{len(precos)} fichas "
+                    f"em {time.perf_counter() - inicio:.3f}s")
+        flash(f"{alteradas} preço(s) atualizado(s).", "success")
+        if alteradas < len(precos):
+            flash(f"{len(precos) - alteradas} ficha(s) foram alteradas por outro usuário depois da prévia "
+                  f"e ficaram de fora. Gere a prévia de novo para revê-las.", "warning")
+        return redirect(url_for('reprecificacao', **{k: v for k, v in request.args.items()}))
+    
+    inicio, fim = periodo_filtro()
+    try:
+        terminacao, passo_minimo, cmv_meta = ler_parametros_precos()
+    except ValueError as e:
+        flash(f"Parâmetros inválidos: {e}", "danger")
+        terminacao, passo_minimo, cmv_meta = TERMINACAO_PADRAO, PASSO_MINIMO_PADRAO, None
+    inicio_calculo = time.perf_counter()
+    pesos = vendas_por_ficha(usuario.loja_id, inicio.date(), fim.date())
+    linhas, resumo = simular_precos(usuario, terminacao, passo_minimo, cmv_meta, pesos)
+    segundos = time.perf_counter() - inicio_calculo
+    return render_template('reprecificacao.html', linhas=linhas, resumo=resumo, segundos=segundos,
+                           terminacao=terminacao, passo_minimo=passo_minimo, cmv_meta=cmv_meta,
+                           inicio=inicio, fim=fim)
+
+# ==============================================================================
+# REAJUSTE DE PREÇOS DE INSUMOS EM LOTE (POR CATEGORIA OU FORNECEDOR)
+# ==============================================================================
+# "+8% em todos os laticínios" vira um único UPDATE sobre preco_embalagem e
+# custo_unitario dos insumos do critério (categoria e/ou CNPJ do fornecedor,
+# menos os desmarcados na prévia). Na mesma transação as fichas que usam
+# esses insumos, direto ou por bases, são recalculadas antes e depois para
+# apontar as que cruzaram o CMV-alvo. A prévia executa o mesmo UPDATE e
+# desfaz a transação no final; a aplicação só grava se o conjunto de insumos
+# ainda tiver a assinatura (quantidade, soma das versões, maior id) da prévia,
+# o que também impede aplicar o mesmo reajuste duas vezes.
+LinhaReajuste = namedtuple('LinhaReajuste', 'id nome categoria preco_antes preco_depois custo_antes custo_depois')
+FichaCruzouCmv = namedtuple('FichaCruzouCmv', 'ficha_id nome cmv_alvo cmv_antes cmv_depois')
+
+def filtros_reajuste(usuario, categoria_id=None, cnpj=None, excluidos=()):
+    """Critérios dos insumos a reajustar; ValueError sem categoria nem fornecedor"""
+    if not categoria_id and not cnpj:
+        raise ValueError("escolha uma categoria ou um fornecedor")
+    filtros = filtros_loja(Insumo, usuario)
+    if categoria_id:
+        filtros.append(Insumo.categoria_id == categoria_id)
+    if cnpj:
+        filtros.append(Insumo.id.in_(select(FornecedorProduto.insumo_id)
+                                     .where(FornecedorProduto.loja_id == usuario.loja_id,
+                                            FornecedorProduto.cnpj == cnpj,
+                                            FornecedorProduto.origem != 'SUGERIDO')))
+    if excluidos:
+        filtros.append(Insumo.id.notin_(excluidos))
+    return filtros
+
+def assinatura_reajuste(filtros):
+    return '-'.join(str(v) for v in db.session.query(
+        func.count(Insumo.id), func.coalesce(func.sum(Insumo.versao), 0),
+        func.coalesce(func.max(Insumo.id), 0)).filter(*filtros).one())
+
+def reajustar_insumos(filtros, percentual=None, valor=None):
+    """Reajusta os insumos dos filtros num UPDATE só (sem commit).
+
+    `percentual` (ex.: 8 = +8%) ou `valor` (R$ somados ao preço da embalagem).
+    Devolve (linhas, fichas que cruzaram o CMV-alvo, resumo).
+    """
+    antes = {l[0]: l for l in db.session.query(Insumo.id, Insumo.nome, Categoria.nome,
+                                               Insumo.preco_embalagem, Insumo.custo_unitario)
+             .outerjoin(Categoria, Insumo.categoria_id == Categoria.id).filter(*filtros)}
+    resumo = {'insumos': len(antes), 'bases': 0, 'fichas': 0, 'acima_antes': 0, 'acima_depois': 0}
+    if not antes:
+        return [], [], resumo
+    
+    base_ids, ficha_ids = fichas_afetadas(antes)
+    cmv_antes = guardar_cmv_anterior(ficha_ids)
+    
+    if percentual is not None:
+        preco = Insumo.preco_embalagem * (1 + percentual / 100.0)
+    else:
+        preco = func.coalesce(Insumo.preco_embalagem, 0.0) + valor
+    # round(x, 2) no PostgreSQL só existe para numeric: arredonda em numeric e volta para float
+    preco = case((preco < 0, 0.0), else_=cast(func.round(cast(preco, Numeric(14, 4)), 2), Float))
+    db.session.execute(
+        update(Insumo).where(*filtros)
+        .values(preco_embalagem=preco,
+                custo_unitario=case((Insumo.tamanho_embalagem > 0,
+                                     preco / Insumo.tamanho_embalagem * func.coalesce(Insumo.fator_correcao, 1.0)),
+                                    else_=Insumo.custo_unitario),
+                versao=Insumo.versao + 1)
+        .execution_options(synchronize_session=False))
+    
+    depois = {}
+    for lote in em_lotes(antes):
+        depois.update((id_, (preco_novo, custo_novo)) for id_, preco_novo, custo_novo in
+                      db.session.query(Insumo.id, Insumo.preco_embalagem, Insumo.custo_unitario)
+                      .filter(Insumo.id.in_(lote)))
+    linhas = sorted((LinhaReajuste(id_, nome, categoria, preco_antes or 0.0, depois[id_][0] or 0.0,
+                                   custo_antes or 0.0, depois[id_][1] or 0.0)
+                     for id_, nome, categoria, preco_antes, custo_antes in antes.values()),
+                    key=lambda l: l.nome)
+    
+    cmv_depois = EngineCalculo.processar_fichas(ficha_ids)
+    cruzaram = []
+    for ficha_id, m in cmv_depois.items():
+        alvo, cmv_anterior = m['cmv_alvo'], cmv_antes[ficha_id]['cmv_real']
+        if not alvo:
+            continue
+        resumo['acima_antes'] += cmv_anterior > alvo
+        resumo['acima_depois'] += m['cmv_real'] > alvo
+        if (cmv_anterior > alvo) != (m['cmv_real'] > alvo):
+            cruzaram.append(FichaCruzouCmv(ficha_id, m['nome'], alvo, cmv_anterior, m['cmv_real']))
+    cruzaram.sort(key=lambda f: (f.cmv_depois <= f.cmv_alvo, f.nome.upper()))
+    resumo.update({'bases': len(base_ids), 'fichas': len(ficha_ids)})
+    return linhas, cruzaram, resumo
+
+def ler_reajuste():
+    """Critério e ajuste do formulário: (categoria_id, cnpj, percentual, valor); ValueError se inválido"""
+    valores = request.values
+    categoria_id = valores.get('categoria_id', type=int)
+    cnpj = ''.join(c for c in valores.get('cnpj', '') if c.isdigit()) or None
+    quantidade = converter_decimal(valores.get('ajuste'))
+    if not quantidade:
+        raise ValueError("informe o reajuste")
+    if valores.get('tipo', 'percentual') == 'percentual':
+        if quantidade <= -100:
+            raise ValueError("o percentual deve ser maior que -100%")
+        return categoria_id, cnpj, quantidade, None
+    return categoria_id, cnpj, None, quantidade
+
+def fornecedores_loja(loja_id):
+    """(CNPJ, nome do emitente) dos fornecedores com produtos vinculados a insumos"""
+    return (db.session.query(FornecedorProduto.cnpj, func.max(NotaFiscal.emitente))
+            .outerjoin(NotaFiscal, and_(NotaFiscal.loja_id == FornecedorProduto.loja_id,
+                                        NotaFiscal.cnpj_emitente == FornecedorProduto.cnpj))
+            .filter(FornecedorProduto.loja_id == loja_id)
+            .group_by(FornecedorProduto.cnpj).order_by(func.max(NotaFiscal.emitente)).all())
+
+@app.route('/insumos/reajuste', methods=['GET', 'POST'])
+@login_required
+def reajuste_insumos():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    contexto = {'categorias': escopo_loja(Categoria, usuario).order_by(Categoria.nome).all(),
+                'fornecedores': fornecedores_loja(usuario.loja_id),
+                'linhas': [], 'cruzaram': [], 'resumo': None, 'assinatura': None, 'segundos': 0.0}
+    if not request.values.get('ajuste'):
+        return render_template('insumos_reajuste.html', **contexto)
+    
+    try:
+        categoria_id, cnpj, percentual, valor = ler_reajuste()
+        criterio = filtros_reajuste(usuario, categoria_id, cnpj)
+        excluidos = request.form.getlist('excluir', type=int) if request.method == 'POST' else []
+        filtros = filtros_reajuste(usuario, categoria_id, cnpj, excluidos)
+    except ValueError as e:
+        flash(f"Reajuste inválido: {e}", "danger")
+        return render_template('insumos_reajuste.html', **contexto)
+    
+    inicio = time.perf_counter()
+    if request.method == 'POST':
+        if request.form.get('assinatura') != assinatura_reajuste(criterio):
+            flash("Os insumos foram alterados depois da prévia. Confira a prévia de novo antes de aplicar.", "warning")
+            return redirect(url_for('reajuste_insumos', **{k: v for k, v in request.form.items()
+                                                           if k in ('categoria_id', 'cnpj', 'tipo', 'ajuste')}))
+        try:
+            linhas, cruzaram, resumo = reajustar_insumos(filtros, percentual, valor)
+            db.session.commit()
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            flash(f"Erro no reajuste: {e}", "danger")
+            return render_template('insumos_reajuste.html', **contexto)
+        logger.info(f"Reajuste de insumos ({usuario.username}): {resumo['insumos']} insumos, "
+                    f"{resumo['fichas']} fichas em {time.perf_counter() - inicio:.3f}s")
+        flash(f"{resumo['insumos']} insumo(s) reajustado(s); {resumo['bases']} base(s) e "
+              f"{resumo['fichas']} ficha(s) recalculadas.", "success")
+        contexto.update(aplicado=True)
+    else:
+        assinatura = assinatura_reajuste(criterio)
+        try:
+            linhas, cruzaram, resumo = reajustar_insumos(filtros, percentual, valor)
+        except SQLAlchemyError as e:
+            logger.error(f"Erro na prévia do reajuste: {e}")
+            flash(f"Erro na prévia do reajuste: {e}", "danger")
+            return render_template('insumos_reajuste.html', **contexto)
+        finally:
+            db.session.rollback()
+        contexto.update(assinatura=assinatura)
+    
+    contexto.update(linhas=linhas, cruzaram=cruzaram, resumo=resumo, segundos=time.perf_counter() - inicio)
+    return render_template('insumos_reajuste.html', **contexto)
+
+# ==============================================================================
+# BUSCA DE INSUMOS E BASES (TYPEAHEAD DOS FORMULÁRIOS)
+# ==============================================================================
+# Os formulários de ficha e de base buscam os itens enquanto o usuário digita,
+# em vez de trazer o catálogo inteiro em cada <select>. Cada loja tem um
+# índice em memória por tipo: trigramas das palavras (para trechos com 3+
+# letras) e a lista ordenada das palavras (para prefixos curtos, via bisect),
+# sobre os nomes normalizados sem acento. O índice é refeito quando muda a
+# quantidade, a soma das versões ou o maior id dos cadastros da loja.
+LIMITE_BUSCA = 20
+
+ItemBusca = namedtuple('ItemBusca', 'id nome unidade user_id chave')
+
+def _trigramas(palavra):
+    return {palavra[i:i + 3] for i in range(len(palavra) - 2)}
+
+class IndiceBusca:
+    def __init__(self, itens):
+        self.itens = {item.id: item for item in itens}
+        self.trigramas = defaultdict(set)
+        palavras = set()
+        for item in itens:
+            for palavra in item.chave.split():
+                palavras.add((palavra, item.id))
+                for trigrama in _trigramas(palavra):
+                    self.trigramas[trigrama].add(item.id)
+        self.palavras = sorted(palavras)
+    
+    def _com_prefixo(self, prefixo):
+        inicio = bisect.bisect_left(self.palavras, (prefixo,))
+        ids = set()
+        for palavra, id_ in itertools.islice(self.palavras, inicio, None):
+            if not palavra.startswith(prefixo):
+                break
+            ids.add(id_)
+        return ids
+    
+    def _com_trecho(self, trecho):
+        grupos = sorted((self.trigramas.get(t, set()) for t in _trigramas(trecho)), key=len)
+        ids = set(grupos[0]).intersection(*grupos[1:]) if grupos else set()
+        return {id_ for id_ in ids if trecho in self.itens[id_].chave}
+    
+    def buscar(self, texto, limite=LIMITE_BUSCA, user_id=None):
+        """Itens cujo nome tem todas as palavras digitadas (prefixo ou trecho), os que começam pelo texto primeiro"""
+        chave = normalizar_nome(texto)
+        termos = chave.split()
+        if not termos:
+            return []
+        ids = None
+        for termo in sorted(termos, key=len, reverse=True):
+            achados = self._com_trecho(termo) if len(termo) >= 3 else self._com_prefixo(termo)
+            ids = achados if ids is None else ids & achados
+            if not ids:
+                return []
+        itens = [self.itens[id_] for id_ in ids if user_id is None or self.itens[id_].user_id == user_id]
+        itens.sort(key=lambda i: (not i.chave.startswith(chave),
+                                  not any(p.startswith(termos[0]) for p in i.chave.split()), i.chave))
+        return itens[:limite]
+
+# Um índice por (tipo, loja); só os INDICES_BUSCA_EM_CACHE usados mais
+# recentemente ficam em memória.
+INDICES_BUSCA_EM_CACHE = int(os.environ.get('INDICES_BUSCA_EM_CACHE', 32))
+_INDICES_BUSCA = OrderedDict()
+_TRAVA_BUSCA = threading.Lock()
+
+def indice_busca(tipo, loja_id):
+    """IndiceBusca de insumos ou bases da loja, remontado só quando o cadastro muda"""
+    modelo = Insumo if tipo == 'insumo' else Base
+    assinatura = tuple(db.session.query(func.count(modelo.id), func.coalesce(func.sum(modelo.versao), 0),
+                                        func.coalesce(func.max(modelo.id), 0))
+                       .filter(modelo.loja_id == loja_id).one())
+    with _TRAVA_BUSCA:
+        guardado = _INDICES_BUSCA.get((tipo, loja_id))
+        if guardado and guardado[0] == assinatura:
+            _INDICES_BUSCA.move_to_end((tipo, loja_id))
+            return guardado[1]
+    if tipo == 'insumo':
+        linhas = (db.session.query(Insumo.id, Insumo.nome, Unidade.sigla, Insumo.user_id)
+                  .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                  .filter(Insumo.loja_id == loja_id))
+    else:
+        linhas = ((id_, nome, None, user_id) for id_, nome, user_id in
+                  db.session.query(Base.id, Base.nome, Base.user_id).filter(Base.loja_id == loja_id))
+    indice = IndiceBusca([ItemBusca(id_, nome, sigla, user_id, normalizar_nome(nome))
+                          for id_, nome, sigla, user_id in linhas])
+    with _TRAVA_BUSCA:
+        _INDICES_BUSCA[(tipo, loja_id)] = (assinatura, indice)
+        _INDICES_BUSCA.move_to_end((tipo, loja_id))
+        while len(_INDICES_BUSCA) > INDICES_BUSCA_EM_CACHE:
+            _INDICES_BUSCA.popitem(last=False)
+    return indice
+
+def nomes_itens_receita(itens):
+    """{(tipo, id): nome exibido} dos itens já gravados numa ficha ou base, para preencher a busca"""
+    refs = defaultdict(set)
+    for tipo, ref in itens:
+        refs[tipo].add(ref)
+    nomes = {}
+    for lote in em_lotes(refs['insumo']):
+        for id_, nome, sigla in (db.session.query(Insumo.id, Insumo.nome, Unidade.sigla)
+                                 .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                                 .filter(Insumo.id.in_(lote))):
+            nomes[('insumo', id_)] = f"{nome} ({sigla})" if sigla else nome
+    for lote in em_lotes(refs['base']):
+        nomes.update((('base', id_), nome) for id_, nome in
+                     db.session.query(Base.id, Base.nome).filter(Base.id.in_(lote)))
+    return nomes
+
+@app.route('/busca/<string:tipo>')
+@login_required
+def buscar_itens(tipo):
+    if tipo not in ('insumo', 'base'):
+        return jsonify({'erro': 'tipo inválido'}), 404
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    limite = min(request.args.get('limite', LIMITE_BUSCA, type=int), 100)
+    itens = indice_busca(tipo, usuario.loja_id).buscar(
+        request.args.get('q', ''), limite, None if eh_admin(usuario) else usuario.id)
+    return jsonify([{'id': i.id, 'nome': i.nome, 'unidade': i.unidade} for i in itens])
+
+# ==============================================================================
+# ROTAS DE BASES
+# ==============================================================================
+@app.route('/bases', methods=['GET', 'POST'])
+@login_required
+def bases():
+    if request.method == 'POST':
+        return nova_base()
+    
+    uid = session['usuario_id']
+    usuario = db.session.get(Usuario, uid)
+    
+    lista = listar_bases_resumo(*filtros_loja(Base, usuario))
+    
+    return render_template('bases.html', lista=lista)
+
+@app.route('/bases/nova', methods=['GET', 'POST'])
+@login_required
+def nova_base():
+    uid = session['usuario_id']
+    usuario = db.session.get(Usuario, uid)
+    if request.method == 'POST':
+        try:
+            nome_base = request.form.get('nome')
+            if not nome_base:
+                flash("Nome da base Ã© obrigatÃ³rio!", "warning")
+                return redirect(url_for('bases'))
 
             rend_val = float(request.form.get('rendimento', '1').replace(',', '.') or 1)
             
@@ -1600,8 +4930,7 @@ def nova_base():
             logger.error(f"Erro ao salvar base: {e}")
             flash(f"Erro ao criar base: {e}", "danger")
             
-    ins = Insumo.query.filter_by(user_id=uid).all()
-    return render_template('bases_form.html', insumos=ins, base=None)
+    return render_template('bases_form.html', base=None, nomes={})
 
 @app.route('/bases/editar/<int:id>', methods=['GET', 'POST'])
 @login_required
@@ -1614,14 +4943,18 @@ def editar_base(id):
         flash("Base nÃ£o encontrada.", "danger")
         return redirect(url_for('bases'))
     
-    if usuario.username != 'bpereira' and base_obj.user_id != uid:
+    if not acesso_loja(base_obj, usuario):
         flash("Acesso negado.", "danger")
         return redirect(url_for('bases'))
 
     if request.method == 'POST':
+        nome_atual = base_obj.nome
+        if not versao_confere(base_obj):
+            return conflito_edicao('base', nome_atual, url_for('editar_base', id=id))
         try:
             base_obj.nome = request.form.get('nome').upper()
             base_obj.rendimento_final = float(request.form.get('rendimento').replace(',', '.') or 1)
+            travar_versao(base_obj)
             BaseItem.query.filter_by(base_id=id).delete()
             
             ids = request.form.getlist('insumo_id[]')
@@ -1635,12 +4968,14 @@ def editar_base(id):
             db.session.commit()
             flash("Base atualizada com sucesso!", "success")
             return redirect(url_for('bases'))
+        except StaleDataError:
+            return conflito_edicao('base', nome_atual, url_for('editar_base', id=id))
         except Exception as e:
             db.session.rollback()
             flash(f"Erro ao editar base: {e}", "danger")
             
-    ins = Insumo.query.filter_by(user_id=uid).all()
-    return render_template('bases_form.html', base=base_obj, insumos=ins)
+    return render_template('bases_form.html', base=base_obj,
+                           nomes=nomes_itens_receita(('insumo', i.insumo_id) for i in base_obj.itens))
 
 @app.route('/del/bas/<int:id>')
 @login_required
@@ -1655,6 +4990,7 @@ def deletar_base_alias(id):
 @login_required
 def nova_ficha():
     uid = session['usuario_id']
+    usuario = db.session.get(Usuario, uid)
     if request.method == 'POST':
         try:
             f = Ficha(
@@ -1665,8 +5001,11 @@ def nova_ficha():
                 cmv_alvo=float(request.form.get('cmv_alvo').replace(',', '.') or 30),
                 loja_id=session.get('loja_id')
             )
+            codigo_pdv = codigo_pdv_formulario(usuario)
             db.session.add(f)
             db.session.flush()
+            if codigo_pdv:
+                vincular_codigo_pdv(usuario, f, codigo_pdv)
             
             i_ids = request.form.getlist('insumo_id[]')
             i_qtds = request.form.getlist('insumo_qtd[]')
@@ -1699,13 +5038,11 @@ def nova_ficha():
             db.session.rollback()
             flash(f"Erro ao salvar ficha: {e}", "danger")
             
-    return render_template('ficha_form.html', 
-                         insumos=Insumo.query.filter_by(user_id=uid).all(), 
-                         bases=Base.query.filter_by(user_id=uid).all(), 
-                         ficha=None)
+    return render_template('ficha_form.html', ficha=None, nomes={})
 
 @app.route('/fichas/ver/<int:id>')
 @login_required
+@condicional_por_loja(lambda id: select(Ficha.loja_id).where(Ficha.id == id).scalar_subquery())
 def ver_ficha(id):
     f = db.session.get(Ficha, id)
     uid = session['usuario_id']
@@ -1715,7 +5052,7 @@ def ver_ficha(id):
         flash("Ficha nÃ£o encontrada.", "warning")
         return redirect(url_for('index'))
     
-    if usuario.username != 'bpereira' and f.user_id != uid:
+    if not acesso_loja(f, usuario):
         flash("Acesso negado.", "warning")
         return redirect(url_for('index'))
     
@@ -1733,16 +5070,25 @@ def editar_ficha(id):
         flash("Ficha nÃ£o encontrada.", "danger")
         return redirect(url_for('index'))
     
-    if usuario.username != 'bpereira' and f.user_id != uid:
+    if not acesso_loja(f, usuario):
         flash("Acesso negado.", "danger")
         return redirect(url_for('index'))
 
     if request.method == 'POST':
+        nome_atual = f.nome
+        if not versao_confere(f):
+            return conflito_edicao('ficha', nome_atual, url_for('editar_ficha', id=id))
         try:
             f.nome = request.form.get('nome').upper()
             f.porcoes = float(request.form.get('porcoes').replace(',', '.'))
             f.preco_venda = float(request.form.get('preco_venda').replace(',', '.'))
             f.cmv_alvo = float(request.form.get('cmv_alvo').replace(',', '.'))
+            codigo_pdv = codigo_pdv_formulario(usuario, f.id)
+            if codigo_pdv and codigo_pdv != f.codigo_pdv:
+                vincular_codigo_pdv(usuario, f, codigo_pdv)
+            else:
+                f.codigo_pdv = codigo_pdv
+            travar_versao(f)
             FichaItem.query.filter_by(ficha_id=id).delete()
             
             i_ids = request.form.getlist('insumo_id[]')
@@ -1772,14 +5118,273 @@ def editar_ficha(id):
             db.session.commit()
             flash("Ficha TÃ©cnica atualizada com sucesso!", "info")
             return redirect(url_for('index'))
+        except StaleDataError:
+            return conflito_edicao('ficha', nome_atual, url_for('editar_ficha', id=id))
         except Exception as e:
             db.session.rollback()
             flash(f"Erro ao atualizar ficha: {e}", "danger")
             
-    return render_template('ficha_form.html', 
-                         ficha=f, 
-                         insumos=Insumo.query.filter_by(user_id=uid).all(), 
-                         bases=Base.query.filter_by(user_id=uid).all())
+    return render_template('ficha_form.html', ficha=f,
+                           nomes=nomes_itens_receita((i.tipo_item, i.referencia_id) for i in f.itens))
+
+# ==============================================================================
+# ONDE É USADO (ÍNDICE REVERSO DE INSUMOS E BASES)
+# ==============================================================================
+# O índice reverso insumo -> bases -> fichas e base -> fichas são os índices
+# ix_base_itens_insumo e ix_ficha_itens_tipo_referencia, mantidos pelo próprio
+# banco a cada item gravado. As consultas abaixo são buscas nesses índices (sem
+# varrer os itens) e servem à tela, à API e à exclusão: um insumo ou base em
+# uso só é excluído com a exclusão em cascata, que o tira das receitas e
+# desfaz os vínculos com notas, fornecedores e estoque.
+UsoReceita = namedtuple('UsoReceita', 'id nome quantidade via')
+
+def onde_usado(tipo, ref_id, loja_id):
+    """Bases e fichas que usam o insumo (direto ou pela base) ou a base, e o histórico do insumo"""
+    bases = []
+    if tipo == 'insumo':
+        bases = [UsoReceita(*linha, None) for linha in
+                 db.session.query(Base.id, Base.nome, BaseItem.quantidade)
+                 .join(Base, BaseItem.base_id == Base.id)
+                 .filter(BaseItem.insumo_id == ref_id)
+                 .order_by(Base.nome)]
+    fichas = [UsoReceita(*linha, None) for linha in
+              db.session.query(Ficha.id, Ficha.nome, FichaItem.quantidade)
+              .join(Ficha, FichaItem.ficha_id == Ficha.id)
+              .filter(FichaItem.tipo_item == tipo, FichaItem.referencia_id == ref_id)]
+    nomes_base = {b.id: b.nome for b in bases}
+    for lote in em_lotes(nomes_base):
+        fichas.extend(UsoReceita(ficha_id, nome, quantidade, nomes_base[base_id])
+                      for ficha_id, nome, quantidade, base_id in
+                      db.session.query(Ficha.id, Ficha.nome, FichaItem.quantidade, FichaItem.referencia_id)
+                      .join(Ficha, FichaItem.ficha_id == Ficha.id)
+                      .filter(FichaItem.tipo_item == 'base', FichaItem.referencia_id.in_(lote)))
+    fichas.sort(key=lambda u: (u.nome.upper(), u.via or ''))
+    
+    historico = {}
+    if tipo == 'insumo':
+        historico = {
+            'movimentos': db.session.query(func.count(MovimentoEstoque.id))
+                          .filter(MovimentoEstoque.loja_id == loja_id, MovimentoEstoque.insumo_id == ref_id).scalar(),
+            'itens_nota': db.session.query(func.count(NotaFiscalItem.id))
+                          .filter(NotaFiscalItem.insumo_id == ref_id).scalar(),
+            'vinculos': db.session.query(func.count(FornecedorProduto.id))
+                        .filter(FornecedorProduto.insumo_id == ref_id).scalar(),
+        }
+    return {'bases': bases, 'fichas': fichas, 'historico': historico}
+
+def em_uso(uso):
+    return bool(uso['bases'] or uso['fichas'] or any(uso['historico'].values()))
+
+def remover_usos(tipo, obj, uso):
+    """Tira o insumo ou a base das receitas e desfaz os vínculos, antes da exclusão em cascata"""
+    FichaItem.query.filter(FichaItem.tipo_item == tipo, FichaItem.referencia_id == obj.id).delete(
+        synchronize_session=False)
+    if tipo == 'insumo':
+        BaseItem.query.filter(BaseItem.insumo_id == obj.id).delete(synchronize_session=False)
+        FornecedorProduto.query.filter(FornecedorProduto.insumo_id == obj.id).delete(synchronize_session=False)
+        # Os itens de nota voltam para a fila de vínculo; o razão do insumo sai junto com ele
+        NotaFiscalItem.query.filter(NotaFiscalItem.insumo_id == obj.id).update(
+            {'insumo_id': None, 'quantidade_insumo': None}, synchronize_session=False)
+        MovimentoEstoque.query.filter(MovimentoEstoque.loja_id == obj.loja_id,
+                                      MovimentoEstoque.insumo_id == obj.id).delete(synchronize_session=False)
+        SaldoEstoque.query.filter(SaldoEstoque.loja_id == obj.loja_id,
+                                  SaldoEstoque.insumo_id == obj.id).delete(synchronize_session=False)
+    nova_versao_receitas(uso)
+
+def nova_versao_receitas(uso):
+    """Receitas alteradas ganham versão nova (concorrência otimista e caches)"""
+    for modelo, ids in ((Ficha, {u.id for u in uso['fichas'] if u.via is None}), (Base, {u.id for u in uso['bases']})):
+        for lote in em_lotes(ids):
+            db.session.execute(update(modelo).where(modelo.id.in_(lote)).values(versao=modelo.versao + 1)
+                               .execution_options(synchronize_session=False))
+
+def item_onde_usado(tipo, id):
+    """Insumo ou base que o usuário pode acessar (ou None)"""
+    modelo = {'insumo': Insumo, 'base': Base}.get(tipo)
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    obj = db.session.get(modelo, id) if modelo else None
+    if not obj or not acesso_loja(obj, usuario):
+        return None
+    return obj
+
+@app.route('/onde-usado/<string:tipo>/<int:id>')
+@login_required
+def onde_usado_tela(tipo, id):
+    obj = item_onde_usado(tipo, id)
+    if not obj:
+        flash("Item não encontrado.", "danger")
+        return redirect(url_for('index'))
+    uso = onde_usado(tipo, id, obj.loja_id)
+    return render_template('onde_usado.html', tipo=tipo, obj=obj, uso=uso, em_uso=em_uso(uso),
+                           diretas=sum(1 for u in uso['fichas'] if u.via is None))
+
+@app.route('/onde-usado/<string:tipo>/<int:id>/dados')
+@login_required
+def onde_usado_dados(tipo, id):
+    obj = item_onde_usado(tipo, id)
+    if not obj:
+        return jsonify({'erro': 'item não encontrado'}), 404
+    uso = onde_usado(tipo, id, obj.loja_id)
+    return jsonify({
+        'tipo': tipo, 'id': obj.id, 'nome': obj.nome, 'em_uso': em_uso(uso),
+        'bases': [u._asdict() for u in uso['bases']],
+        'fichas': [u._asdict() for u in uso['fichas']],
+        'historico': uso['historico'],
+    })
+
+# ==============================================================================
+# INSUMOS DUPLICADOS (DETECÇÃO E UNIFICAÇÃO)
+# ==============================================================================
+# Os nomes são texto livre e o mesmo produto acaba cadastrado duas vezes
+# ("TOMATE ITALIANO" e "TOMATE  ITALIANO KG"). Os pares candidatos saem do
+# IndiceNomes: cada insumo só é comparado com os que têm alguma palavra pouco
+# frequente em comum ou exatamente as mesmas palavras, nunca com a loja
+# inteira. Palavras presentes em mais de LIMITE_BLOCO_DUPLICADOS insumos
+# ("QUEIJO", "MOLHO") não formam grupo sozinhas: compará-los entre si seria
+# quadrático de novo. A unificação
+# aponta as receitas, notas, vínculos e o razão de estoque do duplicado para o
+# insumo mantido e exclui o duplicado, tudo numa transação.
+SEMELHANCA_DUPLICADOS = 0.9
+LIMITE_BLOCO_DUPLICADOS = 100
+
+ItemDuplicado = namedtuple('ItemDuplicado', 'id nome unidade_id unidade custo_unitario versao usos')
+ParDuplicado = namedtuple('ParDuplicado', 'manter remover motivo semelhanca mesma_unidade')
+
+def usos_por_insumo(insumo_ids):
+    """Quantidade de bases e fichas que usam cada insumo diretamente"""
+    usos = Counter()
+    for lote in em_lotes(insumo_ids):
+        usos.update(dict(db.session.query(BaseItem.insumo_id, func.count(BaseItem.id))
+                         .filter(BaseItem.insumo_id.in_(lote)).group_by(BaseItem.insumo_id)))
+        usos.update(dict(db.session.query(FichaItem.referencia_id, func.count(FichaItem.id))
+                         .filter(FichaItem.tipo_item == 'insumo', FichaItem.referencia_id.in_(lote))
+                         .group_by(FichaItem.referencia_id)))
+    return usos
+
+def insumos_duplicados(usuario, minimo=SEMELHANCA_DUPLICADOS):
+    """Pares de insumos da loja com nomes iguais ou quase iguais, do mais parecido ao menos"""
+    linhas = (db.session.query(Insumo.id, Insumo.nome, Insumo.unidade_id, Unidade.sigla,
+                               Insumo.custo_unitario, Insumo.versao)
+              .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+              .filter(*filtros_loja(Insumo, usuario)).all())
+    indice = IndiceNomes((l.id, l.nome) for l in linhas)
+    mesmas_palavras = defaultdict(set)
+    for id_, chave in indice.nomes.items():
+        mesmas_palavras[frozenset(indice.palavras[id_]) or chave].add(id_)
+    
+    encontrados = []
+    for id_, chave in indice.nomes.items():
+        candidatos = set(mesmas_palavras[frozenset(indice.palavras[id_]) or chave])
+        for palavra in indice.palavras[id_]:
+            if len(indice.por_palavra[palavra]) <= LIMITE_BLOCO_DUPLICADOS:
+                candidatos.update(indice.por_palavra[palavra])
+        for outro in candidatos:
+            if outro <= id_:
+                continue
+            chave_outro = indice.nomes[outro]
+            if chave == chave_outro:
+                encontrados.append((id_, outro, 'MESMO NOME', 1.0))
+                continue
+            if indice.palavras[id_] and indice.palavras[id_] == indice.palavras[outro]:
+                encontrados.append((id_, outro, 'MESMAS PALAVRAS',
+                                    SequenceMatcher(None, chave, chave_outro).ratio()))
+                continue
+            # Os limites superiores do difflib descartam a maioria dos pares sem o cálculo completo
+            comparador = SequenceMatcher(None, chave, chave_outro)
+            if comparador.real_quick_ratio() < minimo or comparador.quick_ratio() < minimo:
+                continue
+            semelhanca = comparador.ratio()
+            if semelhanca >= minimo:
+                encontrados.append((id_, outro, 'SEMELHANTE', semelhanca))
+    
+    dados = {l.id: l for l in linhas}
+    usos = usos_por_insumo({i for par in encontrados for i in par[:2]})
+    pares = []
+    for a, b, motivo, semelhanca in encontrados:
+        itens = [ItemDuplicado(*dados[i], usos[i]) for i in (a, b)]
+        # Sugestão: fica o mais usado nas receitas; no empate, o cadastro mais antigo
+        manter, remover = sorted(itens, key=lambda i: (-i.usos, i.id))
+        pares.append(ParDuplicado(manter, remover, motivo, semelhanca,
+                                  manter.unidade_id == remover.unidade_id))
+    pares.sort(key=lambda p: (-p.semelhanca, p.manter.nome, p.remover.nome))
+    return pares
+
+def unificar_insumos(manter, remover):
+    """Aponta tudo o que usa `remover` para `manter` e exclui `remover` (sem commit).
+
+    Devolve o uso do duplicado antes da unificação (bases e fichas alteradas).
+    """
+    if manter.id == remover.id or manter.loja_id != remover.loja_id:
+        raise ValueError("Escolha dois insumos diferentes da mesma loja.")
+    if manter.unidade_id != remover.unidade_id:
+        raise ValueError("Os insumos têm unidades diferentes; as quantidades das receitas não seriam equivalentes.")
+    
+    uso = onde_usado('insumo', remover.id, remover.loja_id)
+    BaseItem.query.filter(BaseItem.insumo_id == remover.id).update(
+        {'insumo_id': manter.id}, synchronize_session=False)
+    FichaItem.query.filter(FichaItem.tipo_item == 'insumo', FichaItem.referencia_id == remover.id).update(
+        {'referencia_id': manter.id}, synchronize_session=False)
+    FornecedorProduto.query.filter(FornecedorProduto.insumo_id == remover.id).update(
+        {'insumo_id': manter.id}, synchronize_session=False)
+    NotaFiscalItem.query.filter(NotaFiscalItem.insumo_id == remover.id).update(
+        {'insumo_id': manter.id}, synchronize_session=False)
+    MovimentoEstoque.query.filter(MovimentoEstoque.loja_id == remover.loja_id,
+                                  MovimentoEstoque.insumo_id == remover.id).update(
+        {'insumo_id': manter.id}, synchronize_session=False)
+    # As fotos de saldo dos dois deixam de valer; o saldo volta a sair do razão unificado
+    SaldoEstoque.query.filter(SaldoEstoque.loja_id == remover.loja_id,
+                              SaldoEstoque.insumo_id.in_([manter.id, remover.id])).delete(synchronize_session=False)
+    nova_versao_receitas(uso)
+    db.session.delete(remover)
+    db.session.flush()
+    return uso
+
+@app.route('/insumos/duplicados')
+@login_required
+def insumos_duplicados_tela():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio = time.time()
+    pares = insumos_duplicados(usuario)
+    return render_template('insumos_duplicados.html', pares=pares, segundos=time.time() - inicio,
+                           total=escopo_loja(Insumo, usuario).count())
+
+@app.route('/insumos/duplicados/unificar', methods=['POST'])
+@login_required
+def unificar_insumos_tela():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    ids = {campo: request.form.get(campo, type=int) for campo in ('manter', 'remover')}
+    itens = {campo: escopo_loja(Insumo, usuario).filter(Insumo.id == id_).first() if id_ else None
+             for campo, id_ in ids.items()}
+    if not all(itens.values()):
+        flash("Insumo não encontrado; a lista de duplicados foi atualizada.", "warning")
+        return redirect(url_for('insumos_duplicados_tela'))
+    
+    manter, remover = itens['manter'], itens['remover']
+    if any(request.form.get(f'versao_{campo}', type=int) not in (None, obj.versao)
+           for campo, obj in itens.items()):
+        flash(f"{manter.nome} ou {remover.nome} foi alterado por outra pessoa. Confira o par novamente.", "warning")
+        return redirect(url_for('insumos_duplicados_tela'))
+    
+    nome_removido = remover.nome
+    try:
+        uso = unificar_insumos(manter, remover)
+        db.session.commit()
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), "danger")
+        return redirect(url_for('insumos_duplicados_tela'))
+    except StaleDataError:
+        db.session.rollback()
+        flash(f"{nome_removido} foi alterado por outra pessoa. Confira o par novamente.", "warning")
+        return redirect(url_for('insumos_duplicados_tela'))
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f"Erro ao unificar: {e}", "danger")
+        return redirect(url_for('insumos_duplicados_tela'))
+    
+    flash(f"{nome_removido} unificado em {manter.nome}: {len(uso['bases'])} base(s) e "
+          f"{sum(1 for u in uso['fichas'] if u.via is None)} ficha(s) atualizadas.", "success")
+    return redirect(url_for('insumos_duplicados_tela'))
 
 # ==============================================================================
 # ROTA DE EXCLUSÃƒO
@@ -1814,10 +5419,18 @@ def excluir(alvo, id):
         return redirect(url_for('config_admin'))
         
     elif alvo in ['insumo', 'ficha', 'base', 'categoria', 'unidade']:
-        if usuario.username != 'bpereira' and hasattr(obj, 'user_id') and obj.user_id != uid:
+        if not acesso_loja(obj, usuario):
             flash("VocÃª nÃ£o tem permissÃ£o para excluir este item.", "danger")
             return redirect(url_for('index'))
     
+    uso = None
+    if alvo in ('insumo', 'base'):
+        uso = onde_usado(alvo, obj.id, obj.loja_id)
+        if em_uso(uso) and not request.args.get('cascata'):
+            flash(f"{alvo.capitalize()} '{obj.nome}' está em uso e não foi excluído. "
+                  f"Confira onde é usado antes de excluir em cascata.", "warning")
+            return redirect(url_for('onde_usado_tela', tipo=alvo, id=obj.id))
+    
     try:
         if alvo == 'usuario' and obj.username != 'bpereira':
             mensagem = f"""
@@ -1833,9 +5446,21 @@ def excluir(alvo, id):
             """
             enviar_alerta_email("ðŸ‘¤ UsuÃ¡rio ExcluÃ­do", mensagem)
         
+        if uso and em_uso(uso):
+            remover_usos(alvo, obj, uso)
+            logger.info(f"{alvo.capitalize()} {obj.id} excluído em cascata por {usuario.username}: "
+                        f"{len(uso['bases'])} base(s), {len(uso['fichas'])} uso(s) em fichas, {uso['historico']}")
+        aviso_vendas = None
+        if alvo == 'ficha':
+            dias_vendas = arquivar_vendas_ficha(obj)
+            if dias_vendas:
+                aviso_vendas = (f"{dias_vendas} dia(s) de vendas da ficha foram para os códigos do PDV "
+                                f"sem ficha ({codigo_vendas_arquivadas(obj)}).")
         db.session.delete(obj)
         db.session.commit()
         flash(f"{alvo.capitalize()} excluÃ­do com sucesso!", "success")
+        if aviso_vendas:
+            flash(aviso_vendas, "info")
     except Exception as e:
         db.session.rollback()
         flash(f"Erro ao excluir: {e}", "danger")
@@ -1849,6 +5474,893 @@ def excluir(alvo, id):
     else:
         return redirect(url_for(alvo + 's'))
 
+# ==============================================================================
+# EXPORTAÇÕES CSV EM STREAMING
+# ==============================================================================
+# As exportações leem o banco em lotes (yield_per usa cursor do lado do servidor
+# no PostgreSQL) e enviam o CSV à medida que as linhas são geradas, então a
+# memória fica constante e o download começa na hora, qualquer que seja o volume.
+LOTE_EXPORTACAO = 1000
+TAMANHO_BLOCO_CSV = 64 * 1024
+
+class _LinhaCSV:
+    """Destino do csv.writer que devolve a linha formatada em vez de gravá-la"""
+    def write(self, valor):
+        return valor
+
+def gerar_csv(cabecalho, linhas):
+    # Padrão brasileiro: ';' como separador e BOM para o Excel reconhecer UTF-8
+    escritor = csv.writer(_LinhaCSV(), delimiter=';')
+    bloco = ['\ufeff', escritor.writerow(cabecalho)]
+    tamanho = 0
+    for linha in linhas:
+        texto = escritor.writerow(linha)
+        bloco.append(texto)
+        tamanho += len(texto)
+        if tamanho >= TAMANHO_BLOCO_CSV:
+            yield ''.join(bloco)
+            bloco, tamanho = [], 0
+    if bloco:
+        yield ''.join(bloco)
+
+def resposta_csv(nome_arquivo, cabecalho, linhas):
+    return Response(stream_with_context(gerar_csv(cabecalho, linhas)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={nome_arquivo}'})
+
+def numero_br(valor, casas=2):
+    return f"{float(valor or 0):.{casas}f}".replace('.', ',')
+
+def data_br(valor, formato='%d/%m/%Y'):
+    return valor.strftime(formato) if valor else ''
+
+def ler_data_filtro(nome):
+    valor = request.args.get(nome, '').strip()
+    if not valor:
+        return None
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d')
+    except ValueError:
+        return None
+
+def periodo_filtro():
+    """Período dos filtros data_inicio/data_fim (padrão: últimos 30 dias)"""
+    fim = ler_data_filtro('data_fim') or datetime.now()
+    inicio = ler_data_filtro('data_inicio') or fim - timedelta(days=30)
+    return inicio, fim
+
+@app.route('/admin/logs/exportar')
+@login_required
+@admin_required
+def exportar_logs():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    inicio = ler_data_filtro('data_inicio')
+    fim = ler_data_filtro('data_fim')
+    
+    consulta = (db.session.query(LogAcesso.id, LogAcesso.data, Loja.nome, Usuario.username,
+                                 LogAcesso.ip, LogAcesso.fingerprint, LogAcesso.motivo)
+                .outerjoin(Loja, LogAcesso.loja_id == Loja.id)
+                .outerjoin(Usuario, LogAcesso.usuario_id == Usuario.id))
+    if usuario.username != 'bpereira':
+        consulta = consulta.filter(LogAcesso.loja_id == usuario.loja_id)
+    if inicio:
+        consulta = consulta.filter(LogAcesso.data >= inicio)
+    if fim:
+        consulta = consulta.filter(LogAcesso.data < fim + timedelta(days=1))
+    consulta = consulta.order_by(LogAcesso.data.desc())
+    
+    linhas = (
+        [id_, data_br(data, '%d/%m/%Y %H:%M:%S'), loja_nome or '', username or '', ip or '', fingerprint or '', motivo or '']
+        for id_, data, loja_nome, username, ip, fingerprint, motivo in consulta.yield_per(LOTE_EXPORTACAO)
+    )
+    
+    return resposta_csv('logs_acesso.csv',
+                        ['ID', 'Data', 'Loja', 'Usuário', 'IP', 'Fingerprint', 'Motivo'],
+                        linhas)
+
+def linhas_custo_insumos(usuario):
+    consulta = (db.session.query(Insumo.nome, Categoria.nome, Unidade.sigla, Insumo.preco_embalagem,
+                                 Insumo.tamanho_embalagem, Insumo.fator_correcao, Insumo.custo_unitario)
+                .outerjoin(Categoria, Insumo.categoria_id == Categoria.id)
+                .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                .filter(*filtros_loja(Insumo, usuario))
+                .order_by(Insumo.nome))
+    for nome, categoria, unidade, preco, tamanho, fc, custo in consulta.yield_per(LOTE_EXPORTACAO):
+        yield [nome, categoria or '', unidade or '', preco or 0, tamanho or 0, fc or 0, custo or 0]
+
+def linhas_custo_bases(usuario):
+    for _, nome, rendimento, custo in consulta_bases_resumo(*filtros_loja(Base, usuario)).yield_per(LOTE_EXPORTACAO):
+        custo = float(custo or 0)
+        yield [nome, rendimento or 0, custo, custo / rendimento if rendimento and rendimento > 0 else 0.0]
+
+def linhas_custo_fichas(usuario):
+    """Uma linha por item e uma linha de totais (com os indicadores) por ficha"""
+    # Bases são poucas; o custo por KG/L de cada uma é calculado uma vez só
+    bases = {b.id: b for b in listar_bases_resumo(*filtros_loja(Base, usuario, por_dono=False))}
+    
+    consulta = (db.session.query(Ficha.id, Ficha.nome, Ficha.porcoes, Ficha.preco_venda, Ficha.cmv_alvo,
+                                 FichaItem.tipo_item, FichaItem.referencia_id, FichaItem.quantidade,
+                                 Insumo.nome, Insumo.custo_unitario, Unidade.sigla)
+                .outerjoin(FichaItem, FichaItem.ficha_id == Ficha.id)
+                .outerjoin(Insumo, and_(FichaItem.tipo_item == 'insumo', FichaItem.referencia_id == Insumo.id))
+                .outerjoin(Unidade, Insumo.unidade_id == Unidade.id)
+                .filter(*filtros_loja(Ficha, usuario))
+                .order_by(Ficha.nome, Ficha.id, FichaItem.id))
+    
+    def linha_total(ficha, custo_total):
+        m = EngineCalculo.indicadores(custo_total, ficha[2], ficha[3], ficha[4])
+        return [ficha[1], ficha[2] or 0, ficha[3] or 0, ficha[4] or 0, 'TOTAL', '', None, '',
+                m['custo_porcao'], custo_total, m['cmv_real'], m['preco_sugerido'],
+                m['lucro_bruto'], m['margem_contribuicao']]
+    
+    atual, custo_total = None, 0.0
+    for (ficha_id, nome, porcoes, preco, cmv_alvo, tipo, ref_id, qtd,
+         ins_nome, ins_custo, sigla) in consulta.yield_per(LOTE_EXPORTACAO):
+        if atual and atual[0] != ficha_id:
+            yield linha_total(atual, custo_total)
+            custo_total = 0.0
+        atual = (ficha_id, nome, porcoes, preco, cmv_alvo)
+        if tipo is None:
+            continue
+        
+        if tipo == 'insumo':
+            item_nome = ins_nome or 'Desconhecido'
+            custo_un = ins_custo or 0
+            un = sigla or 'un'
+        else:
+            base = bases.get(ref_id)
+            item_nome = f"[BASE] {base.nome}" if base else 'Desconhecido'
+            custo_un = base.custo_por_kg_litro if base else 0
+            un = 'Base'
+        subtotal = (qtd or 0) * custo_un
+        custo_total += subtotal
+        yield [nome, porcoes or 0, preco or 0, cmv_alvo or 0, tipo.upper(), item_nome, qtd or 0, un,
+               custo_un, subtotal, None, None, None, None]
+    if atual:
+        yield linha_total(atual, custo_total)
+
+CABECALHO_INSUMOS = ['nome', 'categoria', 'unidade', 'preco', 'tamanho', 'fc', 'custo_unitario']
+CASAS_INSUMOS = [None, None, None, 2, 3, 3, 4]
+CABECALHO_BASES = ['Base', 'Rendimento (KG/L)', 'Custo Total', 'Custo por KG/L']
+CASAS_BASES = [None, 3, 4, 4]
+CABECALHO_FICHAS = ['Ficha', 'Porções', 'Preço Venda', 'CMV Alvo (%)', 'Tipo', 'Item', 'Quantidade',
+                    'Unidade', 'Custo Unit.', 'Subtotal', 'CMV Real (%)', 'Preço Sugerido',
+                    'Lucro Bruto', 'Margem (%)']
+CASAS_FICHAS = [None, 2, 2, 2, None, None, 3, None, 4, 4, 2, 2, 2, 2]
+
+def formatar_br(linhas, casas):
+    """Números no padrão brasileiro; `casas` é None nas colunas de texto"""
+    for linha in linhas:
+        yield [valor if c is None else ('' if valor is None else numero_br(valor, c))
+               for valor, c in zip(linha, casas)]
+
+@app.route('/insumos/exportar')
+@login_required
+def exportar_insumos():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    return resposta_csv('insumos.csv', CABECALHO_INSUMOS,
+                        formatar_br(linhas_custo_insumos(usuario), CASAS_INSUMOS))
+
+@app.route('/fichas/exportar')
+@login_required
+def exportar_fichas():
+    """Planilha de custos: uma linha por item e uma linha de totais por ficha"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    return resposta_csv('fichas_custos.csv', CABECALHO_FICHAS,
+                        formatar_br(linhas_custo_fichas(usuario), CASAS_FICHAS))
+
+# ==============================================================================
+# FICHAS TÉCNICAS EM PDF
+# ==============================================================================
+# A conversão HTML -> PDF é pesada e roda num pool de processos, fora dos
+# workers que atendem as requisições. Cada PDF fica em disco como
+# ficha_<id>_<versão dos dados>.pdf: enquanto a ficha e os insumos/bases que
+# ela usa não mudam, o arquivo é reaproveitado sem nova renderização.
+# No executável do PyInstaller cada processo do pool seria o próprio .exe de
+# novo; por isso lá o padrão é converter na thread (PDF_PROCESSOS=0) e, se o
+# pool for ligado, ele usa spawn junto com o freeze_support() do __main__.
+PASTA_CACHE_PDF = os.path.join(base_path, 'cache_pdf')
+EXECUTAVEL = getattr(sys, 'frozen', False)
+PROCESSOS_PDF = int(os.environ.get('PDF_PROCESSOS', 0 if EXECUTAVEL else min(4, os.cpu_count() or 1)))
+TEMPO_LIMITE_PDF = 120
+
+_pool_pdf = None
+_trava_pool_pdf = threading.Lock()
+
+def pool_pdf():
+    """Pool de processos criado sob demanda (None quando PDF_PROCESSOS=0)"""
+    global _pool_pdf
+    if PROCESSOS_PDF <= 0:
+        return None
+    with _trava_pool_pdf:
+        if _pool_pdf is None:
+            contexto = multiprocessing.get_context('spawn') if EXECUTAVEL else None
+            _pool_pdf = ProcessPoolExecutor(max_workers=PROCESSOS_PDF, mp_context=contexto)
+        return _pool_pdf
+
+def converter_pdf(html):
+    """Agenda a conversão no pool e devolve um Future com os bytes do PDF"""
+    global _pool_pdf
+    pool = pool_pdf()
+    if pool is None:
+        futuro = Future()
+        try:
+            futuro.set_result(html_para_pdf(html))
+        except Exception as e:
+            futuro.set_exception(e)
+        return futuro
+    try:
+        return pool.submit(html_para_pdf, html)
+    except BrokenProcessPool:
+        # Um processo do pool morreu (ex.: falta de memória): recria o pool
+        with _trava_pool_pdf:
+            if _pool_pdf is pool:
+                _pool_pdf = None
+        return pool_pdf().submit(html_para_pdf, html)
+
+def versoes_pdf_fichas(ficha_ids):
+    """Versão dos dados de cada ficha, usada como chave do cache de PDF.
+
+    Combina a versão da ficha com as dos insumos e bases que ela usa (e dos
+    insumos dessas bases) e a data do template; qualquer alteração gera outra chave.
+    """
+    fichas, itens = {}, defaultdict(list)
+    for lote in em_lotes(ficha_ids):
+        fichas.update(db.session.query(Ficha.id, Ficha.versao).filter(Ficha.id.in_(lote)))
+        for ficha_id, tipo, ref in (db.session.query(FichaItem.ficha_id, FichaItem.tipo_item, FichaItem.referencia_id)
+                                    .filter(FichaItem.ficha_id.in_(lote))):
+            itens[ficha_id].append((tipo, ref))
+    
+    base_ids = {ref for lista in itens.values() for tipo, ref in lista if tipo == 'base'}
+    bases, insumos_base = {}, defaultdict(list)
+    for lote in em_lotes(base_ids):
+        bases.update(db.session.query(Base.id, Base.versao).filter(Base.id.in_(lote)))
+        for base_id, insumo_id in db.session.query(BaseItem.base_id, BaseItem.insumo_id).filter(BaseItem.base_id.in_(lote)):
+            insumos_base[base_id].append(insumo_id)
+    
+    insumo_ids = {ref for lista in itens.values() for tipo, ref in lista if tipo == 'insumo'}
+    insumo_ids.update(i for lista in insumos_base.values() for i in lista)
+    insumos = {}
+    for lote in em_lotes(insumo_ids):
+        insumos.update(db.session.query(Insumo.id, Insumo.versao).filter(Insumo.id.in_(lote)))
+    
+    try:
+        template = os.path.getmtime(os.path.join(app.root_path, app.template_folder, 'pdf_template.html'))
+    except OSError:
+        template = 0
+    
+    versoes = {}
+    for ficha_id, versao in fichas.items():
+        partes = [template, versao]
+        for tipo, ref in sorted(itens[ficha_id]):
+            if tipo == 'base':
+                partes.append(('b', ref, bases.get(ref), sorted((i, insumos.get(i)) for i in insumos_base[ref])))
+            else:
+                partes.append(('i', ref, insumos.get(ref)))
+        versoes[ficha_id] = hashlib.sha1(repr(partes).encode()).hexdigest()[:16]
+    return versoes
+
+def html_ficha_pdf(ficha, metricas=None):
+    metricas = metricas or EngineCalculo.processar_ficha(ficha.id)
+    itens = [{'nome': d['nome'], 'qtd': d['qtd'], 'un': d['un'], 'custo_u': d['custo_un'], 'total': d['subtotal']}
+             for d in metricas['itens']]
+    # Direto pelo ambiente Jinja: o PDF não usa os context processors (usuário e
+    # loja da sessão), que custariam duas consultas por ficha no cardápio em zip
+    return app.jinja_env.get_template('pdf_template.html').render(f=ficha, itens=itens, c_total=metricas['custo_total'],
+                                                                  m=metricas)
+
+def caminho_pdf(ficha_id, versao):
+    return os.path.join(PASTA_CACHE_PDF, f"ficha_{ficha_id}_{versao}.pdf")
+
+def guardar_pdf(ficha_id, versao, dados):
+    os.makedirs(PASTA_CACHE_PDF, exist_ok=True)
+    destino = caminho_pdf(ficha_id, versao)
+    temporario = f"{destino}.{secrets.token_hex(4)}.tmp"
+    with open(temporario, 'wb') as arquivo:
+        arquivo.write(dados)
+    os.replace(temporario, destino)
+    
+    # PDFs de versões anteriores da mesma ficha não serão mais usados
+    for nome in os.listdir(PASTA_CACHE_PDF):
+        caminho = os.path.join(PASTA_CACHE_PDF, nome)
+        if nome.startswith(f"ficha_{ficha_id}_") and nome.endswith('.pdf') and caminho != destino:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+def nome_arquivo_pdf(ficha):
+    nome = ''.join(c if c.isalnum() else '_' for c in normalizar_nome(ficha.nome)).strip('_')
+    return f"{nome or 'FICHA'}.pdf"
+
+class ZipStream:
+    """Arquivo .zip montado em partes para ser enviado enquanto é gerado.
+
+    O zipfile grava num destino sem seek (usa data descriptors); depois de cada
+    entrada, `retirar` devolve os bytes já prontos para o cliente.
+    """
+    def __init__(self, compressao=zipfile.ZIP_DEFLATED):
+        self._partes = []
+        self._zip = zipfile.ZipFile(self, 'w', compression=compressao)
+    
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        return len(dados)
+    
+    def flush(self):
+        pass
+    
+    def retirar(self):
+        dados = b''.join(self._partes)
+        self._partes = []
+        return dados
+    
+    def _info(self, nome, compressao):
+        info = zipfile.ZipInfo(nome, date_time=time.localtime()[:6])
+        info.compress_type = self._zip.compression if compressao is None else compressao
+        return info
+    
+    def adicionar(self, nome, conteudo, compressao=None):
+        self._zip.writestr(self._info(nome, compressao), conteudo)
+        return self.retirar()
+    
+    def abrir(self, nome, compressao=None):
+        """Entrada gravada aos poucos (with ... as destino: destino.write(...))"""
+        return self._zip.open(self._info(nome, compressao), 'w')
+    
+    def fechar(self):
+        self._zip.close()
+        return self.retirar()
+
+@app.route('/fichas/pdf/<int:id>')
+@login_required
+def pdf_ficha(id):
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    ficha = escopo_loja(Ficha, usuario).filter(Ficha.id == id).first()
+    if not ficha:
+        flash("Ficha não encontrada.", "warning")
+        return redirect(url_for('index'))
+    
+    versao = versoes_pdf_fichas([ficha.id])[ficha.id]
+    caminho = caminho_pdf(ficha.id, versao)
+    if not os.path.exists(caminho):
+        try:
+            guardar_pdf(ficha.id, versao, converter_pdf(html_ficha_pdf(ficha)).result(timeout=TEMPO_LIMITE_PDF))
+        except ImportError:
+            flash("Geração de PDF indisponível: instale o pacote xhtml2pdf.", "danger")
+            return redirect(url_for('ver_ficha', id=id))
+        except Exception as e:
+            logger.error(f"Erro ao gerar PDF da ficha {ficha.id}: {e}")
+            flash(f"Erro ao gerar PDF: {e}", "danger")
+            return redirect(url_for('ver_ficha', id=id))
+    
+    return send_file(caminho, mimetype='application/pdf', download_name=nome_arquivo_pdf(ficha))
+
+@app.route('/fichas/pdf/cardapio.zip')
+@login_required
+def pdf_cardapio():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    fichas = escopo_loja(Ficha, usuario).order_by(Ficha.nome).all()
+    if not fichas:
+        flash("Nenhuma ficha cadastrada.", "warning")
+        return redirect(url_for('index'))
+    
+    versoes = versoes_pdf_fichas([f.id for f in fichas])
+    nomes, usados = {}, set()
+    for f in fichas:
+        nome = nome_arquivo_pdf(f)
+        if nome in usados:
+            nome = f"{nome[:-4]}_{f.id}.pdf"
+        usados.add(nome)
+        nomes[f.id] = nome
+    
+    def gerar():
+        zip_stream = ZipStream()
+        prontos, pendentes, erros = [], {}, []
+        
+        faltando = []
+        for f in fichas:
+            caminho = caminho_pdf(f.id, versoes[f.id])
+            if os.path.exists(caminho):
+                prontos.append((f, caminho))
+            else:
+                faltando.append(f)
+        
+        # As fichas sem PDF em cache são custeadas num lote só e vão para o pool;
+        # as conversões rodam enquanto as prontas são enviadas
+        metricas = EngineCalculo.processar_fichas([f.id for f in faltando], detalhar=True)
+        for f in faltando:
+            pendentes[converter_pdf(html_ficha_pdf(f, metricas[f.id]))] = f
+        
+        for f, caminho in prontos:
+            with open(caminho, 'rb') as arquivo:
+                yield zip_stream.adicionar(nomes[f.id], arquivo.read(), zipfile.ZIP_STORED)
+        
+        for futuro in as_completed(pendentes):
+            f = pendentes[futuro]
+            try:
+                dados = futuro.result()
+            except Exception as e:
+                logger.error(f"Erro ao gerar PDF da ficha {f.id}: {e}")
+                erros.append(f"{f.nome}: {e}")
+                continue
+            guardar_pdf(f.id, versoes[f.id], dados)
+            yield zip_stream.adicionar(nomes[f.id], dados, zipfile.ZIP_STORED)
+        
+        if erros:
+            yield zip_stream.adicionar('ERROS.txt', '\n'.join(erros).encode('utf-8'))
+        yield zip_stream.fechar()
+    
+    return Response(stream_with_context(gerar()), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename=cardapio_fichas.zip'})
+
+# ==============================================================================
+# EXPORTAÇÃO XLSX EM STREAMING
+# ==============================================================================
+# O XLSX é um zip de XMLs (SpreadsheetML). Ele é escrito à mão sobre o
+# ZipStream: textos vão inline nas células (sem tabela de strings
+# compartilhadas) e cada aba é gerada linha a linha a partir das mesmas
+# consultas em lote das exportações CSV, então a memória não cresce com o volume.
+_XML_INVALIDO = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+# Índices de cellXfs em _ESTILOS_XLSX
+ESTILO_TEXTO, ESTILO_CABECALHO, ESTILO_2_CASAS, ESTILO_3_CASAS, ESTILO_4_CASAS, ESTILO_INTEIRO = range(6)
+ESTILOS_POR_CASAS = {None: ESTILO_TEXTO, 0: ESTILO_INTEIRO, 2: ESTILO_2_CASAS, 3: ESTILO_3_CASAS, 4: ESTILO_4_CASAS}
+
+_ESTILOS_XLSX = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2"><numFmt numFmtId="164" formatCode="#,##0.000"/><numFmt numFmtId="165" formatCode="#,##0.0000"/></numFmts>'
+    '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font><font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+    '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="6">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '<xf numFmtId="4" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="3" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+def _coluna_xlsx(indice):
+    """0 -> A, 25 -> Z, 26 -> AA"""
+    letras = ''
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(65 + resto) + letras
+    return letras
+
+def _celula_xlsx(ref, valor, estilo):
+    if valor is None or valor == '':
+        return ''
+    if isinstance(valor, (int, float)) and not isinstance(valor, bool):
+        if valor != valor or valor in (float('inf'), float('-inf')):
+            return ''
+        return f'<c r="{ref}" s="{estilo}"><v>{valor!r}</v></c>'
+    texto = escape_xml(_XML_INVALIDO.sub('', str(valor)))
+    return f'<c r="{ref}" t="inlineStr" s="{estilo}"><is><t xml:space="preserve">{texto}</t></is></c>'
+
+def _linha_xlsx(numero, valores, colunas, estilos):
+    celulas = ''.join(_celula_xlsx(f'{col}{numero}', valor, estilo)
+                      for col, valor, estilo in zip(colunas, valores, estilos))
+    return f'<row r="{numero}">{celulas}</row>'
+
+def gerar_xlsx(abas):
+    """Gera os bytes de um .xlsx; `abas` é uma lista de (nome, cabecalho, casas, linhas)"""
+    zip_stream = ZipStream()
+    
+    tipos = ''.join(
+        f'<Override PartName="/xl/worksheets/sheet{n}.xml" '
+        f'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        for n in range(1, len(abas) + 1))
+    yield zip_stream.adicionar('[Content_Types].xml', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/styles.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+        f'{tipos}</Types>'))
+    yield zip_stream.adicionar('_rels/.rels', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="xl/workbook.xml"/></Relationships>'))
+    
+    planilhas = ''.join(f'<sheet name="{escape_xml(nome[:31])}" sheetId="{n}" r:id="rId{n}"/>'
+                        for n, (nome, _, _, _) in enumerate(abas, 1))
+    yield zip_stream.adicionar('xl/workbook.xml', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets>{planilhas}</sheets></workbook>'))
+    
+    relacoes = ''.join(
+        f'<Relationship Id="rId{n}" '
+        f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        f'Target="worksheets/sheet{n}.xml"/>'
+        for n in range(1, len(abas) + 1))
+    yield zip_stream.adicionar('xl/_rels/workbook.xml.rels', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        f'{relacoes}<Relationship Id="rId{len(abas) + 1}" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+        'Target="styles.xml"/></Relationships>'))
+    yield zip_stream.adicionar('xl/styles.xml', _ESTILOS_XLSX)
+    
+    for n, (_, cabecalho, casas, linhas) in enumerate(abas, 1):
+        colunas = [_coluna_xlsx(i) for i in range(len(cabecalho))]
+        estilos = [ESTILOS_POR_CASAS[c] for c in casas]
+        with zip_stream.abrir(f'xl/worksheets/sheet{n}.xml') as destino:
+            bloco = [
+                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+                '<sheetViews><sheetView workbookViewId="0">'
+                '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+                '</sheetView></sheetViews><sheetData>',
+                _linha_xlsx(1, cabecalho, colunas, [ESTILO_CABECALHO] * len(colunas)),
+            ]
+            tamanho = 0
+            for numero, linha in enumerate(linhas, start=2):
+                texto = _linha_xlsx(numero, linha, colunas, estilos)
+                bloco.append(texto)
+                tamanho += len(texto)
+                if tamanho >= TAMANHO_BLOCO_CSV:
+                    destino.write(''.join(bloco).encode('utf-8'))
+                    bloco, tamanho = [], 0
+                    pronto = zip_stream.retirar()
+                    if pronto:
+                        yield pronto
+            bloco.append('</sheetData></worksheet>')
+            destino.write(''.join(bloco).encode('utf-8'))
+        yield zip_stream.retirar()
+    
+    yield zip_stream.fechar()
+
+def resposta_xlsx(nome_arquivo, abas):
+    return Response(stream_with_context(gerar_xlsx(abas)),
+                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                    headers={'Content-Disposition': f'attachment; filename={nome_arquivo}'})
+
+@app.route('/fichas/exportar/xlsx')
+@login_required
+def exportar_livro_custos():
+    """Livro de custos completo: insumos, bases e fichas item a item"""
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    return resposta_xlsx('livro_custos.xlsx', [
+        ('Insumos', CABECALHO_INSUMOS, CASAS_INSUMOS, linhas_custo_insumos(usuario)),
+        ('Bases', CABECALHO_BASES, CASAS_BASES, linhas_custo_bases(usuario)),
+        ('Fichas', CABECALHO_FICHAS, CASAS_FICHAS, linhas_custo_fichas(usuario)),
+    ])
+
+# ==============================================================================
+# BACKUP E RESTAURAÇÃO POR LOJA (NDJSON COMPACTADO)
+# ==============================================================================
+# Cada loja vira um arquivo .ndjson.gz: uma linha de cabeçalho e, para cada
+# tabela em ordem de dependência, uma linha com os nomes das colunas seguida de
+# uma linha JSON por registro. A restauração cria uma loja nova, grava em lotes
+# e remapeia as chaves estrangeiras para os ids gerados no banco de destino,
+# então o mesmo arquivo serve para levar a loja do SQLite para o PostgreSQL e vice-versa.
+# Senhas e o usuário mestre não vão para o backup: na restauração cada usuário
+# recebe uma senha aleatória e só entra depois que o administrador a redefinir.
+FORMATO_BACKUP = 'foodcost-loja'
+VERSAO_BACKUP = 1
+LOTE_BACKUP = 1000
+
+# referencias: coluna -> tabela, ou coluna -> (coluna_tipo, {tipo: tabela}) para
+# chaves polimórficas. pai: (coluna, modelo) das tabelas sem loja_id confiável,
+# que seguem a loja do registro pai. sem_colunas: colunas que não são exportadas.
+TabelaBackup = namedtuple('TabelaBackup', 'modelo referencias pai opcional sem_colunas', defaults=(None, False, ()))
+
+TABELAS_BACKUP = [
+    TabelaBackup(Loja, {}),
+    TabelaBackup(Usuario, {'loja_id': 'lojas'}, sem_colunas=('password',)),
+    TabelaBackup(Categoria, {'user_id': 'usuarios', 'loja_id': 'lojas'}),
+    TabelaBackup(Unidade, {'user_id': 'usuarios', 'loja_id': 'lojas'}),
+    TabelaBackup(Insumo, {'user_id': 'usuarios', 'categoria_id': 'categorias',
+                          'unidade_id': 'unidades', 'loja_id': 'lojas'}),
+    TabelaBackup(Base, {'user_id': 'usuarios', 'loja_id': 'lojas'}),
+    TabelaBackup(BaseItem, {'base_id': 'bases', 'insumo_id': 'insumos', 'loja_id': 'lojas'},
+                 pai=('base_id', Base)),
+    TabelaBackup(Ficha, {'user_id': 'usuarios', 'loja_id': 'lojas'}),
+    TabelaBackup(FichaItem, {'ficha_id': 'fichas', 'loja_id': 'lojas',
+                             'referencia_id': ('tipo_item', {'insumo': 'insumos', 'base': 'bases'})},
+                 pai=('ficha_id', Ficha)),
+    TabelaBackup(FornecedorProduto, {'loja_id': 'lojas', 'insumo_id': 'insumos'}),
+    TabelaBackup(NotaFiscal, {'loja_id': 'lojas', 'user_id': 'usuarios'}),
+    TabelaBackup(NotaFiscalItem, {'nota_id': 'notas_fiscais', 'loja_id': 'lojas', 'insumo_id': 'insumos'},
+                 pai=('nota_id', NotaFiscal)),
+    TabelaBackup(VendaDiaria, {'loja_id': 'lojas', 'ficha_id': 'fichas'}),
+    TabelaBackup(VendaSemFicha, {'loja_id': 'lojas'}),
+    TabelaBackup(ImportacaoVendas, {'loja_id': 'lojas', 'user_id': 'usuarios'}),
+    TabelaBackup(MovimentoEstoque, {'loja_id': 'lojas', 'insumo_id': 'insumos',
+                                    'nota_item_id': 'notas_fiscais_itens', 'user_id': 'usuarios'}),
+    TabelaBackup(SaldoEstoque, {'loja_id': 'lojas', 'insumo_id': 'insumos'}),
+    TabelaBackup(Maquina, {'loja_id': 'lojas'}),
+    TabelaBackup(HistoricoLicenca, {'loja_id': 'lojas', 'usuario_id': 'usuarios'}),
+    TabelaBackup(LogAcesso, {'loja_id': 'lojas', 'usuario_id': 'usuarios'}, opcional=True),
+    TabelaBackup(AlertaCmv, {'loja_id': 'lojas', 'ficha_id': 'fichas'}, opcional=True),
+]
+
+def _valor_json(valor):
+    if isinstance(valor, (datetime, date)):
+        return valor.isoformat()
+    raise TypeError(f"Tipo não serializável no backup: {type(valor).__name__}")
+
+def gerar_backup(loja_id, incluir_opcionais=False):
+    """Bytes do backup da loja (NDJSON compactado com gzip), gerados em streaming"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+    tabelas = [t for t in TABELAS_BACKUP if incluir_opcionais or not t.opcional]
+    
+    def registros():
+        yield {'formato': FORMATO_BACKUP, 'versao': VERSAO_BACKUP, 'loja_id': loja_id,
+               'gerado_em': datetime.now().isoformat(), 'banco': db.engine.dialect.name,
+               'tabelas': [t.modelo.__tablename__ for t in tabelas]}
+        contagem = {}
+        for t in tabelas:
+            tabela = t.modelo.__table__
+            if t.modelo is Loja:
+                filtro = tabela.c.id == loja_id
+            elif t.pai:
+                coluna, modelo_pai = t.pai
+                filtro = tabela.c[coluna].in_(select(modelo_pai.id).where(modelo_pai.loja_id == loja_id))
+            else:
+                filtro = tabela.c.loja_id == loja_id
+            if t.modelo is Usuario:
+                filtro = and_(filtro, tabela.c.username != 'bpereira')
+            
+            colunas = [c for c in tabela.columns if c.name not in t.sem_colunas]
+            yield {'tabela': tabela.name, 'colunas': [c.name for c in colunas]}
+            consulta = (select(*colunas).where(filtro).order_by(*tabela.primary_key.columns)
+                        .execution_options(yield_per=LOTE_BACKUP))
+            total = 0
+            for linha in db.session.execute(consulta):
+                yield list(linha)
+                total += 1
+            contagem[tabela.name] = total
+        yield {'fim': True, 'contagem': contagem}
+    
+    bloco, tamanho = [], 0
+    for registro in registros():
+        texto = json.dumps(registro, ensure_ascii=False, separators=(',', ':'), default=_valor_json) + '\n'
+        bloco.append(texto)
+        tamanho += len(texto)
+        if tamanho >= TAMANHO_BLOCO_CSV:
+            pronto = compressor.compress(''.join(bloco).encode('utf-8'))
+            bloco, tamanho = [], 0
+            if pronto:
+                yield pronto
+    yield compressor.compress(''.join(bloco).encode('utf-8')) + compressor.flush()
+
+def restaurar_loja(fluxo, nome_loja=None):
+    """Recria a loja de um backup como uma loja nova neste banco.
+
+    Usuários com username já existente são reaproveitados, máquinas cujo
+    fingerprint já está cadastrado são ignoradas e uma chave de licença repetida
+    não é copiada; cada caso gera um aviso. Tudo roda numa transação só.
+    Retorna (id da nova loja, registros gravados por tabela, avisos).
+    """
+    leitor = io.TextIOWrapper(gzip.GzipFile(fileobj=fluxo, mode='rb'), encoding='utf-8')
+    cabecalho = json.loads(next(leitor, 'null'))
+    if not isinstance(cabecalho, dict) or cabecalho.get('formato') != FORMATO_BACKUP:
+        raise ValueError("o arquivo não é um backup de loja")
+    if cabecalho.get('versao', 0) > VERSAO_BACKUP:
+        raise ValueError(f"backup na versão {cabecalho['versao']}, mais nova que este sistema")
+    if db.session.query(func.count(Loja.id)).scalar() >= 10:
+        raise ValueError("limite de 10 lojas atingido")
+    
+    especificacoes = {t.modelo.__tablename__: t for t in TABELAS_BACKUP}
+    referenciadas = {destino for t in TABELAS_BACKUP for destino in t.referencias.values() if isinstance(destino, str)}
+    referenciadas.update(tabela for t in TABELAS_BACKUP for destino in t.referencias.values()
+                         if isinstance(destino, tuple) for tabela in destino[1].values())
+    
+    mapas = defaultdict(dict)   # tabela -> {id no backup: id neste banco}
+    gravados, lidos, avisos = defaultdict(int), defaultdict(int), []
+    estado = {'spec': None, 'colunas': [], 'datas': {}, 'lote': []}
+    
+    def gravar():
+        spec, lote = estado['spec'], estado['lote']
+        if not spec or not lote:
+            return
+        estado['lote'] = []
+        tabela = spec.modelo.__table__
+        nome = tabela.name
+        colunas_destino = set(tabela.columns.keys())
+        
+        registros = []
+        for valores in lote:
+            registro = {c: v for c, v in zip(estado['colunas'], valores) if c in colunas_destino}
+            for coluna, converter in estado['datas'].items():
+                if registro.get(coluna):
+                    registro[coluna] = converter(registro[coluna])
+            registros.append(registro)
+        
+        # Conflitos com registros únicos que já existem neste banco
+        if nome == 'usuarios':
+            existentes = dict(db.session.query(Usuario.username, Usuario.id)
+                              .filter(Usuario.username.in_([r['username'] for r in registros])))
+            restantes = []
+            for r in registros:
+                if r['username'] in existentes:
+                    mapas[nome][r['id']] = existentes[r['username']]
+                    avisos.append(f"Usuário '{r['username']}' já existe e foi reaproveitado")
+                else:
+                    # Backups antigos traziam a senha; ela nunca é restaurada
+                    r['password'] = secrets.token_urlsafe(24)
+                    restantes.append(r)
+            if restantes:
+                avisos.append(f"{len(restantes)} usuário(s) restaurado(s) com senha aleatória: "
+                              f"redefina a senha de cada um antes do primeiro acesso")
+            registros = restantes
+        elif nome == 'maquinas':
+            fingerprints = {r.get('fingerprint') for r in registros if r.get('fingerprint')}
+            existentes = {f for (f,) in db.session.query(Maquina.fingerprint).filter(Maquina.fingerprint.in_(fingerprints))}
+            if existentes:
+                avisos.append(f"{len(existentes)} máquina(s) já cadastrada(s) neste banco foram ignoradas")
+            registros = [r for r in registros if r.get('fingerprint') not in existentes]
+        elif nome == 'lojas':
+            for r in registros:
+                if nome_loja:
+                    r['nome'] = nome_loja
+                if r.get('chave_licenca') and Loja.query.filter_by(chave_licenca=r['chave_licenca']).first():
+                    r['chave_licenca'] = None
+                    avisos.append("A chave de licença já pertence a outra loja e não foi copiada")
+        
+        # Chaves estrangeiras passam para os ids deste banco
+        validos = []
+        for r in registros:
+            for coluna, destino in spec.referencias.items():
+                antigo = r.get(coluna)
+                if antigo is None:
+                    continue
+                if isinstance(destino, tuple):
+                    destino = destino[1].get(r.get(destino[0]))
+                novo = mapas[destino].get(antigo) if destino else None
+                if novo is None and not tabela.c[coluna].nullable:
+                    break
+                r[coluna] = novo
+            else:
+                validos.append(r)
+        if len(validos) < len(registros):
+            avisos.append(f"{len(registros) - len(validos)} registro(s) de '{nome}' sem referência válida foram ignorados")
+        if not validos:
+            return
+        
+        ids_antigos = [r.pop('id', None) for r in validos]
+        if nome in referenciadas:
+            novos = db.session.execute(
+                tabela.insert().returning(tabela.c.id, sort_by_parameter_order=True), validos
+            ).scalars().all()
+            mapas[nome].update(zip(ids_antigos, novos))
+        else:
+            db.session.execute(tabela.insert(), validos)
+        gravados[nome] += len(validos)
+    
+    fim = None
+    for texto in leitor:
+        registro = json.loads(texto)
+        if isinstance(registro, list):
+            if estado['spec'] is None:
+                raise ValueError("registro antes do cabeçalho da tabela")
+            estado['lote'].append(registro)
+            lidos[estado['spec'].modelo.__tablename__] += 1
+            if len(estado['lote']) >= LOTE_BACKUP:
+                gravar()
+            continue
+        
+        gravar()
+        if registro.get('fim'):
+            fim = registro
+            break
+        spec = especificacoes.get(registro.get('tabela'))
+        if spec is None:
+            raise ValueError(f"tabela desconhecida no backup: {registro.get('tabela')}")
+        estado.update(spec=spec, colunas=registro['colunas'], lote=[], datas={
+            c.name: datetime.fromisoformat if isinstance(c.type, db.DateTime) else date.fromisoformat
+            for c in spec.modelo.__table__.columns if isinstance(c.type, (db.DateTime, db.Date))})
+    
+    if fim is None:
+        raise ValueError("backup incompleto (arquivo truncado)")
+    for tabela, total in fim.get('contagem', {}).items():
+        if lidos.get(tabela, 0) != total:
+            raise ValueError(f"backup inconsistente: '{tabela}' com {lidos.get(tabela, 0)} de {total} registros")
+    
+    loja_id = next(iter(mapas['lojas'].values()), None)
+    if loja_id is None:
+        raise ValueError("backup sem a loja")
+    db.session.commit()
+    return loja_id, dict(gravados), avisos
+
+@app.route('/admin/backup')
+@login_required
+@admin_required
+def admin_backup():
+    usuario = db.session.get(Usuario, session['usuario_id'])
+    loja_id = usuario.loja_id
+    if usuario.username == 'bpereira':
+        loja_id = request.args.get('loja_id', type=int) or loja_id
+    
+    loja = db.session.get(Loja, loja_id) if loja_id else None
+    if not loja:
+        flash("Loja não encontrada.", "warning")
+        return redirect(url_for('index'))
+    
+    incluir_logs = request.args.get('logs') == '1'
+    nome_arquivo = f"backup_loja_{loja.id}_{datetime.now():%Y%m%d_%H%M}.ndjson.gz"
+    logger.info(f"Backup da loja {loja.id} gerado por {usuario.username}")
+    return Response(stream_with_context(gerar_backup(loja.id, incluir_logs)), mimetype='application/gzip',
+                    headers={'Content-Disposition': f'attachment; filename={nome_arquivo}'})
+
+@app.route('/admin/restaurar', methods=['POST'])
+@login_required
+@super_admin_required
+def admin_restaurar():
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        flash("Selecione o arquivo de backup.", "warning")
+        return redirect(url_for('admin_master'))
+    
+    inicio = time.time()
+    try:
+        loja_id, gravados, avisos = restaurar_loja(arquivo.stream, request.form.get('nome', '').strip() or None)
+    except (ValueError, OSError, EOFError) as e:
+        db.session.rollback()
+        flash(f"Backup inválido: {e}", "danger")
+        return redirect(url_for('admin_master'))
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        logger.error(f"Erro ao restaurar backup: {e}")
+        flash(f"Erro ao restaurar backup: {e}", "danger")
+        return redirect(url_for('admin_master'))
+    
+    logger.info(f"Backup restaurado como loja {loja_id}: {gravados} em {time.time() - inicio:.2f}s")
+    flash(f"Loja restaurada (ID {loja_id}): {sum(gravados.values())} registros em {time.time() - inicio:.1f}s.", "success")
+    for aviso in avisos[:5]:
+        flash(aviso, "warning")
+    return redirect(url_for('admin_master'))
+
+@app.cli.command('backup-loja')
+@click.argument('loja_id', type=int)
+@click.option('--saida', default=None, help='Arquivo de destino (padrão: backup_loja_<id>_<data>.ndjson.gz).')
+@click.option('--logs', is_flag=True, help='Inclui os logs de acesso.')
+def backup_loja_cli(loja_id, saida, logs):
+    """Gera o backup de uma loja em NDJSON compactado"""
+    if not db.session.get(Loja, loja_id):
+        raise click.ClickException(f"Loja {loja_id} não encontrada")
+    saida = saida or f"backup_loja_{loja_id}_{datetime.now():%Y%m%d_%H%M}.ndjson.gz"
+    inicio = time.time()
+    with open(saida, 'wb') as arquivo:
+        for bloco in gerar_backup(loja_id, logs):
+            arquivo.write(bloco)
+    click.echo(f"Backup gravado em {saida} ({os.path.getsize(saida) / 1024:.0f} KB, {time.time() - inicio:.2f}s)")
+
+@app.cli.command('restaurar-loja')
+@click.argument('arquivo', type=click.Path(exists=True, dir_okay=False))
+@click.option('--nome', default=None, help='Novo nome para a loja restaurada.')
+def restaurar_loja_cli(arquivo, nome):
+    """Restaura um backup de loja como uma loja nova"""
+    inicio = time.time()
+    with open(arquivo, 'rb') as fluxo:
+        try:
+            loja_id, gravados, avisos = restaurar_loja(fluxo, nome)
+        except (ValueError, OSError, EOFError) as e:
+            db.session.rollback()
+            raise click.ClickException(f"Backup inválido: {e}")
+    for aviso in avisos:
+        click.echo(f"Aviso: {aviso}")
+    click.echo(f"Loja restaurada com ID {loja_id} em {time.time() - inicio:.2f}s")
+    for tabela, total in gravados.items():
+        click.echo(f"  {tabela}: {total}")
+
 # ==============================================================================
 # ROTAS PARA ATIVAÃ‡ÃƒO DE LICENÃ‡A
 # ==============================================================================
@@ -2111,6 +6623,7 @@ def initialize_database():
     if not first_request_flag:
         # Criar banco de dados se nÃ£o existir
         db.create_all()
+        migrar_esquema()
         setup_database()
         validar_limite_sistema()
         first_request_flag = True
@@ -2150,7 +6663,71 @@ def check_and_fix_database():
             print(f"âŒ Erro ao adicionar coluna: {e}")
             db.session.rollback()
 
+# Colunas criadas depois da primeira versão das tabelas. O create_all não altera
+# tabelas que já existem, então elas são adicionadas aqui.
+COLUNAS_MIGRADAS = [
+    ('insumos', 'versao', 'INTEGER NOT NULL DEFAULT 1'),
+    ('bases', 'versao', 'INTEGER NOT NULL DEFAULT 1'),
+    ('fichas', 'versao', 'INTEGER NOT NULL DEFAULT 1'),
+    ('fichas', 'codigo_pdv', 'VARCHAR(40)'),
+    ('unidades', 'loja_id', 'INTEGER REFERENCES lojas(id)'),
+]
+
+# Registros gravados sem loja herdam a loja do usuário dono
+TABELAS_POR_LOJA = ['categorias', 'unidades', 'insumos', 'bases', 'fichas']
+
+def migrar_esquema():
+    """Adiciona colunas novas em bancos já existentes (SQLite e PostgreSQL)"""
+    from sqlalchemy import inspect, text
+    
+    inspector = inspect(db.engine)
+    tabelas = inspector.get_table_names()
+    
+    for tabela, coluna, definicao in COLUNAS_MIGRADAS:
+        if tabela not in tabelas:
+            continue
+        colunas = [col['name'] for col in inspector.get_columns(tabela)]
+        if coluna in colunas:
+            continue
+        try:
+            db.session.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {coluna} {definicao}"))
+            db.session.commit()
+            logger.info(f">>> Coluna '{tabela}.{coluna}' adicionada")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Erro ao adicionar coluna '{tabela}.{coluna}': {e}")
+    
+    for tabela in TABELAS_POR_LOJA:
+        try:
+            db.session.execute(text(
+                f"UPDATE {tabela} SET loja_id = "
+                f"(SELECT usuarios.loja_id FROM usuarios WHERE usuarios.id = {tabela}.user_id) "
+                f"WHERE loja_id IS NULL"
+            ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Erro ao preencher loja_id em '{tabela}': {e}")
+    
+    # Vínculos de NF-e criados por nome parecido passam a ser só sugestões
+    try:
+        db.session.execute(text("UPDATE fornecedor_produtos SET origem = 'SUGERIDO' WHERE origem = 'SEMELHANTE'"))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Erro ao rebaixar vínculos semelhantes: {e}")
+    
+    # Índices declarados nos modelos que ainda não existem no banco
+    for tabela in db.metadata.sorted_tables:
+        for indice in tabela.indexes:
+            try:
+                indice.create(db.engine, checkfirst=True)
+            except Exception as e:
+                logger.error(f"Erro ao criar índice '{indice.name}': {e}")
+
 if __name__ == '__main__':
+    # Executável congelado: os processos do pool de PDFs não podem subir o servidor de novo
+    multiprocessing.freeze_support()
     # Modo produÃ§Ã£o
     port = int(os.environ.get('PORT', 10000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,76 @@
+# comprimir_estaticos.py
+# Gera as versões pré-comprimidas dos arquivos de static/ (.gz, e também .br e
+# .zst se os pacotes brotli e zstandard estiverem instalados). Roda no build;
+# o app.py entrega a versão que o navegador aceita, com Content-Encoding.
+# Uso: python comprimir_estaticos.py [pasta]   (padrão: static/ ao lado deste arquivo)
+import gzip
+import os
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+EXTENSOES = {'.js', '.css', '.svg', '.html', '.json', '.txt', '.map'}
+TAMANHO_MINIMO = 512
+
+
+def codificadores():
+    """extensão -> função que comprime os bytes no nível máximo (é feito uma vez só)"""
+    lista = {'.gz': lambda dados: gzip.compress(dados, compresslevel=9, mtime=0)}
+    if brotli:
+        lista['.br'] = lambda dados: brotli.compress(dados, quality=11)
+    if zstandard:
+        lista['.zst'] = zstandard.ZstdCompressor(level=19).compress
+    return lista
+
+
+def comprimir_pasta(pasta):
+    codigos = codificadores()
+    total_original, total_gzip, arquivos = 0, 0, 0
+    for raiz, _, nomes in os.walk(pasta):
+        for nome in sorted(nomes):
+            origem = os.path.join(raiz, nome)
+            if os.path.splitext(nome)[1].lower() not in EXTENSOES:
+                continue
+            with open(origem, 'rb') as f:
+                dados = f.read()
+            if len(dados) < TAMANHO_MINIMO:
+                continue
+
+            arquivos += 1
+            total_original += len(dados)
+            estatisticas = os.stat(origem)
+            for extensao, comprimir in codigos.items():
+                destino = origem + extensao
+                comprimido = comprimir(dados)
+                if len(comprimido) >= len(dados):
+                    if os.path.exists(destino):
+                        os.remove(destino)
+                    continue
+                with open(destino, 'wb') as f:
+                    f.write(comprimido)
+                # Mesma data do original: o app só usa a versão comprimida se ela não for mais antiga
+                os.utime(destino, (estatisticas.st_atime, estatisticas.st_mtime))
+                if extensao == '.gz':
+                    total_gzip += len(comprimido)
+            print(f"  {os.path.relpath(origem, pasta)}: {len(dados)} bytes -> "
+                  + ', '.join(f"{ext} {os.path.getsize(origem + ext)}" for ext in codigos
+                              if os.path.exists(origem + ext)))
+    return arquivos, total_original, total_gzip
+
+
+if __name__ == '__main__':
+    pasta = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    print(f"🗜️  COMPRIMINDO ARQUIVOS ESTÁTICOS EM {pasta}")
+    print(f"Formatos: {', '.join(codificadores())}")
+    arquivos, original, comprimido = comprimir_pasta(pasta)
+    if arquivos:
+        print(f"✅ {arquivos} arquivo(s): {original} bytes -> {comprimido} bytes em gzip")
+    else:
+        print("Nenhum arquivo para comprimir.")
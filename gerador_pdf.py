@@ -0,0 +1,18 @@
+# gerador_pdf.py
+# Conversão HTML -> PDF das fichas técnicas.
+# Fica fora do app.py para que a função enviada ao pool de PDFs seja
+# referenciada por este módulo. Os processos ainda carregam o app: com fork
+# herdam o processo inteiro e com spawn reimportam o módulo principal (o
+# servidor só não sobe de novo porque fica sob `if __name__ == '__main__'`).
+import io
+
+
+def html_para_pdf(html):
+    """Converte o HTML já renderizado em bytes de PDF (xhtml2pdf)"""
+    from xhtml2pdf import pisa
+
+    saida = io.BytesIO()
+    resultado = pisa.CreatePDF(html, dest=saida, encoding='utf-8')
+    if resultado.err:
+        raise RuntimeError(f"xhtml2pdf retornou {resultado.err} erro(s) ao gerar o PDF")
+    return saida.getvalue()
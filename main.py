@@ -1,4 +1,5 @@
-﻿import threading
+﻿import multiprocessing
+import threading
 import webbrowser
 import time
 from FoodCost_Ultimate_ERP_v8.app import app, init_db
@@ -9,6 +10,7 @@ def open_browser():
     webbrowser.open("http://127.0.0.1:5000")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     init_db()
     # O daemon=True garante que a thread feche se o programa principal fechar
     threading.Thread(target=open_browser, daemon=True).start()
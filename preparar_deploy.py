@@ -36,7 +36,7 @@ Werkzeug==2.3.7
   - type: web
     name: foodcost-erp
     env: python
-    buildCommand: pip install -r requirements.txt
+    buildCommand: pip install -r requirements.txt && python comprimir_estaticos.py
     startCommand: gunicorn app:app
     envVars:
       - key: DATABASE_URL
@@ -0,0 +1,105 @@
+// Busca de insumos e bases nos formulários de ficha e de base.
+// Cada campo é um <div class="busca-item" data-tipo="insumo|base"> com o texto
+// digitado (.busca-texto), o id escolhido (input hidden) e a lista de sugestões
+// (.busca-resultados). Os eventos são delegados no document, então as linhas
+// clonadas pelo "+ Insumo" também funcionam.
+(function () {
+    const ESPERA_MS = 150;
+
+    function campo(el) { return el.closest('.busca-item'); }
+    function oculto(item) { return item.querySelector('input[type="hidden"]'); }
+    function lista(item) { return item.querySelector('.busca-resultados'); }
+
+    function rotulo(r) { return r.unidade ? `${r.nome} (${r.unidade})` : r.nome; }
+
+    function fechar(item) {
+        lista(item).innerHTML = '';
+        lista(item).classList.add('d-none');
+    }
+
+    function escolher(item, botao) {
+        oculto(item).value = botao.dataset.id;
+        const texto = item.querySelector('.busca-texto');
+        texto.value = botao.dataset.rotulo;
+        texto.classList.remove('is-invalid');
+        fechar(item);
+    }
+
+    function mostrar(item, resultados) {
+        const ul = lista(item);
+        ul.innerHTML = '';
+        if (!resultados.length) {
+            ul.innerHTML = '<div class="list-group-item small text-muted">Nada encontrado</div>';
+        }
+        resultados.forEach((r, n) => {
+            const botao = document.createElement('button');
+            botao.type = 'button';
+            botao.className = 'list-group-item list-group-item-action py-1' + (n === 0 ? ' active' : '');
+            botao.dataset.id = r.id;
+            botao.dataset.rotulo = rotulo(r);
+            botao.textContent = rotulo(r);
+            ul.appendChild(botao);
+        });
+        ul.classList.remove('d-none');
+    }
+
+    function buscar(item, texto) {
+        if (item._controle) item._controle.abort();
+        if (!texto.trim()) { fechar(item); return; }
+        item._controle = new AbortController();
+        fetch(`/busca/${item.dataset.tipo}?q=${encodeURIComponent(texto)}`, {signal: item._controle.signal})
+            .then(r => r.json())
+            .then(resultados => mostrar(item, resultados))
+            .catch(() => {});
+    }
+
+    document.addEventListener('input', e => {
+        if (!e.target.classList.contains('busca-texto')) return;
+        const item = campo(e.target);
+        // Texto editado depois da escolha: o id antigo não vale mais
+        oculto(item).value = '';
+        e.target.classList.toggle('is-invalid', e.target.value.trim() !== '');
+        clearTimeout(item._espera);
+        item._espera = setTimeout(() => buscar(item, e.target.value), ESPERA_MS);
+    });
+
+    document.addEventListener('keydown', e => {
+        if (!e.target.classList.contains('busca-texto')) return;
+        const item = campo(e.target);
+        const botoes = [...lista(item).querySelectorAll('button')];
+        const atual = botoes.findIndex(b => b.classList.contains('active'));
+        if (e.key === 'ArrowDown' || e.key === 'ArrowUp') {
+            if (!botoes.length) return;
+            e.preventDefault();
+            const proximo = (atual + (e.key === 'ArrowDown' ? 1 : botoes.length - 1)) % botoes.length;
+            botoes.forEach((b, n) => b.classList.toggle('active', n === proximo));
+        } else if (e.key === 'Enter' && botoes.length) {
+            e.preventDefault();
+            escolher(item, botoes[Math.max(atual, 0)]);
+        } else if (e.key === 'Escape') {
+            fechar(item);
+        }
+    });
+
+    document.addEventListener('mousedown', e => {
+        const botao = e.target.closest('.busca-resultados button');
+        if (botao) {
+            e.preventDefault();
+            escolher(campo(botao), botao);
+        }
+    });
+
+    document.addEventListener('focusout', e => {
+        if (e.target.classList.contains('busca-texto')) fechar(campo(e.target));
+    });
+
+    // Usado pelos botões que clonam uma linha do formulário
+    window.limparBusca = function (raiz) {
+        raiz.querySelectorAll('.busca-item').forEach(item => {
+            item.querySelector('.busca-texto').value = '';
+            item.querySelector('.busca-texto').classList.remove('is-invalid');
+            oculto(item).value = '';
+            fechar(item);
+        });
+    };
+})();
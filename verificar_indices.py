@@ -0,0 +1,62 @@
+# verificar_indices.py
+# Confere o plano de execução das principais listagens por loja.
+# Usa as mesmas consultas geradas pelo app.py (escopo_loja / filtros_loja).
+from types import SimpleNamespace
+
+from sqlalchemy import text
+
+from app import (app, db, migrar_esquema, escopo_loja, filtros_loja,
+                 consulta_insumos_resumo, consulta_bases_resumo,
+                 Ficha, Insumo, Base, Categoria, Unidade)
+
+print("🔍 VERIFICAÇÃO DE ÍNDICES DAS LISTAGENS")
+print("="*60)
+
+admin = SimpleNamespace(id=1, loja_id=1, role='admin', username='admin')
+comum = SimpleNamespace(id=2, loja_id=1, role='user', username='usuario')
+
+falhas = 0
+
+with app.app_context():
+    migrar_esquema()
+
+    consultas = [
+        ('Insumos (admin)', 'ix_insumos_loja_nome', consulta_insumos_resumo(*filtros_loja(Insumo, admin))),
+        ('Insumos (usuário)', 'ix_insumos_loja_nome', consulta_insumos_resumo(*filtros_loja(Insumo, comum))),
+        ('Bases (admin)', 'ix_bases_loja_nome', consulta_bases_resumo(*filtros_loja(Base, admin))),
+        ('Fichas (admin)', 'ix_fichas_loja_nome', escopo_loja(Ficha, admin).order_by(Ficha.nome)),
+        ('Fichas (usuário)', 'ix_fichas_loja_nome', escopo_loja(Ficha, comum).order_by(Ficha.nome)),
+        ('Categorias', 'ix_categorias_loja_nome', escopo_loja(Categoria, admin).order_by(Categoria.nome)),
+        ('Unidades', 'ix_unidades_loja_sigla', escopo_loja(Unidade, admin).order_by(Unidade.sigla)),
+    ]
+
+    dialeto = db.engine.dialect.name
+    prefixo = 'EXPLAIN QUERY PLAN ' if dialeto == 'sqlite' else 'EXPLAIN '
+
+    for titulo, indice, consulta in consultas:
+        sql = str(consulta.statement.compile(db.engine, compile_kwargs={'literal_binds': True}))
+        plano = [' '.join(str(c) for c in linha) for linha in db.session.execute(text(prefixo + sql))]
+        texto = '\n'.join(plano)
+
+        usa_indice = indice in texto
+        ordena_em_memoria = 'TEMP B-TREE FOR ORDER BY' in texto or 'Sort  (' in texto
+
+        if dialeto == 'sqlite' and (not usa_indice or ordena_em_memoria):
+            falhas += 1
+            print(f"❌ {titulo}: esperado {indice} sem ordenação extra")
+        elif dialeto == 'sqlite':
+            print(f"✅ {titulo}: {indice}")
+        else:
+            # No PostgreSQL o planejador prefere Seq Scan em tabelas pequenas;
+            # o plano é exibido para conferência manual.
+            print(f"ℹ️  {titulo}: {'usa ' + indice if usa_indice else 'sem índice neste volume'}")
+
+        for linha in plano:
+            print(f"     {linha}")
+
+print("\n" + "="*60)
+if falhas:
+    print(f"❌ {falhas} consulta(s) sem o índice esperado")
+    raise SystemExit(1)
+print("✅ Todas as listagens usam os índices por loja")
+print("="*60)